@@ -0,0 +1,3 @@
+"""
+Benchmark suite of varpile on synthetic inputs, see `python -m benchmarks --help`.
+"""
@@ -0,0 +1,165 @@
+"""
+Benchmark suite of varpile on synthetic inputs.
+
+    python -m benchmarks generate --kind joint --samples 100 --sites 10000
+    python -m benchmarks run --samples 10 100 1000 --threads 1 4 -o results.json
+    python -m benchmarks compare base.json results.json --threshold 0.1
+
+`run` generates (or reuses) the datasets in --data-dir, runs every stage on every dataset in its own process
+and writes the wall time, CPU time, peak RSS, throughput and output size of every stage as json.
+`compare` prints the change of the throughput (records/s) and peak RSS between two results and exits with 1
+if the throughput of any stage dropped by more than the threshold.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from itertools import product
+from pathlib import Path
+
+import varpile
+
+from .generate import DatasetSpec, generate_dataset
+from .stages import STAGES, run_isolated
+
+ENGINES = ["python", "numpy"]
+
+
+def run_cases(spec: DatasetSpec, data_dir: Path, stages: list[str], threads: list[int]) -> list[dict]:
+    manifest = generate_dataset(spec, data_dir / spec.name)
+    cases = {
+        "infer_sex": [{}],
+        "process_chromosome": [{"engine": engine} for engine in ENGINES],
+        "merge_piles": [{"engine": engine} for engine in ENGINES],
+        "finalize_region": [{}],
+        "end_to_end": [{"engine": engine, "threads": t} for engine, t in product(ENGINES, threads)],
+    }
+
+    results = []
+    for stage in stages:
+        for params in cases[stage]:
+            with tempfile.TemporaryDirectory(prefix="varpile_bench_") as work_dir:
+                metrics = run_isolated(STAGES[stage], manifest, Path(work_dir), *params.values())
+            result = {"stage": stage, "dataset": spec.name, "params": params, **metrics}
+            print(format_result(result), file=sys.stderr)
+            results.append(result)
+    return results
+
+
+def format_result(result: dict) -> str:
+    params = format_params(result["params"])
+    throughput = f"{result['records_per_s']:>12,.0f} rec/s" if result["records_per_s"] else " " * 18
+    return (
+        f"{result['dataset']:<32} {result['stage']:<20} {params:<24} "
+        f"{result['wall_s']:>8.2f} s {throughput} {result['peak_rss_mb']:>8.1f} MB"
+    )
+
+
+def format_params(params: dict) -> str:
+    return " ".join(f"{k}={v}" for k, v in sorted(params.items()))
+
+
+def meta() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=Path(__file__).parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "varpile_version": varpile.__VERSION__,
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def result_key(result: dict) -> tuple:
+    return result["dataset"], result["stage"], format_params(result["params"])
+
+
+def compare(base_path: Path, new_path: Path, threshold: float) -> int:
+    """Print the change of every stage present in both results, return the number of throughput regressions."""
+    base = {result_key(r): r for r in json.loads(base_path.read_text())["results"]}
+    new = {result_key(r): r for r in json.loads(new_path.read_text())["results"]}
+
+    regressions = 0
+    print(f"{'dataset':<32} {'stage':<20} {'params':<24} {'base rec/s':>12} {'new rec/s':>12} {'change':>8} {'RSS':>8}")
+    for key in sorted(base.keys() & new.keys()):
+        b, n = base[key], new[key]
+        if not b["records_per_s"] or not n["records_per_s"]:
+            continue
+        change = n["records_per_s"] / b["records_per_s"] - 1
+        rss_change = n["peak_rss_mb"] / b["peak_rss_mb"] - 1
+        regression = change < -threshold
+        regressions += regression
+        print(
+            f"{key[0]:<32} {key[1]:<20} {key[2]:<24} {b['records_per_s']:>12,.0f} {n['records_per_s']:>12,.0f} "
+            f"{change:>+8.1%} {rss_change:>+8.1%}{'  REGRESSION' if regression else ''}"
+        )
+    for key in sorted(base.keys() ^ new.keys()):
+        print(f"{key[0]:<32} {key[1]:<20} {key[2]:<24} only in {'base' if key in base else 'new'}")
+    return regressions
+
+
+def add_spec_arguments(parser: argparse.ArgumentParser, multiple: bool) -> None:
+    nargs = "+" if multiple else None
+    parser.add_argument("--kind", choices=["joint", "gvcf"], nargs=nargs, default=["joint"] if multiple else "joint")
+    parser.add_argument(
+        "--samples",
+        type=int,
+        nargs=nargs,
+        default=[10, 100] if multiple else 100,
+        help="Samples per file (joint) or number of single-sample files (gvcf).",
+    )
+    parser.add_argument("--sites", type=int, nargs=nargs, default=[10_000] if multiple else 10_000)
+    parser.add_argument("--files", type=int, nargs=nargs, default=[1] if multiple else 1, help="Number of joint files.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", type=Path, default=Path(".benchmarks"), help="Cache of generated datasets.")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmarks of varpile.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="Generate a synthetic dataset.")
+    add_spec_arguments(generate_parser, multiple=False)
+
+    run_parser = subparsers.add_parser("run", help="Run the stages on all combinations of the dataset options.")
+    add_spec_arguments(run_parser, multiple=True)
+    run_parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES))
+    run_parser.add_argument("--threads", type=int, nargs="+", default=[1], help="Threads of the end_to_end stage.")
+    run_parser.add_argument("-o", "--output", type=Path, required=True, help="Results json file.")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two results files.")
+    compare_parser.add_argument("base", type=Path)
+    compare_parser.add_argument("new", type=Path)
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Allowed relative throughput drop.")
+
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        spec = DatasetSpec(args.kind, args.samples, args.sites, args.files, args.seed)
+        manifest = generate_dataset(spec, args.data_dir / spec.name)
+        print(json.dumps(manifest["files"], indent=4))
+
+    elif args.command == "run":
+        results = []
+        for kind, samples, sites, files in product(args.kind, args.samples, args.sites, args.files):
+            spec = DatasetSpec(kind, samples, sites, files, args.seed)
+            results += run_cases(spec, args.data_dir, args.stages, args.threads)
+        args.output.write_text(json.dumps({"meta": meta(), "results": results}, indent=4))
+
+    elif args.command == "compare":
+        sys.exit(1 if compare(args.base, args.new, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
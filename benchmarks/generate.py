@@ -0,0 +1,278 @@
+"""
+Seeded generator of synthetic vcf/bcf inputs.
+
+Genotypes follow Hardy-Weinberg for allele frequencies drawn from a skewed (mostly rare) spectrum,
+DP is gamma-Poisson distributed around a per-sample mean coverage, GQ grows with DP and AD splits the
+reads according to the genotype. XY samples are homozygous (or haploid on chrY) outside PAR regions.
+The sex of the samples is written to the manifest (and sex_map.tsv), inference on the generated files
+is only measured, not checked (hom ref genotypes of rare variants dilute the heterozygous fraction).
+
+Two kinds of datasets:
+- joint: multi-sample files (joint called), every record has all samples (some are missing)
+- gvcf: single-sample gVCF files, variants of the sample and reference blocks between them
+"""
+
+import json
+import math
+import random
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Literal
+
+import pysam
+import pysam.bcftools
+
+from varpile.infer_sex import PAR1_END_1, PAR2_X_BEGIN_1, in_non_par_Y
+
+Kind = Literal["joint", "gvcf"]
+
+# contig: (length, fraction of the sites)
+CONTIGS = {
+    "chr1": (248_956_422, 0.7),
+    "chrX": (156_040_895, 0.25),
+    "chrY": (57_227_415, 0.05),
+}
+
+BASES = "ACGT"
+MEAN_DP = 30
+MISSING_RATE = 0.01
+MULTI_ALLELIC_RATE = 0.1
+INDEL_RATE = 0.15
+MEAN_BLOCK_SIZE = 500  # bases in a gVCF reference block
+
+
+@dataclass
+class DatasetSpec:
+    kind: Kind = "joint"
+    samples: int = 100  # per file for joint, number of (single-sample) files for gvcf
+    sites: int = 10_000  # variant sites (over all contigs)
+    files: int = 1  # number of joint files (ignored for gvcf)
+    seed: int = 0
+
+    @property
+    def name(self) -> str:
+        return f"{self.kind}_s{self.samples}_n{self.sites}_f{self.files}_seed{self.seed}"
+
+
+@dataclass
+class Site:
+    contig: str
+    pos: int
+    ref: str
+    alts: list[str]
+    afs: list[float]  # frequency of each alt allele
+
+
+def generate_dataset(spec: DatasetSpec, out_dir: Path) -> dict:
+    """Generate the input files of the dataset into out_dir (reused if already generated) and return the manifest.
+
+    The manifest (manifest.json) has the spec, the input files, number of records per file and contig and the
+    sex of all samples (also written as sex_map.tsv, usable with varpile count --sex-map).
+    """
+    manifest_path = out_dir / "manifest.json"
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest["spec"] == asdict(spec):
+            return manifest
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(spec.seed)
+    sites = generate_sites(rng, spec.sites)
+
+    files = []
+    sex_map = {}
+    n_files = spec.files if spec.kind == "joint" else spec.samples
+    samples_per_file = spec.samples if spec.kind == "joint" else 1
+    for i in range(n_files):
+        samples = [f"S{i}_{j}" for j in range(samples_per_file)]
+        sexes = {sample: rng.choice(["XX", "XY"]) for sample in samples}
+        sex_map |= sexes
+
+        vcf_path = out_dir / f"f{i}.vcf"
+        write = write_gvcf if spec.kind == "gvcf" else write_joint_vcf
+        records = write(vcf_path, sites, sexes, random.Random(rng.random()))
+        files.append({"path": str(to_bcf(vcf_path)), "records": records, "samples": len(samples)})
+
+    (out_dir / "sex_map.tsv").write_text("".join(f"{sample}\t{sex}\n" for sample, sex in sex_map.items()))
+    manifest = {"spec": asdict(spec), "files": files, "sex_map": sex_map}
+    manifest_path.write_text(json.dumps(manifest, indent=4))
+    return manifest
+
+
+def generate_sites(rng: random.Random, n_sites: int) -> list[Site]:
+    sites = []
+    for contig, (length, fraction) in CONTIGS.items():
+        n = max(1, round(n_sites * fraction))
+        # sites are dense (realistic spacing) at the beginning of the contig, sex chromosomes outside PAR1
+        begin = PAR1_END_1 + 1 if contig in ("chrX", "chrY") else 10_000
+        end = min(length - 100, begin + n * 300)
+        for pos in sorted(rng.sample(range(begin, end), n)):
+            n_alts = 2 if rng.random() < MULTI_ALLELIC_RATE else 1
+            ref = rng.choice(BASES)
+            alts = []
+            while len(alts) < n_alts:
+                alt = rng.choice([b for b in BASES if b != ref])
+                if rng.random() < INDEL_RATE:
+                    alt = ref + "".join(rng.choice(BASES) for _ in range(rng.randint(1, 5)))
+                if alt not in alts:
+                    alts.append(alt)
+            # allele frequency spectrum: log-uniform between 1e-4 and 0.5 (most variants are rare)
+            afs = [math.exp(rng.uniform(math.log(1e-4), math.log(0.5))) / n_alts for _ in alts]
+            sites.append(Site(contig, pos, ref, alts, afs))
+    return sites
+
+
+def is_haploid_region(contig: str, pos: int) -> bool:
+    """Regions where XY samples have a single copy."""
+    if contig == "chrX":
+        return PAR1_END_1 < pos < PAR2_X_BEGIN_1
+    return contig == "chrY" and in_non_par_Y(pos)
+
+
+def draw_genotype(rng: random.Random, site: Site, sex: str) -> tuple[int, ...] | None:
+    """Alleles of a sample at the site, None if missing or the sample has no copy of the contig."""
+    if site.contig == "chrY" and sex == "XX" or rng.random() < MISSING_RATE:
+        return None
+
+    def draw_allele() -> int:
+        u = rng.random()
+        for i, af in enumerate(site.afs, start=1):
+            if u < af:
+                return i
+            u -= af
+        return 0
+
+    if sex == "XY" and is_haploid_region(site.contig, site.pos):
+        allele = draw_allele()
+        return (allele,) if site.contig == "chrY" else (allele, allele)
+    return tuple(sorted((draw_allele(), draw_allele())))
+
+
+def draw_sample_fields(
+    rng: random.Random, gt: tuple[int, ...], n_alleles: int, mean_dp: float
+) -> tuple[int, int, list]:
+    """DP, GQ and AD of a called genotype."""
+    dp = poisson(rng, rng.gammavariate(4, mean_dp / 4))
+    ad = [0] * n_alleles
+    alleles = set(gt)
+    for _ in range(dp):
+        if rng.random() < 0.02:  # sequencing error
+            ad[rng.randrange(n_alleles)] += 1
+        else:
+            ad[rng.choice(gt)] += 1
+    quality = 3 * dp if len(alleles) == 1 else 2.5 * dp + rng.gauss(0, 5)
+    gq = int(min(99, max(0, quality)))
+    return dp, gq, ad
+
+
+def poisson(rng: random.Random, mean: float) -> int:
+    # Knuth for small means, normal approximation for large ones
+    if mean > 50:
+        return max(0, round(rng.gauss(mean, math.sqrt(mean))))
+    k, p, limit = 0, 1.0, math.exp(-mean)
+    while True:
+        p *= rng.random()
+        if p <= limit:
+            return k
+        k += 1
+
+
+def format_gt(gt: tuple[int, ...]) -> str:
+    return "/".join(map(str, gt))
+
+
+def write_header(f, samples: list[str], gvcf: bool) -> None:
+    f.write("##fileformat=VCFv4.2\n")
+    for contig, (length, _) in CONTIGS.items():
+        f.write(f"##contig=<ID={contig},length={length}>\n")
+    if gvcf:
+        f.write('##ALT=<ID=NON_REF,Description="Represents any possible alternative allele at this location">\n')
+        f.write('##INFO=<ID=END,Number=1,Type=Integer,Description="Stop position of the interval">\n')
+        f.write('##FORMAT=<ID=MIN_DP,Number=1,Type=Integer,Description="Minimum DP observed within the block">\n')
+    f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+    f.write('##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">\n')
+    f.write('##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">\n')
+    f.write('##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype quality">\n')
+    f.write("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", *samples]) + "\n")
+
+
+def write_joint_vcf(path: Path, sites: list[Site], sexes: dict[str, str], rng: random.Random) -> dict[str, int]:
+    """Write a multi-sample vcf with all sites, return the number of records per contig."""
+    mean_dps = [rng.uniform(0.5, 1.5) * MEAN_DP for _ in sexes]
+    records: dict[str, int] = {}
+    with open(path, "w") as f:
+        write_header(f, list(sexes), gvcf=False)
+        for site in sites:
+            columns = []
+            n_alleles = len(site.alts) + 1
+            for sex, mean_dp in zip(sexes.values(), mean_dps):
+                gt = draw_genotype(rng, site, sex)
+                if gt is None:
+                    columns.append("./.:.:.:.")
+                    continue
+                dp, gq, ad = draw_sample_fields(rng, gt, n_alleles, mean_dp)
+                columns.append(f"{format_gt(gt)}:{','.join(map(str, ad))}:{dp}:{gq}")
+            f.write(f"{site.contig}\t{site.pos}\t.\t{site.ref}\t{','.join(site.alts)}\t.\tPASS\t.\tGT:AD:DP:GQ\t")
+            f.write("\t".join(columns) + "\n")
+            records[site.contig] = records.get(site.contig, 0) + 1
+    return records
+
+
+def write_gvcf(path: Path, sites: list[Site], sexes: dict[str, str], rng: random.Random) -> dict[str, int]:
+    """Write a single-sample gVCF (variants of the sample and reference blocks), return records per contig."""
+    ((sample, sex),) = sexes.items()
+    mean_dp = rng.uniform(0.5, 1.5) * MEAN_DP
+    records: dict[str, int] = {}
+
+    with open(path, "w") as f:
+        write_header(f, [sample], gvcf=True)
+
+        def block(contig: str, begin: int, end: int) -> None:
+            # split the gap into blocks of random length
+            while begin <= end:
+                block_end = min(end, begin + int(rng.expovariate(1 / MEAN_BLOCK_SIZE)))
+                dp = poisson(rng, mean_dp)
+                min_dp = max(0, dp - rng.randint(0, 5))
+                gq = int(min(99, 3 * min_dp))
+                gt = "0" if sex == "XY" and contig == "chrY" else "0/0"
+                ref = rng.choice(BASES)
+                f.write(f"{contig}\t{begin}\t.\t{ref}\t<NON_REF>\t.\t.\tEND={block_end}\tGT:DP:GQ:MIN_DP\t")
+                f.write(f"{gt}:{dp}:{gq}:{min_dp}\n")
+                records[contig] = records.get(contig, 0) + 1
+                begin = block_end + 1
+
+        for contig in CONTIGS:
+            if contig == "chrY" and sex == "XX":
+                continue
+            previous_end = 0
+            for site in (s for s in sites if s.contig == contig):
+                gt = draw_genotype(rng, site, sex)
+                if gt is not None and not any(gt):
+                    continue  # hom ref, covered by a block
+
+                block(contig, previous_end + 1, site.pos - 1)
+                previous_end = site.pos
+                if gt is None:
+                    continue  # not covered, no block at the site
+
+                n_alleles = len(site.alts) + 2  # with <NON_REF>
+                dp, gq, ad = draw_sample_fields(rng, gt, n_alleles - 1, mean_dp)
+                alts = ",".join(site.alts + ["<NON_REF>"])
+                f.write(f"{contig}\t{site.pos}\t.\t{site.ref}\t{alts}\t.\t.\t.\tGT:AD:DP:GQ\t")
+                f.write(f"{format_gt(gt)}:{','.join(map(str, ad + [0]))}:{dp}:{gq}\n")
+                records[contig] = records.get(contig, 0) + 1
+                previous_end = site.pos + len(site.ref) - 1
+
+            last_site = max((s.pos for s in sites if s.contig == contig), default=previous_end)
+            block(contig, previous_end + 1, last_site + MEAN_BLOCK_SIZE)
+
+    return records
+
+
+def to_bcf(vcf_path: Path) -> Path:
+    """Convert the (text) vcf to an indexed bcf and remove the vcf."""
+    bcf_path = vcf_path.with_suffix(".bcf")
+    pysam.bcftools.view("-Ob", "-o", str(bcf_path), str(vcf_path), catch_stdout=False)
+    pysam.bcftools.index("--csi", "-f", str(bcf_path))
+    vcf_path.unlink()
+    return bcf_path
@@ -0,0 +1,190 @@
+"""
+Benchmarked stages of the pipeline.
+
+Every stage runs in a fresh (spawned) process, so the peak RSS of a stage is not inflated by the
+previous ones. A stage prepares its input (not measured) and measures only its own work with Timer.
+"""
+
+import json
+import multiprocessing
+import resource
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+import pyarrow.parquet as pq
+import pysam
+
+from varpile import actions
+from varpile.actions.finalize_action import finalize_region
+from varpile.allele_counts import merge_piles, process_chromosome
+from varpile.infer_sex import infer_samples_sex
+from varpile.utils import Region1
+
+FILTER_VALUES = {"min_DP": 10, "min_GQ": 20, "min_AB": 0.2}
+REGION = Region1.from_string("chr1")
+REGIONS = [Region1.from_string(contig) for contig in ("chr1", "chrX", "chrY")]
+
+
+class Timer:
+    """Wall and CPU time (of the process and its children) of a block."""
+
+    def __enter__(self) -> "Timer":
+        self._wall = time.perf_counter()
+        self._cpu = _cpu_time()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = _cpu_time() - self._cpu
+
+
+def _cpu_time() -> float:
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return sum(u.ru_utime + u.ru_stime for u in (self_usage, children_usage))
+
+
+def run_isolated(stage: Callable, *args) -> dict:
+    """Run the stage in a new process, return its metrics with the peak RSS (MB) of the process and its children."""
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_run_and_measure, stage, *args).result()
+
+
+def _run_and_measure(stage: Callable, *args) -> dict:
+    metrics = stage(*args)
+    peak_rss_kb = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    metrics["peak_rss_mb"] = peak_rss_kb / 1024
+    metrics["records_per_s"] = metrics["records"] / metrics["wall_s"] if metrics["wall_s"] else None
+    if "genotypes" in metrics:
+        metrics["genotypes_per_s"] = metrics["genotypes"] / metrics["wall_s"] if metrics["wall_s"] else None
+    return metrics
+
+
+def _metrics(timer: Timer, records: int, output: Path | None = None, **extra) -> dict:
+    return {
+        "wall_s": timer.wall,
+        "cpu_s": timer.cpu,
+        "records": records,
+        "output_bytes": None if output is None else dir_size(output),
+        **extra,
+    }
+
+
+def dir_size(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+def _records(manifest: dict, contigs: tuple[str, ...]) -> tuple[int, int]:
+    """Number of records and genotypes (records * samples) of the contigs in all files."""
+    records = genotypes = 0
+    for file in manifest["files"]:
+        n = sum(file["records"].get(contig, 0) for contig in contigs)
+        records += n
+        genotypes += n * file["samples"]
+    return records, genotypes
+
+
+def _sex_info(manifest: dict, path: str) -> dict:
+    with pysam.VariantFile(path) as vcf:
+        return {sample: manifest["sex_map"][sample] for sample in vcf.header.samples}
+
+
+def _write_piles(manifest: dict, region_dir: Path, engine: str) -> None:
+    for i, file in enumerate(manifest["files"]):
+        pile_dir = region_dir / f"f{i}"
+        pile_dir.mkdir(parents=True)
+        sex_info = _sex_info(manifest, file["path"])
+        process_chromosome(Path(file["path"]), REGION, sex_info, pile_dir, FILTER_VALUES, engine=engine)
+
+
+def stage_infer_sex(manifest: dict, work_dir: Path) -> dict:
+    with Timer() as timer:
+        for file in manifest["files"]:
+            infer_samples_sex(file["path"])
+    records, genotypes = _records(manifest, ("chrX",))
+    return _metrics(timer, records, genotypes=genotypes)
+
+
+def stage_process_chromosome(manifest: dict, work_dir: Path, engine: str) -> dict:
+    sex_infos = [_sex_info(manifest, file["path"]) for file in manifest["files"]]
+    with Timer() as timer:
+        for i, (file, sex_info) in enumerate(zip(manifest["files"], sex_infos)):
+            pile_dir = work_dir / f"f{i}"
+            pile_dir.mkdir(parents=True)
+            process_chromosome(Path(file["path"]), REGION, sex_info, pile_dir, FILTER_VALUES, engine=engine)
+    records, genotypes = _records(manifest, ("chr1",))
+    return _metrics(timer, records, work_dir, genotypes=genotypes)
+
+
+def stage_merge_piles(manifest: dict, work_dir: Path, engine: str) -> dict:
+    region_dir = work_dir / str(REGION)
+    _write_piles(manifest, region_dir, engine)
+    pile_rows = sum(pq.ParquetFile(path).metadata.num_rows for path in region_dir.glob("*/data.parquet"))
+    with Timer() as timer:
+        merge_piles(region_dir, aggregated=engine == "numpy")
+    return _metrics(timer, pile_rows, region_dir / "data.parquet")
+
+
+def stage_finalize_region(manifest: dict, work_dir: Path) -> dict:
+    counts_dir = work_dir / "counts"
+    region_dir = counts_dir / str(REGION)
+    _write_piles(manifest, region_dir, "numpy")
+    merge_piles(region_dir, aggregated=True)
+    n_xx = sum(sex == "XX" for sex in manifest["sex_map"].values())
+    info = {"sample_number": {"XX": n_xx, "XY": len(manifest["sex_map"]) - n_xx}, "AC0_filter": FILTER_VALUES}
+    (counts_dir / "info.json").write_text(json.dumps(info))
+
+    rows = pq.ParquetFile(region_dir / "data.parquet").metadata.num_rows
+    out_dir = work_dir / "result"
+    out_dir.mkdir()
+    with Timer() as timer:
+        finalize_region(counts_dir, REGION, out_dir)
+    return _metrics(timer, rows, out_dir)
+
+
+def stage_end_to_end(manifest: dict, work_dir: Path, engine: str, threads: int) -> dict:
+    """varpile count and finalize of all benchmarked contigs (sex from the generated sex map, see stage_infer_sex)."""
+    data_dir = Path(manifest["files"][0]["path"]).parent
+    opt = dict(
+        paths=[Path(file["path"]) for file in manifest["files"]],
+        output=work_dir / "counts",
+        regions=REGIONS,
+        threads=threads,
+        debug=False,
+        engine=engine,
+        sex_map=data_dir / "sex_map.tsv",
+        **FILTER_VALUES,
+    )
+    with Timer() as count_timer:
+        actions.count(opt)
+    with Timer() as finalize_timer:
+        actions.finalize(work_dir / "counts", work_dir / "result", threads)
+
+    timer = Timer()
+    timer.wall = count_timer.wall + finalize_timer.wall
+    timer.cpu = count_timer.cpu + finalize_timer.cpu
+    records, genotypes = _records(manifest, tuple(str(region) for region in REGIONS))
+    shutil.rmtree(work_dir / "counts", ignore_errors=True)
+    return _metrics(
+        timer,
+        records,
+        work_dir / "result",
+        genotypes=genotypes,
+        count_wall_s=count_timer.wall,
+        finalize_wall_s=finalize_timer.wall,
+        input_bytes=sum(Path(file["path"]).stat().st_size for file in manifest["files"]),
+    )
+
+
+STAGES = {
+    "infer_sex": stage_infer_sex,
+    "process_chromosome": stage_process_chromosome,
+    "merge_piles": stage_merge_piles,
+    "finalize_region": stage_finalize_region,
+    "end_to_end": stage_end_to_end,
+}
@@ -2,25 +2,49 @@ import logging
 import math
 from pathlib import Path
 import contextlib
-from typing import Iterator
+from collections import OrderedDict, defaultdict
+from typing import Final, Iterator
 
 import pysam
 
+from varpile.errors import VariantFileError
 from varpile.utils import Region1, is_test
 
 logger = logging.getLogger(__name__)
 
+# input file read from the standard input (e.g. `bcftools view ... | varpile count - ...`)
+STDIN: Final = Path("-")
+
+# records read on between two intervals before the next interval is fetched from the index (see fetch_intervals)
+MAX_SKIPPED_RECORDS = 64
+
+# files kept open by a worker process (see open_cached)
+MAX_OPEN_FILES = 16
+_open_files: OrderedDict[Path, "VariantFile"] = OrderedDict()
+
 
 class VariantFile(contextlib.AbstractContextManager):
 
-    def __init__(self, file_path: Path | str):
+    def __init__(self, file_path: Path | str, threads: int = 0):
+        """
+        Args:
+            threads: Number of extra htslib threads that decompress (BGZF) blocks ahead of the reading thread.
+        """
         self.file_path: Path = Path(file_path)
-        self._handle = pysam.VariantFile(file_path)
+        self.threads = threads
+        self._handle = pysam.VariantFile(file_path, threads=threads)
         self.header = self._handle.header
 
     def __exit__(self, exc_type, exc_value, traceback, /):
+        self.close()
+
+    def close(self) -> None:
         self._handle.close()
 
+    @property
+    def is_indexed(self) -> bool:
+        return self._handle.index is not None
+
     def fetch(self, region: Region1 | str) -> Iterator[pysam.VariantRecord]:
         """Return an iterator over the records."""
 
@@ -48,3 +72,124 @@ class VariantFile(contextlib.AbstractContextManager):
         # Otherwise try to fetch (this will fail if no index was detected
         # This is ok, we want things to fail, force the user to have an index
         return self._handle.fetch(*region.to_pysam_tuple())
+
+    def fetch_intervals(self, contig: str, intervals: list[tuple[int, int]]) -> Iterator[pysam.VariantRecord]:
+        """Return the records overlapping the (sorted, non-overlapping, 1-based) intervals of the contig, each once.
+
+        After an interval the file is read on up to the next interval, it is fetched from the index only if more
+        than MAX_SKIPPED_RECORDS records are in between (a fetch decompresses a whole BGZF block again).
+        """
+        if contig not in self.header.contigs:
+            logger.warning(f"Skiping, contig '{contig}' not found in the header")
+            return
+
+        records = None
+        record = None  # the next record of records
+        previous_end = 0  # 0-based end of the previous interval
+        for begin, end in intervals:
+            skipped = 0
+            while records is not None and record is not None and record.stop < begin:  # ends before the interval
+                skipped += 1
+                if skipped > MAX_SKIPPED_RECORDS:
+                    records = None
+                    break
+                record = next(records, None)
+
+            if records is None:
+                records = self.fetch(Region1(contig, begin, None))
+                record = next(records, None)
+                while record is not None and record.start < previous_end:  # returned for the previous intervals
+                    record = next(records, None)
+            if record is None:
+                return  # no more records in the contig
+
+            while record is not None and record.start < end:
+                if record.stop >= begin:
+                    yield record
+                record = next(records, None)
+            previous_end = end
+
+    def fetch_regions(self, regions: list[Region1]) -> Iterator[tuple[Region1, Iterator[pysam.VariantRecord]]]:
+        """Return the records of every region, reading the file once from start to end (no index needed).
+
+        Yields (region, records) in the order of the file, the records are the ones fetch returns for the region
+        and have to be consumed before the next region. A record overlapping several regions (e.g. a gVCF reference
+        block) is kept for the following regions of its contig. Regions of contigs without records come last.
+
+        Raises:
+            VariantFileError: If the records of a contig are not contiguous (the file is not sorted).
+        """
+        by_contig: dict[str, list[Region1]] = defaultdict(list)
+        for region in regions:
+            by_contig[region.contig].append(region)
+        for contig_regions in by_contig.values():
+            contig_regions.sort(key=lambda region: region.begin or 0)
+
+        # fetch starts from the first record (the file may have been read before), the standard input can't seek
+        records = iter(self._handle) if self.file_path == STDIN else self._handle.fetch()
+        record = next(records, None)
+        seen_contigs = set()
+        while record is not None and by_contig:
+            contig = record.contig
+            if contig in seen_contigs:
+                raise VariantFileError(f"'{self.file_path}' is not sorted, records of '{contig}' are not contiguous")
+            seen_contigs.add(contig)
+            contig_regions = by_contig.pop(contig, [])
+
+            carried = []  # records of the previous regions that overlap the following ones
+            for i, region in enumerate(contig_regions):
+                _, start, stop = region.to_pysam_tuple()
+                start, stop = start or 0, stop or math.inf
+                next_start = (contig_regions[i + 1].to_pysam_tuple()[1] or 0) if i + 1 < len(contig_regions) else None
+
+                def region_records(start: int, stop: float, next_start: int | None) -> Iterator[pysam.VariantRecord]:
+                    nonlocal record, carried
+                    previous, carried = carried, []
+                    for r in previous:
+                        if next_start is not None and r.stop > next_start:
+                            carried.append(r)
+                        if r.start < stop and r.stop > start:
+                            yield r
+                    while record is not None and record.contig == contig and record.start < stop:
+                        r, record = record, next(records, None)
+                        if next_start is not None and r.stop > next_start:
+                            carried.append(r)
+                        if r.stop > start:
+                            yield r
+
+                region_iter = region_records(start, stop, next_start)
+                yield region, region_iter
+                for _ in region_iter:  # the records the caller didn't consume
+                    pass
+
+            while record is not None and record.contig == contig:
+                record = next(records, None)
+
+        for contig_regions in by_contig.values():
+            for region in contig_regions:
+                yield region, iter([])
+
+
+def open_cached(file_path: Path | str, threads: int = 0) -> VariantFile:
+    """Return the open file, kept open for the next tasks of the (worker) process.
+
+    Opening a file parses its header and loads its index, tasks of the same file (other regions or shards) reuse
+    the open file. At most MAX_OPEN_FILES are kept open, the least recently used is closed.
+    The file is reused if it was opened with at least threads decompression threads, otherwise it is reopened
+    (except the standard input, it can only be read once).
+    Don't close the returned file (don't use it as a context manager).
+    """
+    key = Path(file_path)
+    vcf = _open_files.get(key)
+    if vcf is not None and (vcf.threads >= threads or key == STDIN):
+        _open_files.move_to_end(key)
+        return vcf
+    if vcf is not None:
+        del _open_files[key]
+        vcf.close()
+
+    vcf = _open_files[key] = VariantFile(file_path, threads=threads)
+    while len(_open_files) > MAX_OPEN_FILES:
+        _, least_recent = _open_files.popitem(last=False)
+        least_recent.close()
+    return vcf
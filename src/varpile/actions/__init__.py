@@ -1,3 +1,4 @@
 from .finalize_action import finalize
 from .count_action import count
 from .merge_action import merge
+from .query_action import query
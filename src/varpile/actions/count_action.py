@@ -1,16 +1,35 @@
+import hashlib
 import json
 import logging
+import math
 import shutil
+import uuid
 from collections import defaultdict
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import Executor, ProcessPoolExecutor
 from pathlib import Path
 from typing import TypedDict, Optional, Final, final
 
 from tqdm import tqdm
 
 import varpile
-from varpile.allele_counts import process_chromosome, merge_piles
+from varpile.VariantFile import STDIN, open_cached
+from varpile.allele_counts import (
+    Engine,
+    merge_memory_limit,
+    merge_piles,
+    process_batch,
+    process_chromosome,
+    process_file,
+)
+from varpile.coverage import is_gvcf
+from varpile.errors import DatasetError
+from varpile.index import find_index, region_sizes, split_region
 from varpile.infer_sex import infer_samples_sex, SamplesSex
+from varpile.markers import digest, is_done, run_and_mark
+from varpile.metrics import PROFILES_DIR, RunMetrics
+from varpile.scheduler import Scheduler, Task
+from varpile.sex_cache import CacheKeyMode, SexCache, file_key, read_sex_map, samples_from_map
+from varpile.targets import Intervals, group_intervals, read_bed
 from varpile.utils import Region1
 
 logger = logging.getLogger(__name__)
@@ -19,20 +38,42 @@ info = logger.info
 # default chromosomes to use (if regions are not specified)
 CHROMOSOMES: final = [f"chr{i}" for i in range(1, 23)] + ["chrX", "chrY", "chrM"]
 
+# Automatic sharding of regions (see number_of_shards)
+SHARDS_PER_THREAD: Final = 4
+MIN_SHARD_SIZE: Final = 64 * 2**20  # (uncompressed) bytes
+
+# Small (file, region) tasks are batched into one task per batch of files (see batch_files)
+MAX_BATCH_FILES: Final = 256  # files open at the same time in a batch task
+BATCH_PREFIX: Final = "_batch_"  # output directories of the batches in a region directory
+
+# Single pass mode: one task per file counts all regions (see process_file), the merges of all regions follow it
+SINGLE_PASS_GROUP: Final = "single_pass"
+SINGLE_PASS_DIR: Final = ".files"  # completion markers of the file tasks (in the output directory)
+
+# htslib threads decompressing the input file of a task (more don't help, the Python loop is the bottleneck)
+MAX_DECOMPRESSION_THREADS: Final = 3
+
+MERGE_TEMP_DIR: Final = ".tmp"  # in the output directory, hidden so it is not mistaken for a region directory
+
+# Part of the beginning and the end of an input file hashed into its fingerprint (see input_fingerprint)
+FINGERPRINT_CHUNK: Final = 64 * 2**10
+
 # We only support indexed vcf so only gziped vcf or bcf file should be supported
 SUPPORTED_EXTENSIONS: Final = [".vcf.gz", ".vcf.bgz", ".bcf"]
+# a single pass (see process_file) doesn't need the index, uncompressed vcf files are read as well
+SINGLE_PASS_EXTENSIONS: Final = SUPPORTED_EXTENSIONS + [".vcf"]
 
 
-def is_vcf(path: Path) -> bool:
-    return any(path.name.endswith(ext) for ext in SUPPORTED_EXTENSIONS)
+def is_vcf(path: Path, extensions: list[str] = SUPPORTED_EXTENSIONS) -> bool:
+    return any(path.name.endswith(ext) for ext in extensions)
 
 
-def find_input_files(paths: list[Path]) -> list[Path]:
+def find_input_files(paths: list[Path], extensions: list[str] = SUPPORTED_EXTENSIONS) -> list[Path]:
     """Find and return a list of VCF (Variant Call Format) input files."""
     input_files = []
     for path in paths:
         if path.is_dir():
-            input_files.extend(file for file in path.iterdir() if is_vcf(file))
+            input_files.extend(file for file in path.iterdir() if is_vcf(file, extensions))
         else:
             input_files.append(path)
 
@@ -48,9 +89,12 @@ def get_vcf_file_name(input_file: Path | str) -> str:
 
     Returns: The base file name without the recognized VCF-related extensions.
     """
+    if Path(input_file) == STDIN:
+        return "stdin"
+
     name = Path(input_file).name
 
-    for ext in SUPPORTED_EXTENSIONS:
+    for ext in SINGLE_PASS_EXTENSIONS:
         if name.endswith(ext):
             return name.removesuffix(ext)
 
@@ -59,14 +103,59 @@ def get_vcf_file_name(input_file: Path | str) -> str:
     return name
 
 
+def input_fingerprint(input_file: Path) -> str | None:
+    """Return a fingerprint of the content of the input file (None for the standard input).
+
+    The size, the first and last FINGERPRINT_CHUNK bytes of the file and its index are hashed, so the fingerprint
+    doesn't depend on the path or modification time (a copy of the file has the same fingerprint).
+    """
+    if input_file == STDIN:
+        return None
+    h = hashlib.sha256()
+    size = input_file.stat().st_size
+    h.update(str(size).encode())
+    with open(input_file, "rb") as f:
+        h.update(f.read(FINGERPRINT_CHUNK))
+        f.seek(max(size - FINGERPRINT_CHUNK, 0))
+        h.update(f.read())
+    index_path = find_index(input_file)
+    if index_path is not None:
+        h.update(index_path.read_bytes())
+    return h.hexdigest()
+
+
 class IOptions(TypedDict):
     """Interface for Arguments."""
 
     paths: list[Path]
     output: Path
+    name: Optional[str]
     regions: Optional[list]
+    regions_file: Optional[Path]
     threads: int
     debug: bool
+    resume: bool
+    pre_aggregate: bool
+    engine: Engine
+    shards: Optional[int]
+    single_pass: bool
+    max_batch_files: Optional[int]
+    decompression_threads: Optional[int]
+    metrics: bool
+    profile: Optional[int]
+
+    # merge of the piles of a region
+    merge_threads: Optional[int]
+    merge_memory: Optional[str]
+    merge_temp_dir: Optional[Path]
+    streaming_merge: bool
+
+    # sex inference
+    sex_confidence: Optional[float]
+    sex_windows: Optional[int]
+    sex_map: Optional[Path]
+    sex_cache: Optional[Path]  # no cache if None
+    sex_cache_key: CacheKeyMode
 
     # filtering
     min_DP: int
@@ -74,22 +163,302 @@ class IOptions(TypedDict):
     min_AB: float
 
 
+def infer_file_sex(
+    input_file: Path, confidence: float | None = None, windows: int | None = None, threads: int = 0
+) -> tuple[SamplesSex, bool]:
+    """Infer the sex of the samples of the file (see infer_samples_sex), also return whether it is a gVCF file."""
+    return infer_samples_sex(input_file, confidence, windows, threads), file_is_gvcf(input_file, threads)
+
+
+def file_is_gvcf(input_file: Path, threads: int = 0) -> bool:
+    """Return True if the input file is a gVCF file (read from the header of the file open in the worker)."""
+    return is_gvcf(open_cached(input_file, threads).header)
+
+
+def infer_input_files_sex(
+    executor: Executor,
+    input_files: list[Path],
+    opt: IOptions,
+    run_metrics: RunMetrics | None = None,
+    decompression_threads: int = 0,
+) -> tuple[dict[Path, SamplesSex], set[Path]]:
+    """Return the sex of the samples of every input file and the gVCF input files.
+
+    The sex is taken from the sex map (if all samples of the file are in it) or the sex cache,
+    inference jobs are submitted only for the remaining files (and their results are cached).
+    The standard input is read only once (by the count), all of its samples have to be in the sex map.
+    Whether a file is a gVCF file is returned by its inference job (and cached), or read by a job in the pool
+    for the files whose sex is known (the parent doesn't open all input files).
+    The jobs run in the pool with the decompression threads of the count tasks (see split_threads).
+    Which worker runs a job isn't controlled, a count task reuses the open file only if it runs in the same worker.
+
+    Raises:
+        DatasetError: If a sample of the standard input is not in the sex map.
+    """
+    run_metrics = run_metrics or RunMetrics(enabled=False)
+    sex_options = {"confidence": opt.get("sex_confidence"), "windows": opt.get("sex_windows")}
+    job_options = sex_options | {"threads": decompression_threads}
+    sex_map = read_sex_map(opt["sex_map"]) if opt.get("sex_map") else {}
+    sex_cache = None
+    if opt.get("sex_cache"):
+        sex_cache = SexCache(opt["sex_cache"], opt.get("sex_cache_key", "stat"), **sex_options)
+
+    known: dict[Path, SamplesSex] = {}
+    gvcf: dict[Path, bool] = {}
+    for input_file in input_files:
+        if input_file == STDIN:
+            header = open_cached(STDIN).header
+            samples = list(header.samples)
+            missing = [sample for sample in samples if sample not in sex_map]
+            if missing:
+                raise DatasetError(
+                    f"Sex of the samples of the standard input can't be inferred, {missing} not in --sex-map"
+                )
+            known[input_file] = {sample: sex_map[sample] for sample in samples}
+            gvcf[input_file] = is_gvcf(header)
+            continue
+
+        samples_sex = samples_from_map(input_file, sex_map) if sex_map else None
+        if samples_sex is None and sex_cache is not None:
+            samples_sex = sex_cache.get(input_file)
+            cached_gvcf = sex_cache.is_gvcf(input_file)
+            if samples_sex is not None and cached_gvcf is not None:
+                gvcf[input_file] = cached_gvcf
+        if samples_sex is not None:
+            known[input_file] = samples_sex
+
+    info(f"Sex of {len(known)} input files is known (sex map or cache), infer the rest")
+    futures = {
+        run_metrics.submit(executor, infer_file_sex, input_file, labels={"file": str(input_file)}, **job_options): (
+            input_file
+        )
+        for input_file in input_files
+        if input_file not in known
+    }
+    gvcf_futures = {
+        run_metrics.submit(
+            executor, file_is_gvcf, input_file, labels={"file": str(input_file)}, threads=decompression_threads
+        ): input_file
+        for input_file in input_files
+        if input_file in known and input_file not in gvcf
+    }
+    for future in tqdm(futures, desc="Inferring sex"):
+        input_file = futures[future]
+        samples_sex, gvcf[input_file] = run_metrics.result(future.result())
+        # samples present in the sex map take precedence over inferred ones
+        known[input_file] = samples_sex | {s: sex_map[s] for s in samples_sex if s in sex_map}
+        if sex_cache is not None:
+            sex_cache.set(input_file, samples_sex, gvcf[input_file])
+    for future, input_file in gvcf_futures.items():
+        gvcf[input_file] = run_metrics.result(future.result())
+
+    if sex_cache is not None:
+        sex_cache.save()
+
+    return {input_file: known[input_file] for input_file in input_files}, {
+        input_file for input_file in input_files if gvcf[input_file]
+    }
+
+
+def number_of_shards(size: int, total_size: int, threads: int, shards: Optional[int] = None) -> int:
+    """Number of shards to split a (file, region) task into.
+
+    Args:
+        size: Estimated size of the region in the file.
+        total_size: Estimated size of all (file, region) tasks.
+        threads: Number of threads.
+        shards: Explicit number of shards (from the command line), computed if None.
+    """
+    if shards is not None:
+        return max(shards, 1)
+    if threads == 1:
+        return 1
+
+    # aim for SHARDS_PER_THREAD tasks per thread, but don't make shards smaller than MIN_SHARD_SIZE
+    shard_size = max(MIN_SHARD_SIZE, total_size / (SHARDS_PER_THREAD * threads))
+    return max(1, math.ceil(size / shard_size))
+
+
+def targets_sizes(input_file: Path, targets: dict[str, Intervals]) -> dict[Region1, int]:
+    """Approximate size of the targets of every contig in the vcf file (see region_sizes).
+
+    The size of the span of the targets of a contig (first to last target) is scaled by the fraction of the
+    bases of the span that are in the targets.
+    """
+    spans = [Region1(contig, intervals[0][0], intervals[-1][1]) for contig, intervals in targets.items()]
+    sizes = region_sizes(input_file, spans)
+    return {
+        Region1(span.contig, None, None): round(
+            sizes[span] * sum(end - begin + 1 for begin, end in targets[span.contig]) / (span.end - span.begin + 1)
+        )
+        for span in spans
+    }
+
+
+def batch_files(
+    files: list[Path], sizes: list[int], total_size: int, threads: int, max_files: int = MAX_BATCH_FILES
+) -> list[list[Path]]:
+    """Group the small files of a region into batches processed by a single task (see process_batch).
+
+    A batch is at most a shard (MIN_SHARD_SIZE) but small enough to keep SHARDS_PER_THREAD tasks per thread.
+    Files of half this size or more are not batched (a batch with a single file), without an index (total_size
+    is 0) no file is batched.
+
+    Args:
+        files: Input files.
+        sizes: Estimated size of the region in each file.
+        total_size: Estimated size of all (file, region) tasks.
+        threads: Number of threads.
+        max_files: Maximum number of files of a batch (1 disables the batching).
+    """
+    max_size = min(MIN_SHARD_SIZE, total_size / (SHARDS_PER_THREAD * threads))
+    batches, batch, batch_size = [], [], 0
+    for file, size in zip(files, sizes):
+        if size >= max_size / 2:
+            batches.append([file])
+            continue
+        if batch and (batch_size + size > max_size or len(batch) == max_files):
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append(file)
+        batch_size += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def split_threads(threads: int, n_tasks: int, decompression_threads: Optional[int] = None) -> tuple[int, int]:
+    """Split the threads between the tasks running at the same time and the decompression threads of each task.
+
+    When there are fewer (file, shard) tasks than threads, the idle cores decompress (BGZF) the input files
+    ahead of the Python loop of the tasks instead.
+
+    Args:
+        threads: Number of threads.
+        n_tasks: Number of (file, shard) tasks.
+        decompression_threads: Explicit number of decompression threads per task (from the command line).
+
+    Returns:
+        Number of tasks running at the same time and the number of (extra) decompression threads of a task.
+    """
+    if decompression_threads is not None:
+        return max(1, min(threads // (decompression_threads + 1), n_tasks)), decompression_threads
+    workers = max(1, min(threads, n_tasks))
+    return workers, min((threads - workers) // workers, MAX_DECOMPRESSION_THREADS)
+
+
+def check_resume(output: Path, AC0_filter: dict, input_list: list[str]) -> dict | None:
+    """Return info.json of the count run to resume (None if there is nothing to resume).
+
+    Raises:
+        DatasetError: If the run was started with different filters or input files.
+    """
+    info_path = output / "info.json"
+    if not info_path.exists():
+        return None
+
+    previous = json.loads(info_path.read_text())
+    if previous.get("AC0_filter") != AC0_filter:
+        raise DatasetError(f"Can't resume '{output}', filters changed: {previous.get('AC0_filter')} != {AC0_filter}")
+    if previous.get("input_files") != input_list:
+        raise DatasetError(f"Can't resume '{output}', the input files changed")
+    return previous
+
+
+def remove_stale_piles(dir_path: Path, task_dirs: list[Path]) -> None:
+    """Remove the files of a previous run in dir_path that don't belong to the tasks (e.g. other shards).
+
+    Args:
+        dir_path: Directory of an input file in a region (or of a task).
+        task_dirs: Output directories of the tasks, dir_path itself (not sharded) or its subdirectories (shards).
+    """
+    if not dir_path.is_dir():
+        return
+    for path in dir_path.iterdir():
+        if path.is_dir() and path not in task_dirs:
+            shutil.rmtree(path)
+        elif path.is_file() and dir_path not in task_dirs:
+            path.unlink()
+
+
 def count(opt: IOptions) -> None:
 
-    input_files: list[Path] = find_input_files(opt["paths"])
+    # the standard input can only be read in a single pass
+    single_pass = opt.get("single_pass", False) or STDIN in opt["paths"]
+    input_files: list[Path] = find_input_files(
+        opt["paths"], SINGLE_PASS_EXTENSIONS if single_pass else SUPPORTED_EXTENSIONS
+    )
     output: Path = opt["output"]
     threads = opt["threads"]
     regions = opt["regions"] or [Region1.from_string(x) for x in CHROMOSOMES]
+    # target intervals (e.g. of an exome) are counted into one region per contig, see varpile.targets
+    targets = read_bed(opt["regions_file"]) if opt.get("regions_file") else None
+    if targets is not None:
+        regions = [Region1(contig, None, None) for contig in targets]
+        info(f"{sum(len(intervals) for intervals in targets.values())} target intervals on {len(regions)} contigs")
     debug = opt["debug"]
+    engine = opt.get("engine", "python")
+    pre_aggregate = opt.get("pre_aggregate", False) or engine == "numpy"  # numpy engine writes aggregated piles
 
     AC0_filter = {"min_DP": opt["min_DP"], "min_GQ": opt["min_GQ"], "min_AB": opt["min_AB"]}
+    input_list = [str(input_file if input_file == STDIN else input_file.resolve()) for input_file in input_files]
+
+    # With --resume finished (file, region) tasks and regions are kept, see varpile.markers
+    previous_info = check_resume(output, AC0_filter, input_list) if opt.get("resume") else None
+    if previous_info is not None:
+        info(f"Resuming count in '{output}'")
+
+    # per task metrics written to metrics.json, see varpile.metrics
+    run_metrics = RunMetrics(opt.get("metrics", False), output / PROFILES_DIR, opt.get("profile") or 0)
+
+    info(f"Processing chromosomes/regions:")
+    file_keys = {input_file: str(STDIN) if input_file == STDIN else file_key(input_file) for input_file in input_files}
+    if single_pass:
+        # every file is read once from start to end by one task (see process_file), no index is needed
+        info("Single pass: every input file is counted by one task")
+        batches = {region: [[input_file] for input_file in input_files] for region in regions}
+        n_tasks = len(input_files)
+    else:
+        # All (file, region) tasks are scheduled at once, largest first (estimated from the index),
+        # the piles of a region are merged as soon as the last pile of the region is written.
+        # Large regions are split into shards (processed in parallel) so that all threads are used
+        # even when there are only a few input files.
+        sizes = {
+            input_file: region_sizes(input_file, regions) if targets is None else targets_sizes(input_file, targets)
+            for input_file in input_files
+        }
+        total_size = sum(size for file_sizes in sizes.values() for size in file_sizes.values())
+        # small files of a region are counted by a single task into one (aggregated) pile
+        batches = {
+            region: batch_files(
+                input_files,
+                [sizes[input_file][region] for input_file in input_files],
+                total_size,
+                threads,
+                opt.get("max_batch_files") or MAX_BATCH_FILES,
+            )
+            for region in regions
+        }
+        if any(len(batch) > 1 for region_batches in batches.values() for batch in region_batches):
+            info("Small input files are batched, all piles are pre-aggregated")
+            pre_aggregate = True  # the piles of a region are merged together
+        n_tasks = sum(
+            (1 if len(batch) > 1 else number_of_shards(sizes[batch[0]][region], total_size, threads, opt.get("shards")))
+            for region, region_batches in batches.items()
+            for batch in region_batches
+            if len(batch) > 1 or sizes[batch[0]][region] > 0 or total_size == 0  # sizes are 0 without an index
+        )
+    workers, decompression_threads = split_threads(threads, n_tasks, opt.get("decompression_threads"))
+    info(f"{workers} tasks at a time, each with {decompression_threads} decompression threads")
 
-    with ProcessPoolExecutor(threads) as executor:
+    # a process per task in flight, so the worker that finished a task gets the next one (see varpile.scheduler)
+    with ProcessPoolExecutor(workers) as executor:
 
         info(f"Infer sex of input files")
-        futures = {executor.submit(infer_samples_sex, input_file): input_file for input_file in input_files}
-        vcf_sex_info: dict[Path, SamplesSex]
-        vcf_sex_info = {futures[future]: future.result() for future in tqdm(futures, desc="Inferring sex")}
+        with run_metrics.phase("sex_inference"):
+            vcf_sex_info, gvcf_files = infer_input_files_sex(
+                executor, input_files, opt, run_metrics, decompression_threads
+            )
 
         sample_number = defaultdict(int)  # number of XX, and XY samples
         for sex_info in vcf_sex_info.values():
@@ -98,14 +467,35 @@ def count(opt: IOptions) -> None:
 
         info(f"Identified {sample_number["XX"]} XX and {sample_number["XY"]} XY sample")
 
-        # Clean output directory (in case it already exists so we can cleanly overwrite data)
-        if output.exists():
-            if output.is_dir():
-                shutil.rmtree(output)
-            else:
-                output.unlink()
-
-        output.mkdir()  # create the Output directory
+        # samples of gVCF files are counted in AN only where they are covered (see varpile.coverage)
+        gvcf_sample_number = defaultdict(int)
+        for input_file in gvcf_files:
+            for sex in vcf_sex_info[input_file].values():
+                gvcf_sample_number[sex] += 1
+
+        if previous_info is None:
+            # Clean output directory (in case it already exists so we can cleanly overwrite data)
+            if output.exists():
+                if output.is_dir():
+                    shutil.rmtree(output)
+                else:
+                    output.unlink()
+
+            output.mkdir()  # create the Output directory
+
+        # provenance, used by merge to detect a dataset (or input file) that is included twice, the version
+        # identifies the content of the input files (a resumed run is the same dataset), the name is only a label
+        fingerprints = [input_fingerprint(input_file) for input_file in input_files]
+        datasets = [
+            {
+                "name": opt.get("name") or output.name,
+                "id": uuid.uuid4().hex,
+                "version": digest(fingerprints),
+                "input_files": [fingerprint for fingerprint in fingerprints if fingerprint is not None],
+            }
+        ]
+        if previous_info is not None:
+            datasets = previous_info["datasets"]
 
         output_info = output / "info.json"
         output_info.write_text(
@@ -113,42 +503,205 @@ def count(opt: IOptions) -> None:
                 {
                     "version": varpile.__VERSION__,
                     "sample_number": sample_number,
+                    "gvcf_sample_number": gvcf_sample_number,  # used by merge (see varpile.coverage)
                     "AC0_filter": AC0_filter,
+                    "datasets": datasets,
+                    "input_files": input_list,
                 },
                 indent=4,
             )
         )
 
-        info(f"Processing chromosomes/regions:")
+        # a merge runs in a worker next to the other tasks (at most one merge per worker), by default the threads
+        # and the memory are split between the workers so that merges and tasks together stay within -@
+        merge_options = dict(
+            threads=opt.get("merge_threads") or max(1, threads // workers),
+            memory_limit=opt.get("merge_memory") or merge_memory_limit(workers),
+            temp_directory=opt.get("merge_temp_dir") or output / MERGE_TEMP_DIR,
+            streaming=opt.get("streaming_merge", False),
+        )
+
+        scheduler = Scheduler(executor, max_in_flight=workers)
+        n_done = 0
+        pending_regions = []  # regions that are not merged yet
         for region in regions:
             region_dir = output / str(region)
-            futures = []
-            for input_file in input_files:
+            region_tasks: list[tuple[Path, str, Task]] = []  # (output directory, digest, task)
+            task_dirs: dict[Path, list[Path]] = {}  # file output directory -> output directories of its tasks
+            for batch_index, batch in enumerate(batches[region]):
+                if len(batch) > 1:
+                    batch_output = region_dir / f"{BATCH_PREFIX}{batch_index}"
+                    task_dirs[batch_output] = [batch_output]
+                    sex_infos = [vcf_sex_info[input_file] for input_file in batch]
+                    intervals = targets[region.contig] if targets is not None else None
+                    args = (batch, region, sex_infos, batch_output, AC0_filter)
+                    kwargs = dict(engine=engine, decompression_threads=decompression_threads, intervals=intervals)
+                    task_digest = digest(
+                        varpile.__VERSION__,
+                        [file_keys[input_file] for input_file in batch],
+                        str(region),
+                        intervals,
+                        sex_infos,
+                        AC0_filter,
+                        engine,
+                    )
+                    task = Task(
+                        run_and_mark,
+                        (batch_output, task_digest, process_batch, *args),
+                        kwargs,
+                        cost=sum(sizes[input_file][region] for input_file in batch),
+                        group=region,
+                    )
+                    task = run_metrics.task(task, files=len(batch), region=str(region))
+                    region_tasks.append((batch_output, task_digest, task))
+                    continue
 
+                input_file = batch[0]
                 # infer sex for each sample in the vcf.
                 sex_info = vcf_sex_info[input_file]
 
                 # determine the output directory
                 file_name: str = get_vcf_file_name(input_file)
                 file_output = region_dir / file_name
-                file_output.mkdir(parents=True, exist_ok=True)
-
-                # Submit the task to the process pool
-                futures.append(
-                    executor.submit(
-                        process_chromosome,
-                        input_file,
-                        region,
+                if single_pass:
+                    task_dirs[file_output] = [file_output]  # written by the task of the file (see below)
+                    continue
+
+                size = sizes[input_file][region]
+                n_shards = number_of_shards(size, total_size, threads, opt.get("shards"))
+                if targets is None:
+                    shards = split_region(input_file, region, n_shards)
+                    shards_intervals = [None] * len(shards)
+                else:
+                    # groups of consecutive targets, a shard is the span of its targets
+                    shards_intervals = group_intervals(targets[region.contig], n_shards)
+                    shards = [Region1(region.contig, group[0][0], group[-1][1]) for group in shards_intervals]
+                shard_outputs = [
+                    file_output if len(shards) == 1 else file_output / f"shard_{i}" for i in range(len(shards))
+                ]
+                task_dirs[file_output] = shard_outputs
+
+                for shard, intervals, shard_output in zip(shards, shards_intervals, shard_outputs):
+                    args = (input_file, shard, sex_info, shard_output, AC0_filter)
+                    kwargs = dict(
+                        aggregate=pre_aggregate,
+                        debug=debug,
+                        engine=engine,
+                        decompression_threads=decompression_threads,
+                        intervals=intervals,
+                    )
+                    task_digest = digest(
+                        varpile.__VERSION__,
+                        file_keys[input_file],
+                        str(shard),
+                        intervals,
                         sex_info,
-                        file_output,
                         AC0_filter,
-                        debug=debug,
+                        pre_aggregate,
+                        engine,
                     )
+                    task = Task(
+                        run_and_mark,
+                        (shard_output, task_digest, process_chromosome, *args),
+                        kwargs,
+                        cost=size / len(shards),
+                        group=region,
+                        affinity=input_file,  # the worker keeps the file open (see Scheduler)
+                    )
+                    task = run_metrics.task(task, file=str(input_file), region=str(shard))
+                    region_tasks.append((shard_output, task_digest, task))
+
+            merge_kwargs = dict(
+                aggregated=pre_aggregate,
+                debug=debug,
+                gvcf_sample_number=dict(gvcf_sample_number),
+                **merge_options,
+            )
+            # the merged region doesn't depend on how the region was sharded (the number of threads can change)
+            merge_digest = digest(
+                varpile.__VERSION__,
+                [(file_keys[input_file], vcf_sex_info[input_file]) for input_file in input_files],
+                str(region),
+                targets[region.contig] if targets is not None else None,
+                AC0_filter,
+                gvcf_sample_number,
+            )
+            if is_done(region_dir, merge_digest):
+                n_done += 1
+                continue
+            pending_regions.append(region)
+
+            remove_stale_piles(region_dir, list(task_dirs))  # e.g. files batched differently
+            for file_output, shard_outputs in task_dirs.items():
+                remove_stale_piles(file_output, shard_outputs)
+
+            for shard_output, task_digest, task in region_tasks:
+                if not is_done(shard_output, task_digest):
+                    remove_stale_piles(shard_output, [])  # files of an unfinished task
+                    shard_output.mkdir(parents=True, exist_ok=True)
+                    scheduler.add(task)
+
+            merge_task = Task(run_and_mark, (region_dir, merge_digest, merge_piles, region_dir), merge_kwargs)
+            merge_task = run_metrics.task(merge_task, region=str(region))
+            scheduler.add_follow_up(SINGLE_PASS_GROUP if single_pass else region, merge_task)
+
+        main_tasks: list[Task] = []  # tasks that read the standard input, it can't be read by the workers
+        if single_pass and pending_regions:
+            for input_file in input_files:
+                sex_info = vcf_sex_info[input_file]
+                file_name = get_vcf_file_name(input_file)
+                marker_dir = output / SINGLE_PASS_DIR / file_name
+                # the task counts the regions that are not merged yet, but its piles are the same for all regions
+                task_digest = digest(
+                    varpile.__VERSION__,
+                    file_keys[input_file],
+                    [str(region) for region in regions],
+                    targets,
+                    sex_info,
+                    AC0_filter,
+                    pre_aggregate,
+                    engine,
                 )
-
-            # Wait for all tasks to be completed
-            for future in tqdm(futures, desc=str(region)):
-                future.result()
-
-            info(f"Merging files for {region}")
-            merge_piles(region_dir, debug=debug)
+                if is_done(marker_dir, task_digest):
+                    continue
+
+                file_outputs = [output / str(region) / file_name for region in pending_regions]
+                for file_output in file_outputs:
+                    remove_stale_piles(file_output, [])  # files of an unfinished task
+                    file_output.mkdir(parents=True, exist_ok=True)
+                marker_dir.mkdir(parents=True, exist_ok=True)
+
+                args = (input_file, pending_regions, sex_info, file_outputs, AC0_filter)
+                kwargs = dict(
+                    aggregate=pre_aggregate,
+                    debug=debug,
+                    engine=engine,
+                    decompression_threads=0 if input_file == STDIN else decompression_threads,
+                    targets=targets,
+                )
+                task = Task(
+                    run_and_mark,
+                    (marker_dir, task_digest, process_file, *args),
+                    kwargs,
+                    cost=0 if input_file == STDIN else input_file.stat().st_size,
+                    group=None if input_file == STDIN else SINGLE_PASS_GROUP,
+                )
+                task = run_metrics.task(task, file=str(input_file))
+                if input_file == STDIN:
+                    main_tasks.append(task)
+                else:
+                    scheduler.add(task)
+
+        if n_done:
+            info(f"{n_done} regions are already counted")
+        with run_metrics.phase("counting"):
+            for task in main_tasks:
+                info("Counting the standard input")
+                run_metrics.result(task.fn(*task.args, **task.kwargs))
+            for _, result in scheduler.run(desc="Counting"):
+                run_metrics.result(result)
+
+        shutil.rmtree(output / MERGE_TEMP_DIR, ignore_errors=True)
+        shutil.rmtree(output / SINGLE_PASS_DIR, ignore_errors=True)  # all regions are merged
+
+    run_metrics.write(output)
@@ -2,79 +2,160 @@ import json
 import shutil
 from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Literal
 
 import duckdb
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
+from varpile.actions.merge_action import finish_merge
+from varpile.allele_counts import connect, merge_memory_limit
 from varpile.infer_sex import PAR1_END_1, PAR2_X_BEGIN_1
+from varpile.query import BINNED_RESULT_NAME, RESULT_NAME, write_index
 from varpile.utils import Region1
+from varpile.variant_key import ALLELES_NAME, decoded_sql
 
+# Results are sorted by position, the min/max statistics of pos let readers skip the row groups outside of a
+# queried range (e.g. `where pos between ...`), so a row group is the unit read by a query (duckdb default).
+RESULT_ROW_GROUP_SIZE = 122_880
 
-def finalize(in_path: Path, out_path: Path, threads: int):
+# Sorted results of binned regions and the data spilled by duckdb, removed when the dataset is finalized
+TEMP_DIR = ".tmp"
+
+# duckdb: the regions one after the other with all threads, process: a single-threaded process per region
+FinalizeEngine = Literal["duckdb", "process"]
+
+
+def finalize(
+    in_path: Path, out_path: Path, threads: int, bin_size: int | None = None, engine: FinalizeEngine = "duckdb"
+):
 
     if out_path.exists():
         shutil.rmtree(out_path)
 
+    finish_merge(in_path)  # an interrupted merge into the dataset
     out_path.mkdir(exist_ok=True)
     info_path = in_path / "info.json"
     shutil.copyfile(info_path, out_path / "info.json")
 
     # Get a list of all directories under in_path
-    directories = [path for path in in_path.iterdir() if path.is_dir()]
+    directories = [path for path in in_path.iterdir() if path.is_dir() and not path.name.startswith(".")]
     regions = [Region1.from_string(x.name) for x in directories]
-
-    # Process the directories in parallel using ProcessPoolExecutor
-    with ProcessPoolExecutor(threads) as executor:
-        futures = [executor.submit(finalize_region, in_path, region, out_path) for region in regions]
-        for future in tqdm(futures, desc="Finalizing dataset"):
-            future.result()
-
-
-def finalize_region(in_dir: Path, region: Region1, out_dir: Path):
+    if not regions:
+        return
+
+    try:
+        if engine == "duckdb":
+            finalize_regions(in_path, regions, out_path, threads, bin_size)
+            return
+
+        # Process the directories in parallel using ProcessPoolExecutor
+        with ProcessPoolExecutor(threads) as executor:
+            futures = [
+                executor.submit(finalize_region, in_path, region, out_path, bin_size, merge_memory_limit(threads))
+                for region in regions
+            ]
+            for future in tqdm(futures, desc="Finalizing dataset"):
+                future.result()
+    finally:
+        shutil.rmtree(out_path / TEMP_DIR, ignore_errors=True)
+
+
+def finalize_regions(in_dir: Path, regions: list[Region1], out_dir: Path, threads: int, bin_size: int | None = None):
+    """Finalize the regions one after the other, each with a duckdb query using all threads.
+
+    Each query reads only the files of its region. The memory of the connection is limited, larger sorts spill
+    to out_dir/.tmp. See finalize_region for the output.
+    """
+    with connect(threads, merge_memory_limit(1), out_dir / TEMP_DIR) as con:
+        for region in tqdm(regions, desc="Finalizing dataset"):
+            rel = con.sql(results_sql(in_dir, region))
+            write_result(con, rel, out_dir / str(region), bin_size)
+
+
+def finalize_region(
+    in_dir: Path, region: Region1, out_dir: Path, bin_size: int | None = None, memory_limit: str | None = None
+):
+    """Write the result of the region sorted by position (pos, ref, alt).
+
+    The result is out_dir/<region>/result.parquet, or if bin_size is given, one file per bin of positions
+    out_dir/<region>/result/bin=<pos // bin_size>/ (hive partitioning, read with `hive_partitioning = true`).
+    """
+    with connect(1, memory_limit, out_dir / TEMP_DIR) as con:
+        rel = con.sql(results_sql(in_dir, region))
+        write_result(con, rel, out_dir / str(region), bin_size)
+
+
+def results_sql(in_dir: Path, region: Region1) -> str:
+    """SQL query of the results (AN, DP_mean and DP_std) of the variants of the region."""
     # get info from info.json
     info = json.loads((in_dir / "info.json").read_text())
     XX_sample_number = info["sample_number"]["XX"]
     XY_sample_number = info["sample_number"]["XY"]
 
-    path: Path = in_dir / str(region) / "data.parquet"
-    out_path: Path = out_dir / str(region) / "result.parquet"
-    contig = region.contig
-
-    con = duckdb.connect()
-    con.query("set threads=1")
-
-    rel = con.read_parquet(str(path))
-
-    rel = rel.filter("XX_AC > 0 or XY_AC > 0")  # discard
-
-    XX_n = f"({XX_sample_number} - XX_n_DP_discarded)"
-    XY_n = f"({XY_sample_number} - XY_n_DP_discarded)"
-
-    XX_multiplier = XY_multiplier = 2
-    if contig == "chrM":
-        XX_multiplier = XY_multiplier = 1
-    elif contig == "chrY":
-        # it's 1 because we only keep non-autosomal variants on XY samples
-        XY_multiplier = 1
-        XX_multiplier = 0
-    elif contig == "chrX":
-        # if not in PAR then 1 else 2
-        XY_multiplier = f"if({PAR1_END_1} < pos and pos < {PAR2_X_BEGIN_1}, 1, 2)"
-
-    XX_AN_computation = f"{XX_n} * {XX_multiplier}"
-    XY_AN_computation = f"{XY_n} * {XY_multiplier}"
-
-    rel = rel.select(
-        f"""pos, ref, alt,
-        XX_AN: {XX_AN_computation}, 
+    XX_n = f"({XX_sample_number} - XX_n_DP_discarded - XX_n_no_coverage)"
+    XY_n = f"({XY_sample_number} - XY_n_DP_discarded - XY_n_no_coverage)"
+
+    # on chrY it's 1 for XY samples because we only keep non-autosomal variants, on chrX it's 1 if not in PAR
+    contig = f"'{region.contig}'"
+    XX_multiplier = f"case {contig} when 'chrM' then 1 when 'chrY' then 0 else 2 end"
+    XY_multiplier = f"""case
+        when {contig} = 'chrM' or {contig} = 'chrY' then 1
+        when {contig} = 'chrX' and {PAR1_END_1} < pos and pos < {PAR2_X_BEGIN_1} then 1
+        else 2
+    end"""
+
+    return f"""
+        select
+        pos, ref, alt,
+        XX_AN: {XX_n} * {XX_multiplier},
         XX_AC, XX_AC_hom, XX_AC_hemi,
-        XY_AN: {XY_AN_computation},
+        XY_AN: {XY_n} * {XY_multiplier},
         XY_AC, XY_AC_hom, XY_AC_hemi,
         DP_mean: (DP_sum/n_samples),
         DP_std: sqrt((DP2_sum - 2*DP_mean*DP_sum + n_samples*(DP_mean**2)) / n_samples),
-        """
-    )
-
-    out_path.parent.mkdir(exist_ok=True)
-    # rel.write_csv(str(out_path), sep="\t")
-    rel.write_parquet(str(out_path), compression="ZSTD")
+        from ({_counts_sql(in_dir / str(region))})
+        where XX_AC > 0 or XY_AC > 0  -- discard
+    """
+
+
+def _counts_sql(region_dir: Path) -> str:
+    """SQL query of the counts of the region with pos, ref, alt (also of datasets counted by older versions)."""
+    path = region_dir / "data.parquet"
+    columns = pq.read_schema(path).names
+    counts = f"read_parquet('{path}')"
+    if "key" in columns:
+        # variant keys are decoded into pos, ref, alt (datasets counted before the keys have pos, ref, alt)
+        alleles = f"read_parquet('{region_dir / ALLELES_NAME}')"
+        counts = f"({decoded_sql(counts, alleles)})"
+    if "XX_n_no_coverage" not in columns:
+        # samples of gVCF files that are not covered at the position (counted before the gVCF support don't have it)
+        return f"select *, XX_n_no_coverage: 0, XY_n_no_coverage: 0 from {counts}"
+    return f"select * from {counts}"
+
+
+def write_result(
+    con: duckdb.DuckDBPyConnection, rel: duckdb.DuckDBPyRelation, out_path: Path, bin_size: int | None
+) -> None:
+    """Write the rows of rel sorted by pos, ref, alt into out_path (see finalize_region) and its index."""
+    out_path.mkdir(exist_ok=True)
+    rel = rel.order("pos, ref, alt")
+    if bin_size is None:
+        rel.write_parquet(str(out_path / RESULT_NAME), compression="ZSTD", row_group_size=RESULT_ROW_GROUP_SIZE)
+    else:
+        # a file per bin (duckdb partitioned writes don't keep the order of the rows with several threads): the
+        # region is sorted once into a temporary file, a bin reads only its row groups (min/max statistics of pos)
+        temp_path = out_path.parent / TEMP_DIR / f"{out_path.name}.parquet"
+        temp_path.parent.mkdir(exist_ok=True)
+        rel.write_parquet(str(temp_path), compression="ZSTD", row_group_size=RESULT_ROW_GROUP_SIZE)
+        sorted_rel = con.read_parquet(str(temp_path))
+        bins = sorted_rel.select(f"bin: pos // {bin_size}").distinct().fetchall()
+        for (bin,) in bins:
+            bin_path = out_path / BINNED_RESULT_NAME / f"bin={bin}"
+            bin_path.mkdir(parents=True)
+            rel_bin = sorted_rel.filter(f"pos between {bin * bin_size} and {(bin + 1) * bin_size - 1}")
+            rel_bin.order("pos, ref, alt").write_parquet(
+                str(bin_path / "data_0.parquet"), compression="ZSTD", row_group_size=RESULT_ROW_GROUP_SIZE
+            )
+        temp_path.unlink()
+    write_index(out_path)
@@ -1,2 +1,264 @@
-def merge(*args, **kwargs):
-    raise NotImplementedError()
+import json
+import logging
+import os
+import shutil
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import duckdb
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+import varpile
+from varpile.allele_counts import COUNT_COLUMNS
+from varpile.coverage import COVERAGE_NAME, no_coverage_at, write_region_coverage
+from varpile.errors import DatasetError
+from varpile.kway_merge import merge_sorted
+from varpile.variant_key import ALLELES_NAME, merge_alleles
+
+logger = logging.getLogger(__name__)
+info = logger.info
+
+# In place merge (--into): the merged regions and info.json are written into MERGING_DIR, which is renamed to
+# MERGED_DIR once complete (the commit of the merge), then its files are moved into the dataset (see finish_merge)
+MERGING_DIR = ".merging"
+MERGED_DIR = ".merged"
+
+
+def datasets_of(path: Path, dataset_info: dict) -> list[dict]:
+    """Return the datasets (name, id, version, input_files) contained in a count dataset.
+
+    Datasets counted before the provenance was recorded are identified by their directory name.
+    """
+    return dataset_info.get("datasets") or [{"name": path.name, "id": None}]
+
+
+def dataset_identities(dataset: dict) -> set[tuple[str, str]]:
+    """Return what identifies the dataset: the id of its count run and the fingerprints of its input files.
+
+    The name is only a label (datasets of different centers can have the same name), it identifies only
+    datasets counted before the id was recorded.
+    """
+    identities = {("input file", fingerprint) for fingerprint in dataset.get("input_files", [])}
+    if dataset.get("id"):
+        identities.add(("count run", dataset["id"]))
+    else:
+        identities.add(("name", dataset["name"]))
+    return identities
+
+
+def merge_info(paths: list[Path], infos: list[dict]) -> dict:
+    """Combine info.json of count datasets, sample numbers are added up and the datasets are listed.
+
+    Raises:
+        DatasetError: If the datasets were counted with different filters (AC0_filter)
+            or the same dataset (count run or input file, see dataset_identities) is included more than once.
+    """
+    AC0_filter = infos[0]["AC0_filter"]
+    sample_number = defaultdict(int)
+    gvcf_sample_number = defaultdict(int)
+    datasets: list[dict] = []
+    seen: dict[tuple[str, str], tuple[Path, dict]] = {}  # identity -> (path, dataset)
+    for path, dataset_info in zip(paths, infos):
+        if dataset_info["AC0_filter"] != AC0_filter:
+            raise DatasetError(
+                f"Can't merge datasets with different filters: {AC0_filter} != {dataset_info['AC0_filter']}"
+            )
+        for sex, n in dataset_info["sample_number"].items():
+            sample_number[sex] += n
+        for sex, n in dataset_info.get("gvcf_sample_number", {}).items():
+            gvcf_sample_number[sex] += n
+
+        for dataset in datasets_of(path, dataset_info):
+            for identity in sorted(dataset_identities(dataset)):
+                if identity in seen:
+                    other_path, other = seen[identity]
+                    raise DatasetError(
+                        f"Dataset '{dataset['name']}' in '{path}' is included twice, the same {identity[0]} "
+                        f"({identity[1]}) is in dataset '{other['name']}' in '{other_path}'"
+                    )
+            seen |= {identity: (path, dataset) for identity in dataset_identities(dataset)}
+            datasets.append(dataset)
+
+    return {
+        "version": varpile.__VERSION__,
+        "sample_number": sample_number,
+        "gvcf_sample_number": gvcf_sample_number,
+        "AC0_filter": AC0_filter,
+        "datasets": datasets,
+    }
+
+
+def finish_merge(path: Path) -> None:
+    """Move the files of a committed in place merge (MERGED_DIR) into the dataset.
+
+    Moving the files is not atomic, but it is repeated until done: every merge (and finalize) of the dataset
+    first finishes a committed merge that was interrupted. A merge interrupted before its commit is discarded.
+    """
+    merged = path / MERGED_DIR
+    if not merged.is_dir():
+        return
+
+    info(f"Finishing the merge into '{path}'")
+    for region_dir in sorted(p for p in merged.iterdir() if p.is_dir()):
+        (path / region_dir.name).mkdir(exist_ok=True)
+        for file in region_dir.iterdir():
+            os.replace(file, path / region_dir.name / file.name)
+    if (merged / "info.json").exists():
+        os.replace(merged / "info.json", path / "info.json")  # the dataset lists the new datasets
+    shutil.rmtree(merged)
+
+
+def merge_region(
+    region_paths: list[Path], out_path: Path, gvcf_sample_numbers: list[dict[str, int]] | None = None
+) -> None:
+    """Merge data.parquet of a region from several datasets (sorted by key) into out_path.
+
+    The alleles (alleles.parquet next to data.parquet) and the coverage of gVCF samples (see varpile.coverage)
+    are merged as well.
+
+    Args:
+        gvcf_sample_numbers: Number of XX and XY gVCF samples of each dataset.
+
+    Raises:
+        DatasetError: If a dataset was counted before the variant keys (it has pos, ref, alt columns)
+            or it has gVCF samples but not their coverage.
+    """
+    gvcf_sample_numbers = gvcf_sample_numbers or [{}] * len(region_paths)
+    for path in region_paths:
+        if "key" not in pq.read_schema(path).names:
+            raise DatasetError(f"'{path}' was counted by an older version (without variant keys), count it again")
+    # (coverage, gVCF samples) of the datasets with gVCF samples
+    gvcf_datasets = [
+        (path.parent / COVERAGE_NAME, n) for path, n in zip(region_paths, gvcf_sample_numbers) if any(n.values())
+    ]
+    for coverage_path, _ in gvcf_datasets:
+        if not coverage_path.exists():
+            raise DatasetError(f"'{coverage_path.parent}' has gVCF samples but not their coverage, count it again")
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    alleles_paths = [path.parent / ALLELES_NAME for path in region_paths]
+    if len(region_paths) == 1:
+        shutil.copyfile(region_paths[0], out_path)
+        shutil.copyfile(alleles_paths[0], out_path.parent / ALLELES_NAME)
+        if gvcf_datasets:
+            shutil.copyfile(gvcf_datasets[0][0], out_path.parent / COVERAGE_NAME)
+        return
+
+    merge_sorted(region_paths, out_path, COUNT_COLUMNS, key_size=1)
+    with duckdb.connect() as con:
+        merge_alleles(con, alleles_paths, out_path.parent / ALLELES_NAME)
+        if gvcf_datasets:
+            set_no_coverage(out_path, gvcf_datasets)
+            write_region_coverage(
+                con, [coverage_path for coverage_path, _ in gvcf_datasets], out_path.parent / COVERAGE_NAME
+            )
+
+
+def set_no_coverage(path: Path, gvcf_datasets: list[tuple[Path, dict[str, int]]]) -> None:
+    """Set XX/XY_n_no_coverage of the merged region to the gVCF samples without coverage in all datasets.
+
+    The sum of the merged rows only has the samples without coverage of the datasets that have the variant,
+    the samples of the other datasets are taken from their coverage at the position of the variant.
+    The file is rewritten batch by batch (the rows stay sorted by key).
+
+    Args:
+        path: data.parquet of the merged region.
+        gvcf_datasets: Coverage (COVERAGE_NAME) and the number of XX and XY gVCF samples of each dataset.
+    """
+    positions = np.unique(pq.read_table(path, columns=["key"])["key"].to_numpy() >> 32)
+    XX_no_coverage = np.zeros(len(positions), dtype=np.int64)
+    XY_no_coverage = np.zeros(len(positions), dtype=np.int64)
+    for coverage_path, gvcf_sample_number in gvcf_datasets:
+        XX, XY = no_coverage_at(positions, [coverage_path], gvcf_sample_number)
+        XX_no_coverage += XX
+        XY_no_coverage += XY
+
+    parquet_file = pq.ParquetFile(path)
+    schema = parquet_file.schema_arrow
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with pq.ParquetWriter(tmp_path, schema, compression="ZSTD") as writer:
+        for batch in parquet_file.iter_batches():
+            table = pa.Table.from_batches([batch])
+            index = np.searchsorted(positions, table["key"].to_numpy() >> 32)
+            for name, no_coverage in [("XX_n_no_coverage", XX_no_coverage), ("XY_n_no_coverage", XY_no_coverage)]:
+                column = pa.array(no_coverage[index], type=schema.field(name).type)
+                table = table.set_column(schema.get_field_index(name), name, column)
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def merge(paths: list[Path], out_path: Path | None, threads: int, into: Path | None = None) -> None:
+    """Merge count datasets (output of varpile count or merge) into a single count dataset.
+
+    Regions are merged in parallel, each region with a streaming k-way merge of the (sorted) inputs.
+
+    Args:
+        paths: Count datasets to merge.
+        out_path: Output directory, if None the datasets are merged into `into` (in place).
+        into: An existing (merged) dataset the new datasets are added to. Only the regions present
+            in the new datasets are merged, the other regions are copied (or left as they are in place).
+    """
+    if out_path is None and into is None:
+        raise ValueError("Output directory or the dataset to merge into is required")
+    out_path = out_path or into
+    in_place = into is not None and out_path.resolve() == into.resolve()
+
+    inputs = ([into] if into is not None else []) + paths
+    if not in_place and out_path.resolve() in [path.resolve() for path in inputs]:
+        raise DatasetError(f"Output '{out_path}' is also an input")
+    for path in inputs:
+        finish_merge(path)
+
+    infos = [json.loads((path / "info.json").read_text()) for path in inputs]
+    merged_info = merge_info(inputs, infos)
+    gvcf_sample_numbers = {
+        path: dataset_info.get("gvcf_sample_number", {}) for path, dataset_info in zip(inputs, infos)
+    }
+    info(f"Merging {len(inputs)} datasets with {merged_info['sample_number']} samples")
+
+    # region -> data.parquet of the region in the datasets that have it
+    region_paths: dict[str, list[Path]] = defaultdict(list)
+    for path in inputs:
+        for region_dir in sorted(p for p in path.iterdir() if p.is_dir() and not p.name.startswith(".")):
+            region_paths[region_dir.name].append(region_dir / "data.parquet")
+
+    if in_place:
+        # regions and info.json are written to a staging directory and moved in place once all of them are merged
+        # (see finish_merge), a merge that fails before leaves the dataset unchanged
+        new_regions = {p.name for path in paths for p in path.iterdir() if p.is_dir() and not p.name.startswith(".")}
+        region_paths = {region: region_paths[region] for region in new_regions}
+        staging = out_path / MERGING_DIR
+        shutil.rmtree(staging, ignore_errors=True)
+    else:
+        if out_path.exists():
+            shutil.rmtree(out_path)
+        staging = out_path
+
+    # largest regions first, so that a large region doesn't start last
+    regions = sorted(region_paths, key=lambda r: sum(p.stat().st_size for p in region_paths[r]), reverse=True)
+
+    with ProcessPoolExecutor(threads) as executor:
+        futures = [
+            executor.submit(
+                merge_region,
+                region_paths[region],
+                staging / region / "data.parquet",
+                [gvcf_sample_numbers[path.parent.parent] for path in region_paths[region]],
+            )
+            for region in regions
+        ]
+        for future in tqdm(futures, desc="Merging datasets"):
+            future.result()
+
+    staging.mkdir(exist_ok=True)
+    tmp_info = staging / "info.json.tmp"
+    tmp_info.write_text(json.dumps(merged_info, indent=4))
+    os.replace(tmp_info, staging / "info.json")
+
+    if in_place:
+        os.replace(staging, out_path / MERGED_DIR)  # commit, the dataset contains the new datasets from now on
+        finish_merge(out_path)
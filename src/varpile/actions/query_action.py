@@ -0,0 +1,36 @@
+import contextlib
+import sys
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.csv
+
+import varpile.query
+from varpile.query import VARIANT_SCHEMA, read_variants
+from varpile.utils import Region1
+
+
+def query(
+    path: Path,
+    variants: list[tuple[str, int, str, str]],
+    regions: list[Region1] | None,
+    variants_file: Path | None,
+    output: Path | None,
+) -> None:
+    """Write the results of the variants and of the variants in the regions as TSV (stdout if output is None)."""
+    dataset = varpile.query.open(path)
+
+    tables = []
+    if variants:
+        tables.append(dataset.lookup_many(pa.table(list(zip(*variants)), schema=VARIANT_SCHEMA)))
+    if variants_file is not None:
+        tables.append(dataset.lookup_many(read_variants(variants_file)))
+    for region in regions or []:
+        tables.append(dataset.region(region))
+
+    table = pa.concat_tables(tables) if tables else dataset.empty()
+    with open(output, "wb") if output is not None else contextlib.nullcontext(sys.stdout.buffer) as out:
+        # the header is written separately, arrow quotes the column names
+        out.write(("\t".join(table.column_names) + "\n").encode())
+        write_options = pa.csv.WriteOptions(include_header=False, delimiter="\t", quoting_style="none")
+        pa.csv.write_csv(table, out, write_options)
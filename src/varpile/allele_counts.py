@@ -1,32 +1,112 @@
+import contextlib
+import heapq
+import operator
+import os
 import shutil
 from pathlib import Path
-from typing import Final, TypedDict
+from typing import ClassVar, Final, Iterable, Iterator, Literal, TypedDict
 
 import duckdb
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pysam
 
-from varpile.VariantFile import VariantFile
-from varpile.infer_sex import SamplesSex, in_non_par_Y, in_non_par_X
+from varpile import metrics
+from varpile.VariantFile import VariantFile, open_cached
+from varpile.coverage import COVERAGE_NAME, CoveragePile, is_gvcf, is_ref_block, no_coverage_at, write_region_coverage
+from varpile.genotypes import MISSING, NO_ALLELE, SampleColumns
+from varpile.infer_sex import SamplesSex, Sex, in_non_par_Y, in_non_par_X
+from varpile.kway_merge import merge_sorted
+from varpile.targets import Intervals, in_intervals
 from varpile.utils import OutFile, Region1
+from varpile.variant_key import ALLELES_COLUMNS, ALLELES_NAME, is_hashed, merge_alleles, variant_key
 
-CON = duckdb.connect(":memory:")
-CON.query("set threads to 1")
 
+# Memory of the merges (one per worker can run at the same time) and of finalize, see merge_memory_limit
+MERGE_MEMORY_FRACTION: Final = 0.75
+
+
+def merge_memory_limit(workers: int) -> str:
+    """Default duckdb memory limit of a merge (or finalize): a share of the available memory per worker."""
+    available = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    return f"{max(int(available * MERGE_MEMORY_FRACTION / workers) // 2**20, 256)}MB"
+
+
+def connect(threads: int = 1, memory_limit: str | None = None, temp_directory: Path | None = None):
+    """Return a new in-memory duckdb connection for merge_piles.
+
+    Args:
+        threads: Number of duckdb threads.
+        memory_limit: duckdb memory limit (e.g. "4GB"), larger aggregations spill to temp_directory.
+        temp_directory: Directory of the spilled data (default: duckdb's default, <database>.tmp).
+    """
+    config = {"threads": threads, "preserve_insertion_order": False}
+    if memory_limit is not None:
+        config["memory_limit"] = memory_limit
+    if temp_directory is not None:
+        config["temp_directory"] = str(temp_directory)
+    return duckdb.connect(":memory:", config=config)
+
+
+# Variants are identified by their key (pos, ref, alt), see varpile.variant_key.
+# Counts of a single sample are 0-2, they are stored in the narrowest type (piles are intermediate files).
 VARIANT_PILE_COLUMNS = {
-    "pos": "INT",
-    "ref": "VARCHAR",
-    "alt": "VARCHAR",
+    "key": "BIGINT",
+    "XX_AC": "UTINYINT",
+    "XX_AC_hom": "UTINYINT",
+    "XX_AC_hemi": "UTINYINT",
+    "XX_n_DP_discarded": "UTINYINT",
+    "XY_AC": "UTINYINT",
+    "XY_AC_hom": "UTINYINT",
+    "XY_AC_hemi": "UTINYINT",
+    "XY_n_DP_discarded": "UTINYINT",
+    "DP": "INT",
+}
+
+# Columns of a pile that is already aggregated per variant (sorted by key).
+# These are the same columns that merge_piles produces (without the gVCF coverage).
+AGGREGATED_PILE_COLUMNS = {
+    "key": "BIGINT",
     "XX_AC": "INT",
     "XX_AC_hom": "INT",
     "XX_AC_hemi": "INT",
+    "XY_AC": "INT",
+    "XY_AC_hom": "INT",
+    "XY_AC_hemi": "INT",
     "XX_n_DP_discarded": "INT",
+    "XY_n_DP_discarded": "INT",
+    "n_samples": "INT",
+    "DP_sum": "BIGINT",
+    "DP2_sum": "BIGINT",
+}
+
+# Columns of data.parquet of a region in a count dataset (written by merge_piles, sorted by key),
+# the alleles of the hashed keys are in alleles.parquet next to it
+COUNT_COLUMNS = {
+    "key": "BIGINT",
+    "XX_AC": "INT",
+    "XX_AC_hom": "INT",
+    "XX_AC_hemi": "INT",
     "XY_AC": "INT",
     "XY_AC_hom": "INT",
     "XY_AC_hemi": "INT",
+    "XX_n_DP_discarded": "INT",
     "XY_n_DP_discarded": "INT",
-    "DP": "INT",
+    "XX_n_no_coverage": "INT",  # samples of gVCF files without a (passing) reference block or variant record
+    "XY_n_no_coverage": "INT",
+    "n_samples": "INT",
+    "DP_sum": "BIGINT",
+    "DP2_sum": "BIGINT",
 }
 
+# constants for pile counts (AC, AC_hom, AC_hemi, n_DP_discarded)
+EMPTY_COUNTS: Final = (0, 0, 0, 0)  # used when there are no values (example sex=XX and we need to fill XY values)
+DP_DISCARDED_COUNTS: Final = (0, 0, 0, 1)  # used when the DP is too low
+
+# python: iter_alleles (one python object per sample), numpy: iter_variant_sums (all samples of a record at once)
+Engine = Literal["python", "numpy"]
+
 
 class IFilterValues(TypedDict):
     """FilterValues to use"""
@@ -36,54 +116,310 @@ class IFilterValues(TypedDict):
     min_AB: float  # Allelic Balance
 
 
+class Pile:
+    """Writes one row per (sample, allele) into the pile file.
+
+    The alleles of the variants with a hashed key are written into the alleles file.
+    """
+
+    columns: ClassVar[dict] = VARIANT_PILE_COLUMNS
+
+    def __init__(self, out_file: OutFile, alleles_file: OutFile):
+        self.out_file = out_file
+        self.alleles_file = alleles_file
+        self._keys_pos: int | None = None
+        self._keys: dict[tuple[str, str], int] = {}  # (ref, alt) -> key of the variants at _keys_pos
+
+    def variant_key(self, pos: int, ref: str, alt: str) -> int:
+        if pos != self._keys_pos:
+            self._keys.clear()
+            self._keys_pos = pos
+
+        key = self._keys.get((ref, alt))
+        if key is None:
+            key = self._keys[(ref, alt)] = variant_key(pos, ref, alt)
+            if is_hashed(key):
+                self.alleles_file.write_row((key, ref, alt))
+        return key
+
+    def add(self, pos: int, ref: str, alt: str, sex: Sex, counts: tuple[int, int, int, int], dp: int) -> None:
+        if sex == "XX":
+            XX_counts, XY_counts = (counts, EMPTY_COUNTS)
+        else:
+            XX_counts, XY_counts = (EMPTY_COUNTS, counts)
+
+        self.out_file.write_row((self.variant_key(pos, ref, alt), *XX_counts, *XY_counts, dp))
+
+    def flush(self) -> None:
+        pass
+
+
+class AggregatedPile(Pile):
+    """Keeps running per variant (pos, ref, alt) sums and writes one row per variant.
+
+    Records are fetched sorted by position, so once a larger position comes in the sums
+    of the previous position are final and can be written out. This keeps the memory bounded
+    by the number of alleles at a single position.
+    If a position shows up again (unsorted input) we just write a second row for the same variant,
+    merge_piles sums them up anyway.
+    """
+
+    columns: ClassVar[dict] = AGGREGATED_PILE_COLUMNS
+
+    def __init__(self, out_file: OutFile, alleles_file: OutFile):
+        super().__init__(out_file, alleles_file)
+        self.pos: int | None = None
+        # (ref, alt) -> [XX_AC, XX_AC_hom, XX_AC_hemi, XY_AC, XY_AC_hom, XY_AC_hemi,
+        #                XX_n_DP_discarded, XY_n_DP_discarded, n_samples, DP_sum, DP2_sum]
+        self.sums: dict[tuple[str, str], list[int]] = {}
+
+    def add(self, pos: int, ref: str, alt: str, sex: Sex, counts: tuple[int, int, int, int], dp: int) -> None:
+        sums = self._variant_sums(pos, ref, alt)
+
+        ac, ac_hom, ac_hemi, n_DP_discarded = counts
+        offset = 0 if sex == "XX" else 3
+        sums[offset] += ac
+        sums[offset + 1] += ac_hom
+        sums[offset + 2] += ac_hemi
+        sums[6 if sex == "XX" else 7] += n_DP_discarded
+        sums[8] += 1
+        sums[9] += dp
+        sums[10] += dp * dp
+
+    def add_sums(self, pos: int, ref: str, alt: str, sums: list[int]) -> None:
+        """Add the sums of several samples (in the order of AGGREGATED_PILE_COLUMNS, without pos, ref, alt)."""
+        variant_sums = self._variant_sums(pos, ref, alt)
+        for i, value in enumerate(sums):
+            variant_sums[i] += value
+
+    def _variant_sums(self, pos: int, ref: str, alt: str) -> list[int]:
+        if pos != self.pos:
+            self.flush()
+            self.pos = pos
+
+        sums = self.sums.get((ref, alt))
+        if sums is None:
+            sums = self.sums[(ref, alt)] = [0] * 11
+        return sums
+
+    def flush(self) -> None:
+        rows = [(self.variant_key(self.pos, ref, alt), *sums) for (ref, alt), sums in self.sums.items()]
+        for row in sorted(rows):
+            self.out_file.write_row(row)
+        self.sums.clear()
+
+
 def process_chromosome(
     vcf_path: Path,
     region: Region1,
     sex_info: SamplesSex,
     out_dir: Path,
     filter_values: IFilterValues,
+    aggregate: bool = False,
     debug: bool = False,
+    engine: Engine = "python",
+    decompression_threads: int = 0,
+    intervals: Intervals | None = None,
 ):
+    """Write the pile of variant counts for one vcf file and one region.
+
+    Args:
+        aggregate: If True, write one row per variant (pos, ref, alt) with the counts summed over the samples
+            (AggregatedPile), otherwise write one row per sample and allele (Pile).
+        engine: "numpy" computes the counts of all samples of a record at once (see iter_variant_sums),
+            it always writes an aggregated pile.
+        decompression_threads: Extra htslib threads decompressing the file (see VariantFile).
+        intervals: Count only the records that start in these target intervals of the region (see varpile.targets).
+    """
+    metrics.add("samples", len(sex_info))
+    vcf = open_cached(vcf_path, threads=decompression_threads)  # the file stays open for the next task of the file
+    records = fetch_targets(vcf, region, intervals)
+    count_region(records, vcf.header, region, sex_info, out_dir, filter_values, aggregate, engine)
+
+
+def process_file(
+    vcf_path: Path,
+    regions: list[Region1],
+    sex_info: SamplesSex,
+    out_dirs: list[Path],
+    filter_values: IFilterValues,
+    aggregate: bool = False,
+    debug: bool = False,
+    engine: Engine = "python",
+    decompression_threads: int = 0,
+    targets: dict[str, Intervals] | None = None,
+):
+    """Write the piles of variant counts of all regions for one vcf file, reading the file once.
+
+    The records are read from start to end and routed to their regions (see VariantFile.fetch_regions),
+    so the file doesn't need an index and can be the standard input (VariantFile.STDIN).
+
+    Args:
+        out_dirs: Output directory of each region.
+        targets: Target intervals of the contigs, the records of a region (contig) are counted only in its targets.
+        For the other arguments see process_chromosome.
+    """
+    metrics.add("samples", len(sex_info))
+    out_dir_of = dict(zip(regions, out_dirs))
+    vcf = open_cached(vcf_path, threads=decompression_threads)
+    for region, records in vcf.fetch_regions(regions):
+        if targets is not None:
+            records = in_intervals(records, targets.get(region.contig, []))
+        count_region(records, vcf.header, region, sex_info, out_dir_of[region], filter_values, aggregate, engine)
+
+
+def fetch_targets(vcf: VariantFile, region: Region1, intervals: Intervals | None) -> Iterable[pysam.VariantRecord]:
+    """Return the records of the region, only the ones in the target intervals if they are given."""
+    if intervals is None:
+        return vcf.fetch(region)
+    return in_intervals(vcf.fetch_intervals(region.contig, intervals), intervals)
+
+
+def count_region(
+    records: Iterable[pysam.VariantRecord],
+    header: pysam.VariantHeader,
+    region: Region1,
+    sex_info: SamplesSex,
+    out_dir: Path,
+    filter_values: IFilterValues,
+    aggregate: bool = False,
+    engine: Engine = "python",
+):
+    """Write the pile of variant counts of the records of a region (see process_chromosome)."""
     # define the location where we will save the chromosome data (out_path is treated as directory)
     variant_pile_path = out_dir / "data.parquet"
 
     min_DP = filter_values["min_DP"]
 
-    out_file = OutFile(variant_pile_path, columns=VARIANT_PILE_COLUMNS)
-    vcf = VariantFile(vcf_path)
-    empty_values = "0\t0\t0\t0"  # used when there are no values (example sex=XX and we need to fill XY values)
-    zero_counts = "0\t0\t0\t1"  # used when counts are zero
-    with out_file, vcf:
-        alleles = iter_alleles(vcf, region, sex_info, filter_values)
-        for (PASS, rec, sex, sample, dp), alt, (ac, ac_hom, ac_hemi) in alleles:
-            # Exclude allele that refers to a spanning deletion
-            # https://gatk.broadinstitute.org/hc/en-us/articles/360035531912-Spanning-or-overlapping-deletions-allele
-            if alt == "*":
-                continue
+    pile_class = AggregatedPile if aggregate or engine == "numpy" else Pile
+    out_file = OutFile(variant_pile_path, columns=pile_class.columns)
+    alleles_file = OutFile(out_dir / ALLELES_NAME, columns=ALLELES_COLUMNS)
+    with out_file, alleles_file, contextlib.ExitStack() as stack:
+        pile = pile_class(out_file, alleles_file)
+
+        # gVCF reference blocks are written as covered intervals (see varpile.coverage)
+        coverage = None
+        if is_gvcf(header):
+            coverage_file = stack.enter_context(OutFile(out_dir / COVERAGE_NAME, CoveragePile.columns))
+            coverage = CoveragePile(coverage_file, region, sex_info, min_DP, filter_values["min_GQ"])
+
+        if engine == "numpy":
+            for pos, ref, alt, sums in iter_variant_sums(records, region, sex_info, filter_values, coverage):
+                pile.add_sums(pos, ref, alt, sums)
+        else:
+            alleles = iter_alleles(records, region, sex_info, filter_values, coverage)
+            for (PASS, rec, sex, sample, dp), alt, (ac, ac_hom, ac_hemi) in alleles:
+                # Exclude allele that refers to a spanning deletion
+                # https://gatk.broadinstitute.org/hc/en-us/articles/360035531912-Spanning-or-overlapping-deletions-allele
+                if alt == "*":
+                    continue
 
-            if dp >= min_DP:
-                if PASS:
-                    str_counts = f"{ac}\t{ac_hom}\t{ac_hemi}\t0"
+                if dp >= min_DP:
+                    if PASS:
+                        counts = (ac, ac_hom, ac_hemi, 0)
+                    else:
+                        counts = EMPTY_COUNTS  # AC is 0 but we don't decrease AN
                 else:
-                    str_counts = empty_values  # AC is 0 but we don't decrease AN
-            else:
-                str_counts = zero_counts
+                    counts = DP_DISCARDED_COUNTS
 
-            if sex == "XX":
-                XX_counts, XY_counts = (str_counts, empty_values)
-            else:
-                XX_counts, XY_counts = (empty_values, str_counts)
+                pile.add(rec.pos, rec.ref, alt, sex, counts, dp)
 
-            line = f"{rec.pos}\t{rec.ref}\t{alt}\t{XX_counts}\t{XY_counts}\t{dp}\n"
-            out_file.write_line(line)
+        pile.flush()
+        if coverage is not None:
+            coverage.flush()
 
 
-def iter_alleles(vcf_file: VariantFile, region: Region1, sex_info: SamplesSex, filter_values: IFilterValues):
+def process_batch(
+    vcf_paths: list[Path],
+    region: Region1,
+    sex_infos: list[SamplesSex],
+    out_dir: Path,
+    filter_values: IFilterValues,
+    engine: Engine = "python",
+    decompression_threads: int = 0,
+    intervals: Intervals | None = None,
+):
+    """Write one aggregated pile of the region for several (small) vcf files.
+
+    The records of the files are read side by side in position order, so the counts of a variant are summed over
+    all files of the batch (one pile, one alleles file and one coverage file instead of one per input file).
+
+    Args:
+        sex_infos: Sex of the samples of each file.
+        engine, intervals: See process_chromosome (the pile is always aggregated).
+    """
+    min_DP, min_GQ = filter_values["min_DP"], filter_values["min_GQ"]
+    metrics.add("samples", sum(len(sex_info) for sex_info in sex_infos))
+    out_file = OutFile(out_dir / "data.parquet", columns=AggregatedPile.columns)
+    alleles_file = OutFile(out_dir / ALLELES_NAME, columns=ALLELES_COLUMNS)
+    with out_file, alleles_file, contextlib.ExitStack() as stack:
+        pile = AggregatedPile(out_file, alleles_file)
+
+        coverage_file = None
+        coverages: list[CoveragePile] = []
+        variant_sums = []
+        for vcf_path, sex_info in zip(vcf_paths, sex_infos):
+            vcf = stack.enter_context(VariantFile(vcf_path, threads=decompression_threads))
+            # gVCF reference blocks of all files are written as covered intervals into one file (see varpile.coverage)
+            coverage = None
+            if is_gvcf(vcf.header):
+                if coverage_file is None:
+                    coverage_file = stack.enter_context(OutFile(out_dir / COVERAGE_NAME, CoveragePile.columns))
+                coverage = CoveragePile(coverage_file, region, sex_info, min_DP, min_GQ)
+                coverages.append(coverage)
+            iter_sums = iter_variant_sums if engine == "numpy" else iter_allele_sums
+            records = fetch_targets(vcf, region, intervals)
+            variant_sums.append(iter_sums(records, region, sex_info, filter_values, coverage))
+
+        for pos, ref, alt, sums in heapq.merge(*variant_sums, key=operator.itemgetter(0)):
+            pile.add_sums(pos, ref, alt, sums)
+
+        pile.flush()
+        for coverage in coverages:
+            coverage.flush()
+
+
+def iter_allele_sums(
+    records: Iterable[pysam.VariantRecord],
+    region: Region1,
+    sex_info: SamplesSex,
+    filter_values: IFilterValues,
+    coverage: CoveragePile | None = None,
+) -> Iterator[tuple[int, str, str, list[int]]]:
+    """Counts of iter_alleles as in process_chromosome, yields (pos, ref, alt, sums) of every sample and allele.
+
+    The sums are in the order of AGGREGATED_PILE_COLUMNS (see iter_variant_sums).
+    """
+    min_DP = filter_values["min_DP"]
+    for (PASS, rec, sex, sample, dp), alt, (ac, ac_hom, ac_hemi) in iter_alleles(
+        records, region, sex_info, filter_values, coverage
+    ):
+        if alt == "*":  # spanning deletion
+            continue
+
+        if dp >= min_DP:
+            ac, ac_hom, ac_hemi, n_DP_discarded = (ac, ac_hom, ac_hemi, 0) if PASS else EMPTY_COUNTS
+        else:
+            ac, ac_hom, ac_hemi, n_DP_discarded = DP_DISCARDED_COUNTS
+
+        if sex == "XX":
+            yield rec.pos, rec.ref, alt, [ac, ac_hom, ac_hemi, 0, 0, 0, n_DP_discarded, 0, 1, dp, dp * dp]
+        else:
+            yield rec.pos, rec.ref, alt, [0, 0, 0, ac, ac_hom, ac_hemi, 0, n_DP_discarded, 1, dp, dp * dp]
+
+
+def iter_alleles(
+    records: Iterable[pysam.VariantRecord],
+    region: Region1,
+    sex_info: SamplesSex,
+    filter_values: IFilterValues,
+    coverage: CoveragePile | None = None,
+):
 
     min_GQ = filter_values["min_GQ"]
     min_AB = filter_values["min_AB"]
 
-    vcf_records = vcf_file.fetch(region)
+    vcf_records = metrics.counted(records)
 
     sex_list = list(sex_info.values())
 
@@ -96,14 +432,26 @@ def iter_alleles(vcf_file: VariantFile, region: Region1, sex_info: SamplesSex, f
     is_chrX = region.contig in ("chrX", "X")
     is_chrY = region.contig in ("chrY", "Y")
 
+    # Records are assigned to the region where they start (fetch also returns records that only overlap the region),
+    # so that a record is counted exactly once when a chromosome is split into several regions (shards).
+    region_begin = region.begin or 0
+
     record: pysam.VariantRecord
     sample: pysam.VariantRecordSample
     for record in vcf_records:
 
-        # If the record is a GVCF block ignore it (at the moment we discard this information)
-        if record.alleles[1] == "<NON_REF>":
+        # GVCF blocks are not counted, but they tell which samples are covered (blocks are clipped to the region)
+        if is_ref_block(record):
+            if coverage is not None:
+                coverage.add_block(record)
+            continue
+
+        if record.pos < region_begin:
             continue
 
+        if coverage is not None:
+            coverage.add_variant(record)
+
         alts = record.alts
 
         for sex, sample in zip(sex_list, record.samples.values()):
@@ -196,6 +544,138 @@ def iter_alleles(vcf_file: VariantFile, region: Region1, sex_info: SamplesSex, f
                 # TODO triploid or Multi-ploid... ?
 
 
+def iter_variant_sums(
+    records: Iterable[pysam.VariantRecord],
+    region: Region1,
+    sex_info: SamplesSex,
+    filter_values: IFilterValues,
+    coverage: CoveragePile | None = None,
+) -> Iterator[tuple[int, str, str, list[int]]]:
+    """Vectorized equivalent of iter_alleles and the counting in process_chromosome.
+
+    GT, DP, GQ and AD of all samples of a record are parsed into numpy arrays (see SampleColumns),
+    the filters and the XX/XY hemizygous rules are applied as masks and the counts are summed per
+    allele and sex. Yields (pos, ref, alt, sums) with sums in the order of AGGREGATED_PILE_COLUMNS.
+
+    Partially missing genotypes (e.g. ./1) are counted for the known allele (iter_alleles fails on them).
+    """
+    min_DP = filter_values["min_DP"]
+    min_GQ = filter_values["min_GQ"]
+    min_AB = filter_values["min_AB"]
+
+    is_XY = np.array([sex == "XY" for sex in sex_info.values()], dtype=bool)
+
+    is_chrX = region.contig in ("chrX", "X")
+    is_chrY = region.contig in ("chrY", "Y")
+    region_begin = region.begin or 0
+
+    for record in metrics.counted(records):
+
+        # GVCF blocks are not counted, but they tell which samples are covered (see iter_alleles)
+        if is_ref_block(record):
+            if coverage is not None:
+                coverage.add_block(record)
+            continue
+
+        if record.pos < region_begin:
+            continue
+
+        if coverage is not None:
+            coverage.add_variant(record)
+
+        alleles = record.alleles
+
+        # samples that are counted and samples counted as hemizygous
+        if is_chrY:
+            counted = is_XY if in_non_par_Y(record.pos) else np.zeros_like(is_XY)
+            hemi = counted
+        elif is_chrX:
+            counted = np.ones_like(is_XY)
+            hemi = is_XY if in_non_par_X(record.pos) else np.zeros_like(is_XY)
+        else:
+            counted = np.ones_like(is_XY)
+            hemi = np.zeros_like(is_XY)
+
+        columns = SampleColumns(record)
+        dp = columns.ints("DP")
+        counted = counted & (dp != MISSING)  # samples without DP are ignored
+        if not counted.any():
+            continue
+
+        GQ = columns.ints("GQ")
+        PASS = np.where(GQ == MISSING, 0, GQ) >= min_GQ
+
+        gt = columns.gt()
+        counted &= (gt[:, 2:] == NO_ALLELE).all(axis=1)  # TODO triploid or Multi-ploid... ?
+        a1, a2 = gt[:, 0], gt[:, 1]
+
+        # Allelic balance (AB) of allele a is AD[a - 1] / DP, 0 if AD is missing or DP is 0
+        AD = columns.ints("AD", len(alleles))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            AB = np.where((AD != MISSING) & (dp[:, None] > 0), AD / dp[:, None], 0)
+
+        def AB_pass(a: np.ndarray) -> np.ndarray:
+            return AB[np.arange(len(a)), np.maximum(a - 1, 0)] > min_AB
+
+        haploid = a2 == NO_ALLELE
+        known1, known2 = a1 > 0, a2 > 0  # alternative alleles
+        hom_alt = ~haploid & known1 & (a1 == a2)
+        het = ~hom_alt & (known1 | known2)  # includes multi allelic (two rows) and haploid alt
+        multi_het = het & known1 & known2
+        ref = ~(hom_alt | het)  # hom ref, missing or haploid ref (zero counts)
+
+        # Depending on the sex and chromosome het and hom counts are hemizygous counts
+        het_counts = np.where(hemi[:, None], (1, 0, 1), (1, 0, 0))
+        hom_alt_counts = np.where(hemi[:, None], (1, 0, 1), (2, 1, 0))
+        zero_counts = np.zeros_like(het_counts)
+        hemi_counts = np.broadcast_to((1, 0, 1), het_counts.shape)
+        het_allele = np.where(known1, a1, a2)
+
+        # one row per (sample, allele): (sample indices, allele indices, PASS, counts)
+        rows = []
+        for selection, allele, row_pass, counts in (
+            (ref, np.zeros_like(a1), PASS, zero_counts),
+            (hom_alt, a1, PASS, hom_alt_counts),
+            (het & haploid, a1, PASS, hemi_counts),
+            (het & ~haploid, het_allele, PASS & AB_pass(het_allele), het_counts),
+            (multi_het, a2, PASS & AB_pass(a2), het_counts),  # second allele of a1/a2
+        ):
+            selection = selection & counted
+            rows.append((np.flatnonzero(selection), allele[selection], row_pass[selection], counts[selection]))
+
+        samples = np.concatenate([r[0] for r in rows])
+        row_alleles = np.concatenate([r[1] for r in rows]).astype(np.int64)
+        row_pass = np.concatenate([r[2] for r in rows])
+        row_counts = np.concatenate([r[3] for r in rows]).astype(np.int64)
+        row_dp = dp[samples]
+
+        # DP filtering: (AC, AC_hom, AC_hemi) only for passing samples, n_DP_discarded for low DP
+        dp_ok = row_dp >= min_DP
+        row_counts[~(dp_ok & row_pass)] = 0
+        values = np.column_stack([row_counts, ~dp_ok, np.ones_like(row_dp), row_dp, row_dp * row_dp])
+
+        # sum per (allele, sex)
+        keys = row_alleles * 2 + is_XY[samples]
+        sums = np.zeros((2 * len(alleles), values.shape[1]), dtype=np.int64)
+        np.add.at(sums, keys, values)
+
+        for allele_index in np.flatnonzero(sums[0::2, 4] + sums[1::2, 4]):
+            alt = alleles[allele_index]
+            # Exclude allele that refers to a spanning deletion
+            if alt == "*":
+                continue
+            XX, XY = sums[2 * allele_index].tolist(), sums[2 * allele_index + 1].tolist()
+            yield record.pos, record.ref, alt, [
+                *XX[0:3],
+                *XY[0:3],
+                XX[3],
+                XY[3],
+                XX[4] + XY[4],
+                XX[5] + XY[5],
+                XX[6] + XY[6],
+            ]
+
+
 def get_AB(sample, allele_index_1: int) -> float:
     try:
         AD = sample["AD"]
@@ -204,39 +684,123 @@ def get_AB(sample, allele_index_1: int) -> float:
         return 0
 
 
-def merge_piles(dir_path: Path, debug: bool = False) -> None:
+def merge_piles(
+    dir_path: Path,
+    aggregated: bool = False,
+    debug: bool = False,
+    gvcf_sample_number: dict[Sex, int] | None = None,
+    threads: int = 1,
+    memory_limit: str | None = None,
+    temp_directory: Path | None = None,
+    streaming: bool = False,
+) -> None:
     """Combine parquet files (piles of variants) into a single file containing counts.
 
     This is the first merge operation done to produce count datasets in a single center.
+
+    Args:
+        aggregated: True if the piles were written by AggregatedPile (already summed per variant).
+        gvcf_sample_number: Number of XX and XY samples in gVCF input files. Samples of gVCF files that are not
+            covered at a variant position (see varpile.coverage) are counted in XX/XY_n_no_coverage, the coverage
+            of the region is written to COVERAGE_NAME (for varpile merge).
+        threads, memory_limit, temp_directory: duckdb settings (see connect), the spilled data of the region
+            is written into temp_directory/<region> and removed afterward.
+        streaming: Merge aggregated piles (sorted by key) with a streaming k-way merge (see kway_merge)
+            instead of a duckdb group by. The memory is bounded by a batch per pile, but it runs on a single core.
+            Regions with gVCF coverage are always merged with duckdb.
     """
-    file_glob: str = str(Path(dir_path) / "*" / "data.parquet")
+    # piles are in <dir_path>/<file name>/data.parquet or <dir_path>/<file name>/<shard>/data.parquet
+    file_glob: str = str(Path(dir_path) / "*" / "**" / "data.parquet")
     out_path: str = str(dir_path / "data.parquet")
-    rel = CON.query(
-        f"""
-        select 
-        pos, ref, alt,
-        XX_AC: sum(XX_AC)::int,
-        XX_AC_hom: sum(XX_AC_hom)::int,
-        XX_AC_hemi: sum(XX_AC_hemi)::int,
-        XY_AC: sum(XY_AC)::int,
-        XY_AC_hom: sum(XY_AC_hom)::int,
-        XY_AC_hemi: sum(XY_AC_hemi)::int,
-        -- DP stat counts
-        XX_n_DP_discarded: sum(XX_n_DP_discarded)::int, -- number of samples that are DP discarded
-        XY_n_DP_discarded: sum(XY_n_DP_discarded)::int, -- number of samples that are DP discarded
-        n_samples: count(*)::int,  -- total number of samples (this is for DP statistics)
-        DP_sum: sum(DP)::double,
-        DP2_sum: sum(DP**2)::double,
-        -- array_agg(DP) DPs, -- for debug
-        from read_parquet('{file_glob}', hive_partitioning = false)
-        group by pos, ref, alt
-        order by pos, ref, alt
-    """
-    )
-
-    rel.write_parquet(out_path, compression="ZSTD")
+    coverage_files = sorted(Path(dir_path).glob(f"*/**/{COVERAGE_NAME}"))
+    alleles_files = sorted(Path(dir_path).glob(f"*/**/{ALLELES_NAME}"))
+
+    if temp_directory is not None:
+        temp_directory = temp_directory / dir_path.name
+    with connect(threads, memory_limit, temp_directory) as con:
+        if streaming and aggregated and not (coverage_files and gvcf_sample_number):
+            with metrics.timed("streaming_merge"):
+                pile_paths = sorted(Path(dir_path).glob("*/**/data.parquet"))
+                merge_sorted(pile_paths, Path(out_path), AGGREGATED_PILE_COLUMNS, key_size=1, out_columns=COUNT_COLUMNS)
+        else:
+            _group_piles(con, file_glob, out_path, aggregated, coverage_files, gvcf_sample_number)
+        merge_alleles(con, alleles_files, dir_path / ALLELES_NAME)
+        if coverage_files and gvcf_sample_number:
+            with metrics.timed("region_coverage"):
+                write_region_coverage(con, coverage_files, dir_path / COVERAGE_NAME)
+    if temp_directory is not None:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+
+    metrics.add("rows", pq.ParquetFile(out_path).metadata.num_rows)
+    metrics.add("bytes_written", Path(out_path).stat().st_size)
 
     if not debug:
         for file in dir_path.iterdir():
             if file.is_dir():
                 shutil.rmtree(file)
+
+
+def _group_piles(
+    con: duckdb.DuckDBPyConnection,
+    file_glob: str,
+    out_path: str,
+    aggregated: bool,
+    coverage_files: list[Path],
+    gvcf_sample_number: dict[Sex, int] | None,
+) -> None:
+    """Sum the piles per variant with a duckdb group by (see merge_piles)."""
+    if aggregated:
+        DP_stats = """
+        n_samples: sum(n_samples)::int,
+        DP_sum: sum(DP_sum)::bigint,
+        DP2_sum: sum(DP2_sum)::bigint,"""
+    else:
+        DP_stats = """
+        n_samples: count(*)::int,  -- total number of samples (this is for DP statistics)
+        DP_sum: sum(DP)::bigint,
+        DP2_sum: sum(DP::bigint * DP)::bigint,"""
+
+    # number of gVCF samples without coverage at the variant positions (0 without gVCF input files)
+    positions = XX_no_coverage = XY_no_coverage = np.array([], dtype=np.int32)
+    if coverage_files and gvcf_sample_number:
+        with metrics.timed("coverage_at"):
+            positions = con.query(
+                f"select distinct pos: (key >> 32)::int from read_parquet('{file_glob}') order by pos"
+            ).fetchnumpy()["pos"]
+            XX_no_coverage, XY_no_coverage = no_coverage_at(positions, coverage_files, gvcf_sample_number)
+        XX_no_coverage, XY_no_coverage = XX_no_coverage.astype(np.int32), XY_no_coverage.astype(np.int32)
+    no_coverage = pa.table({"pos": positions, "XX_n_no_coverage": XX_no_coverage, "XY_n_no_coverage": XY_no_coverage})
+    con.register("no_coverage", no_coverage)
+
+    rel = con.query(
+        f"""
+        with counts as (
+            select
+            key,
+            XX_AC: sum(XX_AC)::int,
+            XX_AC_hom: sum(XX_AC_hom)::int,
+            XX_AC_hemi: sum(XX_AC_hemi)::int,
+            XY_AC: sum(XY_AC)::int,
+            XY_AC_hom: sum(XY_AC_hom)::int,
+            XY_AC_hemi: sum(XY_AC_hemi)::int,
+            -- DP stat counts
+            XX_n_DP_discarded: sum(XX_n_DP_discarded)::int, -- number of samples that are DP discarded
+            XY_n_DP_discarded: sum(XY_n_DP_discarded)::int, -- number of samples that are DP discarded
+            {DP_stats}
+            -- array_agg(DP) DPs, -- for debug
+            from read_parquet('{file_glob}', hive_partitioning = false)
+            group by key
+        )
+        select
+        counts.* exclude (n_samples, DP_sum, DP2_sum),
+        XX_n_no_coverage: coalesce(no_coverage.XX_n_no_coverage, 0)::int, -- gVCF samples without coverage
+        XY_n_no_coverage: coalesce(no_coverage.XY_n_no_coverage, 0)::int, -- gVCF samples without coverage
+        n_samples, DP_sum, DP2_sum,
+        from counts left join no_coverage on no_coverage.pos = (counts.key >> 32)::int
+        order by key
+    """
+    )
+
+    with metrics.timed("group_by_write"):
+        rel.write_parquet(out_path, compression="ZSTD")
+    con.unregister("no_coverage")
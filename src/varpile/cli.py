@@ -2,10 +2,14 @@
 
 import argparse
 from pathlib import Path
+from typing import get_args
 import logging
 
 from varpile import actions
+from varpile.actions.finalize_action import FinalizeEngine
+from varpile.allele_counts import Engine
 from varpile.errors import RegionError
+from varpile.sex_cache import CacheKeyMode
 
 from varpile.utils import Region1
 
@@ -21,6 +25,15 @@ class ParseRegion(argparse.Action):
         setattr(namespace, self.dest, regions)
 
 
+def parse_variant(value: str) -> tuple[str, int, str, str]:
+    """Parse a variant of the form chrom:pos:ref:alt."""
+    try:
+        chrom, pos, ref, alt = value.split(":")
+        return chrom, int(pos), ref, alt
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid variant: '{value}'. Expected format: chrom:pos:ref:alt")
+
+
 def make_parser() -> argparse.ArgumentParser:
     """Parses command-line arguments for the CLI."""
 
@@ -31,14 +44,30 @@ def make_parser() -> argparse.ArgumentParser:
     # Count action
     ###
     count_parser = subparsers.add_parser("count", help="Computes allele counts from VCF files")
-    count_parser.add_argument("paths", nargs="+", type=Path, help="Provide one or several paths to file or directory")
+    count_parser.add_argument(
+        "paths",
+        nargs="+",
+        type=Path,
+        help="Provide one or several paths to file or directory, - reads the standard input (implies --single-pass)",
+    )
     count_parser.add_argument("-o", "--output", type=Path, required=True, help="Specify the output directory path")
     count_parser.add_argument(
+        "--name",
+        help="Name of the dataset (e.g. the datacenter) recorded in info.json (default: output directory name)",
+    )
+    regions_group = count_parser.add_mutually_exclusive_group()
+    regions_group.add_argument(
         "-r",
         "--regions",
         action=ParseRegion,
         help="comma separated regions of form contig[:begin[-end]] (1-based) ",
     )
+    regions_group.add_argument(
+        "--regions-file",
+        type=Path,
+        help="BED file of target intervals (e.g. of an exome), overlapping intervals are merged and every contig "
+        "is counted into one region",
+    )
     count_parser.add_argument(
         "--min-DP", type=int, default=10, help="Variants with lower DP (depth) are discarded (default 10)"
     )
@@ -51,7 +80,103 @@ def make_parser() -> argparse.ArgumentParser:
         default=0.2,
         help="Heterozygote calls with lower AB (allelic bias) are discarded (default 0.2)",
     )
+    count_parser.add_argument(
+        "--sex-confidence",
+        type=float,
+        help="Stop sex inference once the sex of every sample is decided with this confidence (e.g. 0.999)",
+    )
+    count_parser.add_argument(
+        "--sex-windows",
+        type=int,
+        help="Infer sex from this number of evenly spaced 1Mb windows of chrX instead of the whole chromosome",
+    )
+    count_parser.add_argument(
+        "--sex-map", type=Path, help="TSV file (sample, XX|XY) with known sex of samples, skips the inference"
+    )
+    count_parser.add_argument(
+        "--sex-cache",
+        type=Path,
+        help="Cache inferred sex in this json file (created if missing), it can be shared between runs "
+        "(e.g. ~/.cache/varpile/sex_cache.json). Without it nothing is cached",
+    )
+    count_parser.add_argument(
+        "--sex-cache-key",
+        choices=get_args(CacheKeyMode),
+        default="stat",
+        help="Identify input files by path, size and mtime (stat) or by the hash of header and chrX index (content)",
+    )
     count_parser.add_argument("-@", "--threads", type=int, default=1, help="Number of threads to use (default 1)")
+    count_parser.add_argument(
+        "--shards",
+        type=int,
+        help="Split every region of a file into this number of shards (default: based on the size and threads)",
+    )
+    count_parser.add_argument(
+        "--decompression-threads",
+        type=int,
+        help="Extra threads decompressing the input file of every task, -@ is split between the tasks and their "
+        "decompression threads (default: the threads not needed by the tasks, e.g. when there are few input files)",
+    )
+    count_parser.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="Read every input file once from start to end (one task per file) instead of fetching every region "
+        "from the index, input files don't need an index",
+    )
+    count_parser.add_argument(
+        "--max-batch-files",
+        type=int,
+        help="Small files of a region are counted together by one task (into one pre-aggregated pile), "
+        "at most this number of files per task (default 256, 1 disables the batching)",
+    )
+    count_parser.add_argument(
+        "--pre-aggregate",
+        action="store_true",
+        help="Sum the counts per variant inside each worker, piles have one row per variant instead of one per sample",
+    )
+    count_parser.add_argument(
+        "--engine",
+        choices=get_args(Engine),
+        default="python",
+        help="python: count genotypes sample by sample, numpy: count all samples of a record at once "
+        "(faster for multi-sample files, implies --pre-aggregate)",
+    )
+    count_parser.add_argument(
+        "--merge-threads",
+        type=int,
+        help="Number of duckdb threads of a region merge (default: -@ divided by the number of workers)",
+    )
+    count_parser.add_argument(
+        "--merge-memory",
+        help="duckdb memory limit of a region merge, e.g. 4GB (default: 3/4 of the available memory divided by the number of workers)",
+    )
+    count_parser.add_argument(
+        "--merge-temp-dir",
+        type=Path,
+        help="Directory for data spilled by the region merge (default: <output>/.tmp)",
+    )
+    count_parser.add_argument(
+        "--streaming-merge",
+        action="store_true",
+        help="Merge pre-aggregated piles with a single core streaming sorted merge (memory bounded by a batch per "
+        "pile) instead of the duckdb group by",
+    )
+    count_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted count in the output directory, finished files/regions are not counted again",
+    )
+    count_parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="Write per task metrics (wall/CPU time, records, rows, bytes, peak RSS, step timings) to metrics.json",
+    )
+    count_parser.add_argument(
+        "--profile",
+        type=int,
+        metavar="N",
+        help="Profile the tasks with cProfile and keep the dumps of the N slowest in <output>/.profiles (implies --metrics)",
+    )
     count_parser.add_argument("--debug", action="store_true", help="Enable debug mode that preserves per sample output")
     count_parser.add_argument(
         "-v", action="count", default=0, help="Increase verbosity level (use -v, -vv, -vvv for more detailed logging)"
@@ -61,6 +186,17 @@ def make_parser() -> argparse.ArgumentParser:
     # Merge action
     ###
     merge_parser = subparsers.add_parser("merge", help="Merge multiple count datasets into one")
+    merge_parser.add_argument("paths", type=Path, nargs="+", help="Count datasets (output of count or merge)")
+    merge_parser.add_argument("-o", "--output", type=Path, help="Output directory (default: the --into dataset)")
+    merge_parser.add_argument(
+        "--into",
+        type=Path,
+        help="Existing (merged) dataset to add the datasets to, only regions present in the new datasets are merged",
+    )
+    merge_parser.add_argument("-@", "--threads", type=int, default=1, help="Number of threads to use (default 1)")
+    merge_parser.add_argument(
+        "-v", action="count", default=0, help="Increase verbosity level (use -v, -vv, -vvv for more detailed logging)"
+    )
 
     ###
     # Finalize action
@@ -70,6 +206,44 @@ def make_parser() -> argparse.ArgumentParser:
     finalize_parser.add_argument("-o", "--output", type=Path, required=True, help="Output directory")
     finalize_parser.add_argument("-@", "--threads", type=int, default=1, help="Number of threads to use (default 1)")
     finalize_parser.add_argument(
+        "--bin-size",
+        type=int,
+        default=None,
+        help="Partition the result of each region into files of bins of BIN_SIZE positions "
+        "(<region>/result/bin=<pos // BIN_SIZE>/, hive partitioning), default: one result.parquet per region",
+    )
+    finalize_parser.add_argument(
+        "--engine",
+        choices=get_args(FinalizeEngine),
+        default="duckdb",
+        help="duckdb: finalize the regions one after the other, each with all threads, "
+        "process: a single-threaded process per region (default duckdb)",
+    )
+    finalize_parser.add_argument(
+        "-v", action="count", default=0, help="Increase verbosity level (use -v, -vv, -vvv for more detailed logging)"
+    )
+
+    ###
+    # Query action
+    ###
+    query_parser = subparsers.add_parser("query", help="Look up variants in a finalized dataset (TSV output)")
+    query_parser.add_argument("path", type=Path, help="Finalized dataset")
+    query_parser.add_argument(
+        "variants", nargs="*", type=parse_variant, help="Variants of form chrom:pos:ref:alt (e.g. chr17:43044295:G:A)"
+    )
+    query_parser.add_argument(
+        "-r",
+        "--regions",
+        action=ParseRegion,
+        help="comma separated regions of form contig[:begin[-end]] (1-based), all variants in them",
+    )
+    query_parser.add_argument(
+        "--variants-file",
+        type=Path,
+        help="Variants to look up, a VCF/BCF file or a TSV file (no header) with columns chrom, pos, ref, alt",
+    )
+    query_parser.add_argument("-o", "--output", type=Path, help="Output TSV file (default: stdout)")
+    query_parser.add_argument(
         "-v", action="count", default=0, help="Increase verbosity level (use -v, -vv, -vvv for more detailed logging)"
     )
 
@@ -88,7 +262,8 @@ def configure_logging(verbosity: int):
 
 
 def main():
-    args = make_parser().parse_args()
+    parser = make_parser()
+    args = parser.parse_args()
     configure_logging(args.v)
     opt = args.__dict__
 
@@ -97,9 +272,13 @@ def main():
     if action == "count":
         actions.count(opt)
     elif action == "finalize":
-        actions.finalize(opt["path"], opt["output"], opt["threads"])
+        actions.finalize(opt["path"], opt["output"], opt["threads"], opt["bin_size"], opt["engine"])
     elif action == "merge":
-        raise NotImplementedError()
+        if opt["output"] is None and opt["into"] is None:
+            parser.error("merge: -o/--output is required (unless merging --into an existing dataset)")
+        actions.merge(opt["paths"], opt["output"], opt["threads"], into=opt["into"])
+    elif action == "query":
+        actions.query(opt["path"], opt["variants"], opt["regions"], opt["variants_file"], opt["output"])
 
 
 if __name__ == "__main__":
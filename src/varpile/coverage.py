@@ -0,0 +1,190 @@
+"""
+Coverage of gVCF samples at variant positions.
+
+In a gVCF file the positions without a variant are covered by reference blocks (ALT is <NON_REF>,
+the block ends at INFO/END). A sample of a gVCF file that has neither a variant record nor a reference
+block (passing the DP/GQ filters) at a position is not called there, so it must not contribute to AN.
+
+Blocks can be megabases long, so they are never expanded per base. For each input file (and region)
+we write the covered intervals with the number of covering samples per sex (CoveragePile).
+When the piles of a region are merged, the number of covering samples at the variant positions is
+computed with a sweep over the sorted interval endpoints (coverage_at): the number of intervals that
+begin at or before a position minus the number of intervals that end before it.
+
+The summed coverage of all files is kept in the count dataset (COVERAGE_NAME in the region directory, see
+write_region_coverage), so that `varpile merge` can compute the samples without coverage of a dataset at the
+positions of variants that only other datasets have.
+"""
+
+from pathlib import Path
+from typing import ClassVar
+
+import duckdb
+import numpy as np
+import pyarrow.parquet as pq
+import pysam
+
+from varpile.infer_sex import SamplesSex
+from varpile.utils import OutFile, Region1
+
+GVCF_REF_BLOCK_ALLELE = "<NON_REF>"
+COVERAGE_NAME = "coverage.parquet"  # next to data.parquet of a pile or of a region of a count dataset
+
+# 1-based closed interval [begin, end] and the number of covering samples per sex
+COVERAGE_COLUMNS = {
+    "begin": "INT",
+    "end": "INT",
+    "XX_n": "INT",
+    "XY_n": "INT",
+}
+
+
+def is_ref_block(record: pysam.VariantRecord) -> bool:
+    """Return True if the record is a gVCF reference block."""
+    return len(record.alleles) > 1 and record.alleles[1] == GVCF_REF_BLOCK_ALLELE
+
+
+def is_gvcf(header: pysam.VariantHeader) -> bool:
+    """Return True if the header declares the <NON_REF> allele (gVCF file)."""
+    return GVCF_REF_BLOCK_ALLELE.strip("<>") in header.alts
+
+
+class CoveragePile:
+    """Writes the intervals (clipped to the region) covered by the samples of a gVCF file.
+
+    A sample covers a reference block if the block passes the DP and GQ filters (the minimum DP of the block,
+    MIN_DP, is used when present). A variant record covers its position for all samples, they are
+    accounted for by the variant pile (counts or n_DP_discarded).
+    Adjacent intervals with the same counts are joined, a position is covered once per file (records at the same
+    position, e.g. split multi-allelic variants, don't add the samples again).
+    """
+
+    columns: ClassVar[dict] = COVERAGE_COLUMNS
+
+    def __init__(self, out_file: OutFile, region: Region1, sex_info: SamplesSex, min_DP: int, min_GQ: int):
+        self.out_file = out_file
+        self.region_begin = region.begin or 1
+        self.region_end = region.end or np.iinfo(np.int32).max
+        self.sex_list = list(sex_info.values())
+        self.n_samples = (self.sex_list.count("XX"), self.sex_list.count("XY"))
+        self.min_DP = min_DP
+        self.min_GQ = min_GQ
+        self._interval: list[int] | None = None  # [begin, end, XX_n, XY_n] not written yet
+
+    def add_block(self, record: pysam.VariantRecord) -> None:
+        XX_n = XY_n = 0
+        dp_field = "MIN_DP" if "MIN_DP" in record.format else "DP"
+        for sex, sample in zip(self.sex_list, record.samples.values()):
+            try:
+                dp = int(sample[dp_field])
+            except Exception:  # noqa (missing DP)
+                continue
+            try:
+                GQ = int(sample["GQ"])
+            except Exception:  # noqa
+                GQ = 0
+
+            if dp >= self.min_DP and GQ >= self.min_GQ:
+                if sex == "XX":
+                    XX_n += 1
+                else:
+                    XY_n += 1
+
+        self._add(record.pos, record.stop, XX_n, XY_n)
+
+    def add_variant(self, record: pysam.VariantRecord) -> None:
+        self._add(record.pos, record.pos, *self.n_samples)
+
+    def _add(self, begin: int, end: int, XX_n: int, XY_n: int) -> None:
+        begin, end = max(begin, self.region_begin), min(end, self.region_end)
+        if begin > end or XX_n + XY_n == 0:
+            return
+
+        interval = self._interval
+        if interval is not None and begin <= interval[1]:
+            return  # already covered by the samples of this file (records are sorted, blocks don't overlap)
+        if interval is not None and interval[1] + 1 == begin and interval[2:] == [XX_n, XY_n]:
+            interval[1] = end
+            return
+
+        self.flush()
+        self._interval = [begin, end, XX_n, XY_n]
+
+    def flush(self) -> None:
+        if self._interval is not None:
+            self.out_file.write_row(self._interval)
+            self._interval = None
+
+
+def coverage_at(positions: np.ndarray, coverage_files: list[Path]) -> tuple[np.ndarray, np.ndarray]:
+    """Number of covering (XX, XY) samples at the positions, summed over the coverage files.
+
+    Files are processed one by one, so the memory is bounded by the largest file.
+    """
+    XX_covered = np.zeros(len(positions), dtype=np.int64)
+    XY_covered = np.zeros(len(positions), dtype=np.int64)
+    for path in coverage_files:
+        intervals = pq.read_table(path, columns=list(COVERAGE_COLUMNS))
+        begin = intervals["begin"].to_numpy()
+        end = intervals["end"].to_numpy()
+        XX_covered += _sweep(positions, begin, end, intervals["XX_n"].to_numpy())
+        XY_covered += _sweep(positions, begin, end, intervals["XY_n"].to_numpy())
+    return XX_covered, XY_covered
+
+
+def no_coverage_at(
+    positions: np.ndarray, coverage_files: list[Path], gvcf_sample_number: dict[str, int]
+) -> tuple[np.ndarray, np.ndarray]:
+    """Number of (XX, XY) gVCF samples that are not covered at the positions (see coverage_at).
+
+    Raises:
+        ValueError: If more samples cover a position than there are gVCF samples (a sample counted twice).
+    """
+    XX_covered, XY_covered = coverage_at(positions, coverage_files)
+    XX_no_coverage = gvcf_sample_number.get("XX", 0) - XX_covered
+    XY_no_coverage = gvcf_sample_number.get("XY", 0) - XY_covered
+    if np.any(XX_no_coverage < 0) or np.any(XY_no_coverage < 0):
+        raise ValueError(f"More covering samples than gVCF samples {gvcf_sample_number} in {coverage_files}")
+    return XX_no_coverage, XY_no_coverage
+
+
+def write_region_coverage(con: duckdb.DuckDBPyConnection, coverage_files: list[Path], out_path: Path) -> None:
+    """Write the sum of the coverage files as intervals with constant counts (begin, end, XX_n, XY_n).
+
+    The counts change only at the begin of an interval or after its end: the counts are summed per change
+    position and accumulated in position order. Intervals without covered samples are left out.
+    """
+    files = [str(path) for path in coverage_files]
+    con.query(
+        f"""
+        with changes as (
+            select pos, sum(XX_n) as XX_n, sum(XY_n) as XY_n
+            from (
+                select "begin"::bigint as pos, XX_n, XY_n from read_parquet({files})
+                union all
+                select "end"::bigint + 1 as pos, -XX_n, -XY_n from read_parquet({files})
+            )
+            group by pos
+            having sum(XX_n) != 0 or sum(XY_n) != 0
+        ), steps as (
+            select
+            "begin": pos,
+            "end": lead(pos) over (order by pos) - 1,
+            XX_n: sum(XX_n) over (order by pos rows unbounded preceding),
+            XY_n: sum(XY_n) over (order by pos rows unbounded preceding),
+            from changes
+        )
+        select "begin"::int as "begin", "end"::int as "end", XX_n::int as XX_n, XY_n::int as XY_n
+        from steps where XX_n != 0 or XY_n != 0
+        order by "begin"
+        """
+    ).write_parquet(str(out_path), compression="ZSTD")
+
+
+def _sweep(positions: np.ndarray, begin: np.ndarray, end: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Sum of the weights of the closed intervals [begin, end] that contain each position."""
+    order = np.argsort(begin, kind="stable")
+    begun = np.concatenate([[0], np.cumsum(weights[order])])[np.searchsorted(begin[order], positions, side="right")]
+    order = np.argsort(end, kind="stable")
+    ended = np.concatenate([[0], np.cumsum(weights[order])])[np.searchsorted(end[order], positions, side="left")]
+    return begun - ended
@@ -4,3 +4,7 @@ class RegionError(ValueError):
 
 class VariantFileError(ValueError):
     pass
+
+
+class DatasetError(ValueError):
+    pass
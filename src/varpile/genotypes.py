@@ -0,0 +1,164 @@
+"""
+Extract the genotypes (and other FORMAT fields) of all samples of a record as numpy arrays.
+
+Going through record.samples creates a python object for each sample and a dictionary lookup
+for each field, which dominates the runtime for multi-sample vcf files.
+Instead, we format the record as a vcf line (done by htslib) and parse the sample columns with numpy.
+
+GT is always the first FORMAT field (VCF specification), so in the common case
+(single digit allele indices, diploid or haploid) every allele is at a fixed offset from the
+beginning of the sample column. Records that don't fit this fast path (e.g. allele index >= 10,
+polyploid genotypes) fall back to pysam.
+Integer fields (DP, GQ, AD, ...) are located using the positions of ':' and ',' separators
+and parsed digit by digit for all samples at once.
+"""
+
+import numpy as np
+import pysam
+
+MISSING = -1  # allele or value is '.' (or not present)
+NO_ALLELE = -2  # padding, e.g. second allele of a haploid genotype
+
+_TAB, _NEWLINE, _COLON, _COMMA, _DOT = (ord(c) for c in "\t\n:,.")
+_PHASED, _UNPHASED = ord("|"), ord("/")
+_ZERO = ord("0")
+_MAX_DIGITS = 18  # larger values don't fit into int64
+
+
+class SampleColumns:
+    """Sample columns of a record, formatted as a vcf line."""
+
+    def __init__(self, record: pysam.VariantRecord) -> None:
+        self.record = record
+        self.format: list[str] = list(record.format.keys())
+
+        text = str(record).encode()
+        # pad the line, so that we can look a few characters past the last sample column
+        self.line = np.frombuffer(text + b"\n\n\n", dtype=np.uint8)
+
+        tabs = np.flatnonzero(self.line == _TAB)
+        self.starts = tabs[8:] + 1  # first character of the sample columns
+        # tab (or newline) after the sample columns
+        self.ends = np.append(tabs[9:], len(text) - 1)[: len(self.starts)]
+
+        sample_section = self.line[self.starts[0] :] if len(self.starts) else self.line[:0]
+        offset = self.starts[0] if len(self.starts) else 0
+        self._colons = np.flatnonzero(sample_section == _COLON) + offset
+        self._commas = np.flatnonzero(sample_section == _COMMA) + offset
+        self._first_colon = np.searchsorted(self._colons, self.starts)
+        self._n_colons = np.searchsorted(self._colons, self.ends) - self._first_colon
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def gt(self) -> np.ndarray:
+        """Return the GT of all samples as an int array of shape (n_samples, ploidy), see gt_array."""
+        gt = self._parse_gt()
+        if gt is None:
+            gt = _pysam_gt(self.record)
+        return gt
+
+    def ints(self, field: str, n_values: int | None = None) -> np.ndarray:
+        """Parse an integer FORMAT field of all samples, missing values are MISSING.
+
+        Args:
+            field: Name of the FORMAT field.
+            n_values: If None, the field has a single value and the result has shape (n_samples,),
+                otherwise the field is a list and the result has shape (n_samples, n_values).
+        """
+        shape = (len(self),) if n_values is None else (len(self), n_values)
+        if field not in self.format:
+            return np.full(shape, MISSING, dtype=np.int64)
+
+        begin, end = self._field_bounds(self.format.index(field))
+        if n_values is None:
+            return self._parse_ints(begin, end)
+
+        # split the field on ',' (values that are not present are missing)
+        first_comma = np.searchsorted(self._commas, begin)
+        n_commas = np.searchsorted(self._commas, end) - first_comma
+        commas = np.append(self._commas, 0)  # padding, so that we can index past the last comma
+        values = np.empty(shape, dtype=np.int64)
+        for j in range(n_values):
+            value_begin = begin if j == 0 else commas[np.minimum(first_comma + j - 1, len(commas) - 1)] + 1
+            value_end = np.where(j < n_commas, commas[np.minimum(first_comma + j, len(commas) - 1)], end)
+            present = j <= n_commas
+            values[:, j] = np.where(present, self._parse_ints(np.where(present, value_begin, end), value_end), MISSING)
+        return values
+
+    def _field_bounds(self, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Offsets [begin, end) of the k-th FORMAT field of every sample (empty if the field is not present)."""
+        colons = np.append(self._colons, 0)  # padding, so that we can index past the last colon
+        if k == 0:
+            begin = self.starts
+        else:
+            begin = colons[np.minimum(self._first_colon + k - 1, len(colons) - 1)] + 1
+        end = np.where(k < self._n_colons, colons[np.minimum(self._first_colon + k, len(colons) - 1)], self.ends)
+        present = k <= self._n_colons  # trailing fields can be dropped
+        return np.where(present, begin, self.ends), np.where(present, end, self.ends)
+
+    def _parse_ints(self, begin: np.ndarray, end: np.ndarray) -> np.ndarray:
+        """Parse the non-negative integers line[begin:end], anything else is MISSING."""
+        width = end - begin
+        max_width = min(int(width.max(initial=0)), _MAX_DIGITS)
+        value = np.zeros(len(begin), dtype=np.int64)
+        numeric = (width > 0) & (width <= _MAX_DIGITS)
+        for j in range(max_width):
+            inside = j < width
+            digit = self.line[np.minimum(begin + j, len(self.line) - 1)].astype(np.int64) - _ZERO
+            numeric &= ~inside | ((digit >= 0) & (digit <= 9))
+            value = np.where(inside, value * 10 + digit, value)
+        return np.where(numeric, value, MISSING)
+
+    def _parse_gt(self) -> np.ndarray | None:
+        """Parse GT of all samples from the text representation, None if the fast path doesn't apply."""
+        if not self.format or self.format[0] != "GT":
+            return None
+
+        line, starts = self.line, self.starts
+        first, separator, second, after = line[starts], line[starts + 1], line[starts + 2], line[starts + 3]
+        haploid = _is_end(separator)
+        diploid = ((separator == _PHASED) | (separator == _UNPHASED)) & _is_end(after)
+
+        if not np.all(haploid | diploid) or not np.all(_is_allele(first)) or not np.all(_is_allele(second) | haploid):
+            return None  # multi digit allele index or polyploid genotype
+
+        gt = np.empty((len(starts), 2), dtype=np.int16)
+        gt[:, 0] = _allele_index(first)
+        gt[:, 1] = np.where(haploid, NO_ALLELE, _allele_index(second))
+
+        # pysam reports allele indices that don't exist in the record as missing
+        gt[gt >= len(self.record.alleles)] = MISSING
+        return gt
+
+
+def gt_array(record: pysam.VariantRecord) -> np.ndarray:
+    """Return the GT of all samples as an int array of shape (n_samples, ploidy).
+
+    Ploidy is at least 2, missing alleles are MISSING and haploid genotypes are padded with NO_ALLELE.
+    """
+    if not record.format.keys() or record.format.keys()[0] != "GT":
+        return _pysam_gt(record)
+    return SampleColumns(record).gt()
+
+
+def _pysam_gt(record: pysam.VariantRecord) -> np.ndarray:
+    genotypes = [sample.allele_indices for sample in record.samples.values()]
+    ploidy = max(2, *map(len, genotypes)) if genotypes else 2
+    gt = np.full((len(genotypes), ploidy), NO_ALLELE, dtype=np.int16)
+    for i, alleles in enumerate(genotypes):
+        for j, allele in enumerate(alleles):
+            gt[i, j] = MISSING if allele is None else allele
+    return gt
+
+
+def _is_end(c: np.ndarray) -> np.ndarray:
+    return (c == _COLON) | (c == _TAB) | (c == _NEWLINE)
+
+
+def _is_allele(c: np.ndarray) -> np.ndarray:
+    return (c == _DOT) | ((c >= _ZERO) & (c <= _ZERO + 9))
+
+
+def _allele_index(c: np.ndarray) -> np.ndarray:
+    return np.where(c == _DOT, MISSING, c.astype(np.int16) - _ZERO)
@@ -0,0 +1,268 @@
+"""
+Read the CSI/TBI index of a vcf file without opening the vcf file.
+
+htslib doesn't expose the content of the index (bins, chunks, number of records per contig),
+so we parse the index ourselves. Both formats are BGZF compressed (readable with gzip) and described in
+https://samtools.github.io/hts-specs/CSIv1.pdf and https://samtools.github.io/hts-specs/tabix.pdf
+
+A chunk is a pair of virtual file offsets (begin, end). The upper 48 bits of a virtual offset is
+the offset of the compressed BGZF block in the file and the lower 16 bits the offset inside the
+uncompressed block, so chunks can be used to estimate how many (uncompressed) bytes of the vcf file
+belong to a contig or a genomic bin.
+"""
+
+import gzip
+import math
+import statistics
+import struct
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pysam
+
+from varpile.errors import VariantFileError
+from varpile.utils import Region1
+
+Chunk = tuple[int, int]  # (begin, end) virtual file offsets
+
+INDEX_EXTENSIONS = (".csi", ".tbi")
+
+BGZF_BLOCK_SIZE = 65280  # maximum number of uncompressed bytes in a BGZF block
+
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+
+
+@dataclass
+class ContigIndex:
+    """Index of a single contig."""
+
+    bins: dict[int, list[Chunk]] = field(default_factory=dict)  # bin number -> chunks (without the pseudo bin)
+    n_records: int | None = None  # number of records (from the pseudo bin, if present)
+
+    @property
+    def chunks(self) -> list[Chunk]:
+        """All chunks of the contig sorted by begin offset."""
+        return sorted(chunk for chunks in self.bins.values() for chunk in chunks)
+
+
+@dataclass
+class Index:
+    min_shift: int
+    depth: int
+    contigs: dict[str, ContigIndex]
+    compression_ratio: float = 1.0  # uncompressed bytes per compressed byte (estimated from the chunks)
+
+    def estimate_compression_ratio(self) -> None:
+        """Estimate the compression ratio from the typical distance between BGZF blocks."""
+        block_offsets = sorted({offset >> 16 for c in self.contigs.values() for chunk in c.chunks for offset in chunk})
+        block_sizes = [b - a for a, b in zip(block_offsets, block_offsets[1:])]
+        if block_sizes:
+            self.compression_ratio = BGZF_BLOCK_SIZE / statistics.median(block_sizes)
+
+    def chunk_size(self, chunk: Chunk) -> float:
+        """Approximate number of uncompressed bytes in the chunk."""
+        begin, end = chunk
+        return max(0.0, ((end >> 16) - (begin >> 16)) * self.compression_ratio + (end & 0xFFFF) - (begin & 0xFFFF))
+
+    def bin_region(self, bin_number: int) -> tuple[int, int]:
+        """Return the 0-based half-open genomic interval [begin, end) covered by the bin."""
+        level, first = 0, 0
+        while bin_number >= first + (1 << (3 * level)):
+            first += 1 << (3 * level)
+            level += 1
+        size = 1 << (self.min_shift + 3 * (self.depth - level))
+        begin = (bin_number - first) * size
+        return begin, begin + size
+
+    @property
+    def pseudo_bin(self) -> int:
+        return ((1 << (3 * (self.depth + 1))) - 1) // 7 + 1
+
+    def region_size(self, region: Region1) -> int:
+        """Approximate number of (uncompressed) bytes of the records in the region.
+
+        Chunks of bins that partially overlap the region are weighted by the overlapping fraction of the bin.
+        """
+        contig = self.contigs.get(region.contig)
+        if contig is None:
+            return 0
+
+        return round(sum(self._bin_sizes(contig, region).values()))
+
+    def split_region(self, region: Region1, n: int) -> list[Region1]:
+        """Split the region into (at most) n shards with about the same number of bytes.
+
+        The size of a bin is spread evenly over the bases of the bin, shard boundaries are
+        rounded to the boundaries of the smallest bins (2**min_shift bases).
+        """
+        contig = self.contigs.get(region.contig)
+        if n <= 1 or contig is None:
+            return [region]
+
+        # sweep over the bin boundaries, the size per base (density) changes only at the bin boundaries
+        events: dict[int, float] = defaultdict(float)
+        total = 0.0
+        for (begin0, end0), size in self._bin_sizes(contig, region).items():
+            events[begin0] += size / (end0 - begin0)
+            events[end0] -= size / (end0 - begin0)
+            total += size
+
+        window_size = 1 << self.min_shift
+        targets = [total * i / n for i in range(1, n)]
+        boundaries = set()  # 1-based begin positions of the shards (except the first one)
+        density = cumulative = 0.0
+        previous = min(events, default=0)
+        for position in sorted(events):
+            segment = density * (position - previous)
+            while targets and segment > 0 and cumulative + segment >= targets[0]:
+                target_position = previous + (targets.pop(0) - cumulative) / density
+                boundaries.add(round(target_position / window_size) * window_size + 1)
+            cumulative += segment
+            density += events[position]
+            previous = position
+
+        first = region.begin or 1
+        last = math.inf if region.end is None else region.end
+        begins = [first] + sorted(b for b in boundaries if first < b <= last)
+        ends = [b - 1 for b in begins[1:]] + [region.end]
+        return [Region1(region.contig, begin, end) for begin, end in zip(begins, ends)]
+
+    def _bin_sizes(self, contig: ContigIndex, region: Region1) -> dict[tuple[int, int], float]:
+        """Size of the bins that overlap the region keyed by the 0-based interval of the bin (clipped to the region).
+
+        Bins that partially overlap the region are weighted by the overlapping fraction of the bin.
+        """
+        region_begin0 = 0 if region.begin is None else region.begin - 1
+        region_end0 = math.inf if region.end is None else region.end
+
+        # Large bins can extend past the end of the contig, don't spread their size past the last leaf bin
+        first_leaf_bin = ((1 << (3 * self.depth)) - 1) // 7
+        leaf_ends = [self.bin_region(b)[1] for b in contig.bins if b >= first_leaf_bin]
+        region_end0 = min(region_end0, max(leaf_ends, default=math.inf))
+
+        sizes: dict[tuple[int, int], float] = defaultdict(float)
+        for bin_number, chunks in contig.bins.items():
+            bin_begin, bin_end = self.bin_region(bin_number)
+            begin0, end0 = max(bin_begin, region_begin0), min(bin_end, region_end0)
+            if end0 > begin0:
+                chunks_size = sum(self.chunk_size(chunk) for chunk in chunks)
+                sizes[(begin0, end0)] += chunks_size * (end0 - begin0) / (bin_end - bin_begin)
+        return sizes
+
+
+def find_index(vcf_path: Path | str) -> Path | None:
+    """Return the path of the index of the vcf file (None if not found)."""
+    for ext in INDEX_EXTENSIONS:
+        path = Path(f"{vcf_path}{ext}")
+        if path.exists():
+            return path
+    return None
+
+
+def read_file_index(vcf_path: Path) -> Index | None:
+    """Read the index of the vcf file (contig names are taken from the vcf header)."""
+    with pysam.VariantFile(str(vcf_path)) as f:
+        contig_names = list(f.header.contigs)
+    return read_index(vcf_path, contig_names)
+
+
+def region_sizes(vcf_path: Path, regions: list[Region1]) -> dict[Region1, int]:
+    """Approximate size of the regions in the vcf file (0 if the file is not indexed), used to order the tasks."""
+    index = read_file_index(vcf_path)
+    return {region: 0 if index is None else index.region_size(region) for region in regions}
+
+
+def split_region(vcf_path: Path, region: Region1, n: int) -> list[Region1]:
+    """Split the region into (at most) n shards of similar size, see Index.split_region."""
+    index = read_file_index(vcf_path) if n > 1 else None
+    return [region] if index is None else index.split_region(region, n)
+
+
+def read_index(vcf_path: Path | str, contig_names: list[str]) -> Index | None:
+    """Read the CSI/TBI index of the vcf file.
+
+    Args:
+        vcf_path: Path to the (indexed) vcf file.
+        contig_names: Names of the contigs from the header in their order,
+            BCF indexes refer to contigs by their position in the header.
+
+    Returns:
+        The index or None if the file is not indexed.
+    """
+    index_path = find_index(vcf_path)
+    if index_path is None:
+        return None
+
+    with gzip.open(index_path, "rb") as f:
+        data = f.read()
+
+    try:
+        return _IndexReader(data).read(contig_names)
+    except (struct.error, IndexError) as e:
+        raise VariantFileError(f"Can't read the index '{index_path}': {e}") from e
+
+
+class _IndexReader:
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt: str) -> tuple:
+        values = struct.unpack_from("<" + fmt, self.data, self.offset)
+        self.offset += struct.calcsize("<" + fmt)
+        return values
+
+    def read(self, contig_names: list[str]) -> Index:
+        magic = self.data[:4]
+        self.offset = 4
+        if magic == b"CSI\x01":
+            min_shift, depth, l_aux = self.unpack("iii")
+            aux_end = self.offset + l_aux
+            names = self.read_tabix_names() if l_aux else contig_names
+            self.offset = aux_end
+            (n_ref,) = self.unpack("i")
+            is_csi = True
+        elif magic == b"TBI\x01":
+            min_shift, depth = TBI_MIN_SHIFT, TBI_DEPTH
+            (n_ref,) = self.unpack("i")
+            names = self.read_tabix_names()
+            is_csi = False
+        else:
+            raise VariantFileError(f"Unknown index format {magic!r}")
+
+        index = Index(min_shift, depth, contigs={})
+        pseudo_bin = index.pseudo_bin
+        for ref in range(n_ref):
+            contig = ContigIndex()
+            (n_bin,) = self.unpack("i")
+            for _ in range(n_bin):
+                if is_csi:
+                    bin_number, _loffset, n_chunk = self.unpack("IQi")
+                else:
+                    bin_number, n_chunk = self.unpack("Ii")
+                chunks = [self.unpack("QQ") for _ in range(n_chunk)]
+                if bin_number == pseudo_bin:
+                    # pseudo bin: (begin, end) offsets of the contig and (n_mapped, n_unmapped)
+                    contig.n_records = chunks[1][0]
+                else:
+                    contig.bins[bin_number] = chunks
+
+            if not is_csi:
+                (n_intv,) = self.unpack("i")
+                self.offset += 8 * n_intv  # skip the linear index
+
+            if ref < len(names):
+                index.contigs[names[ref]] = contig
+
+        index.estimate_compression_ratio()
+        return index
+
+    def read_tabix_names(self) -> list[str]:
+        # format, col_seq, col_beg, col_end, meta, skip, l_nm
+        *_, l_nm = self.unpack("iiiiiii")
+        names = self.data[self.offset : self.offset + l_nm]
+        self.offset += l_nm
+        return [name.decode() for name in names.split(b"\0") if name]
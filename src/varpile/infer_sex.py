@@ -26,12 +26,17 @@ chromosome:GRCh38:Y:57,217,416 - 57,227,415 is unique to Y
 156,040,895
 """
 
+import itertools
 import logging
 from pathlib import Path
+from statistics import NormalDist
 from typing import Literal
-import pysam
 
-from varpile.VariantFile import VariantFile
+import numpy as np
+
+from varpile import metrics
+from varpile.VariantFile import VariantFile, open_cached
+from varpile.genotypes import MISSING, NO_ALLELE, gt_array
 from varpile.utils import Region1
 
 logger = logging.getLogger(__name__)
@@ -72,65 +77,177 @@ SamplesSex = dict[str, Sex]
 
 FRACTION_LIMIT = 0.2  # 20 percent
 
+# Early stopping (confidence is not None): a sample is decided once at least MIN_INFORMATIVE_GENOTYPES
+# genotypes have been seen and the confidence interval of the het fraction is entirely on one side of FRACTION_LIMIT.
+MIN_INFORMATIVE_GENOTYPES = 100
+EARLY_STOP_CHECK_INTERVAL = 128  # check if all samples are decided every N records
+
+NON_PAR_REGION_ON_X = Region1("chrX", PAR1_END_1 + 1, PAR2_X_BEGIN_1 - 1)
+SEX_WINDOW_SIZE = 1_000_000  # size of the sub-windows when sampling the region (windows is not None)
+
+
+def sample_windows(region: Region1, windows: int, window_size: int = SEX_WINDOW_SIZE) -> list[Region1]:
+    """Split the region into evenly spaced sub-windows of size window_size.
+
+    If the windows would cover the whole region, the region itself is returned.
+
+    Examples:
+        >>> sample_windows(Region1("chrX", 1, 1000), 2, 100)
+        [Region1(contig='chrX', begin=201, end=300), Region1(contig='chrX', begin=701, end=800)]
+    """
+    length = region.end - region.begin + 1
+    if windows * window_size >= length:
+        return [region]
+
+    step = length // windows
+    margin = (step - window_size) // 2  # center the window inside its step
+    begins = [region.begin + i * step + margin for i in range(windows)]
+    return [Region1(region.contig, begin, begin + window_size - 1) for begin in begins]
+
+
+def het_fraction_interval(
+    het_events: np.ndarray, total: np.ndarray, confidence: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """Wilson score interval of the heterozygous fraction (for every sample)."""
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    n = np.maximum(total, 1)
+    p = het_events / n
+    denominator = 1 + z**2 / n
+    center = (p + z**2 / (2 * n)) / denominator
+    half_width = z / denominator * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2))
+    return center - half_width, center + half_width
+
+
+def is_decided(het_events: np.ndarray, hom_events: np.ndarray, confidence: float) -> np.ndarray:
+    """True for samples where the sex is known with the given confidence."""
+    total = het_events + hom_events
+    lower, upper = het_fraction_interval(het_events, total, confidence)
+    return (total >= MIN_INFORMATIVE_GENOTYPES) & ((upper < FRACTION_LIMIT) | (lower >= FRACTION_LIMIT))
+
+
+def count_X_genotypes(
+    f: VariantFile, confidence: float | None = None, windows: int | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """Count heterozygous and homozygous genotypes of every sample in the non-PAR region of chromosome X.
+
+    All samples are counted in a single pass over the region, the genotypes of a record are
+    extracted as an int array across the samples (see genotypes.gt_array).
+
+    Args:
+        f: The opened vcf file.
+        confidence: If given, stop reading once the sex of every sample is decided with this confidence
+            (e.g. 0.999), see is_decided.
+        windows: If given, read only this number of evenly spaced sub-windows of the region (using the index).
+            A file without an index is read from the start (see VariantFile.fetch_regions). If a sample has
+            fewer than MIN_INFORMATIVE_GENOTYPES genotypes in the windows, the whole region is read instead.
+
+    Returns:
+        Two arrays (het_events, hom_events) with one count per sample (in the header order).
+    """
+    metrics.add("samples", len(f.header.samples))
+    regions = [NON_PAR_REGION_ON_X] if windows is None else sample_windows(NON_PAR_REGION_ON_X, windows)
+    het_events, hom_events = _count_genotypes(f, regions, confidence)
+
+    if len(regions) > 1 and np.any(het_events + hom_events < MIN_INFORMATIVE_GENOTYPES):
+        logger.info(f"Not enough genotypes in {len(regions)} windows of chrX, reading the whole region")
+        het_events, hom_events = _count_genotypes(f, [NON_PAR_REGION_ON_X], confidence)
+
+    return het_events, hom_events
+
+
+def _count_genotypes(f: VariantFile, regions: list[Region1], confidence: float | None) -> tuple[np.ndarray, np.ndarray]:
+    """Count heterozygous and homozygous genotypes of every sample in the regions (see count_X_genotypes)."""
+    n_samples = len(f.header.samples)
+    het_events = np.zeros(n_samples, dtype=np.int64)
+    hom_events = np.zeros(n_samples, dtype=np.int64)
+
+    if f.is_indexed:
+        region_records = (f.fetch(region) for region in regions)
+    else:  # read the file from the start up to the end of chromosome X
+        region_records = (records for _, records in f.fetch_regions(regions))
+    records = metrics.counted(itertools.chain.from_iterable(region_records))
+
+    for i, r in enumerate(records, start=1):
+        if confidence is not None and i % EARLY_STOP_CHECK_INTERVAL == 0:
+            if np.all(is_decided(het_events, hom_events, confidence)):
+                logger.debug(f"Sex of all samples decided after {i} records")
+                break
+
+        gt = gt_array(r)
+        if gt.shape[1] > 2 and np.any(gt[:, 2:] != NO_ALLELE):
+            raise ValueError(
+                "Unexpected genotype format:", r.samples[int(np.flatnonzero(gt[:, 2] != NO_ALLELE)[0])]["GT"]
+            )
+
+        a, b = gt[:, 0], gt[:, 1]
+        haploid = b == NO_ALLELE
+        missing = (a == MISSING) & ((b == MISSING) | haploid)  # Ignore records with no genotype
+        diploid = ~missing & ~haploid
+
+        hom_events += diploid & (a == b)  # Count homozygous reference and alternative genotypes
+        het_events += diploid & (a != b)  # Treat other cases as heterozygous
+        het_events += ~missing & haploid & (a > 1)  # Treat hemizygous cases as heterozygous
+
+        unexpected = ~missing & haploid & (a <= 1)
+        if np.any(unexpected):
+            raise ValueError("Unexpected genotype format:", (int(a[np.flatnonzero(unexpected)[0]]),))
 
-def infer_sex(input_file: Path | str, sample_rank: int = 0) -> Sex:
+    return het_events, hom_events
+
+
+def sex_from_counts(het_event: int, hom_event: int, sample_name: str) -> Sex:
+    """Decide the sex of the sample based on the fraction of heterozygous genotypes."""
+
+    # In case there are no variants (chrX is missing for example)
+    # we can't divide by 0. Instead assume the sample is XX
+    total = hom_event + het_event
+    if total == 0:
+        logger.warning(f"Sex inference not possible, assume the sample '{sample_name}' is XX.")
+        return "XX"
+
+    het_fraction = het_event / total
+    if het_fraction < FRACTION_LIMIT:
+        return "XY"  # Male
+    else:
+        return "XX"  # Female
+
+
+def infer_sex(
+    input_file: Path | str, sample_rank: int = 0, confidence: float | None = None, windows: int | None = None
+) -> Sex:
     """Infer the sex ('XX' or 'XY') of the sample based on genotype data.
 
     This function analyzes the number of homozygous and heterozygous events
     in the non-PAR region of chromosome X to determine the sample's sex.
+    NOTE: to infer the sex of all samples in a file use infer_samples_sex (single pass over the file).
 
     Args:
         input_file (Path | str): Path to the VCF input file.
         sample_rank (int): The sample index within the VCF file to analyze. Defaults to 0.
+        confidence (float | None): Stop early once the sex is decided with this confidence (see count_X_genotypes).
+        windows (int | None): Only read this number of evenly spaced sub-windows of chrX (see count_X_genotypes).
 
     Returns:
         Sex: 'XX' if the sample is inferred to be female, or 'XY' if inferred to be male.
     """
 
-    with VariantFile(input_file) as f:
-
-        non_PAR_region_on_X = Region1("chrX", PAR1_END_1 + 1, PAR2_X_BEGIN_1 - 1)
-        X_non_par_region_iter = f.fetch(non_PAR_region_on_X)
-
-        hom_event = 0
-        het_event = 0
-        for r in X_non_par_region_iter:
-            s = r.samples[sample_rank]
-
-            match s["GT"]:
-                case (None,) | (None, None):
-                    continue  # Ignore records with no genotype
-                case (a, b) if a == b:
-                    if a > 0:
-                        hom_event += 1
-                    elif a == 0:
-                        # Count homozygous reference genotypes
-                        hom_event += 1
-                case (a, b):  # Treat other cases as heterozygous
-                    het_event += 1
-                case (a,) if a > 1:  # Treat hemizygous cases as heterozygous
-                    het_event += 1
-                case wtf:
-                    raise ValueError("Unexpected genotype format:", wtf)
-
-        # In case there are no variants (chrX is missing for example)
-        # we can't divide by 0. Instead assume the sample is XX
-        total = hom_event + het_event
-        if total == 0:
-            sample_name = f.header.samples[sample_rank]
-            logger.warning(f"Sex inference not possible, assume the sample '{sample_name}' is XX.")
-            return "XX"
-
-        het_fraction = het_event / total
-        if het_fraction < FRACTION_LIMIT:
-            return "XY"  # Male
-        else:
-            return "XX"  # Female
-
-
-def infer_samples_sex(input_file: Path | str) -> SamplesSex:
-    with pysam.VariantFile(str(input_file)) as vcf:
-        # get the samples in the file (we don't really need the names)
-        samples: list[str] = list(vcf.header.samples)
-        samples_sex = {sample: infer_sex(input_file, rank) for rank, sample in enumerate(samples)}
-        return samples_sex
+    f = open_cached(input_file)
+    het_events, hom_events = count_X_genotypes(f, confidence, windows)
+    sample_name = f.header.samples[sample_rank]
+    return sex_from_counts(int(het_events[sample_rank]), int(hom_events[sample_rank]), sample_name)
+
+
+def infer_samples_sex(
+    input_file: Path | str, confidence: float | None = None, windows: int | None = None, threads: int = 0
+) -> SamplesSex:
+    """Infer the sex of every sample in the file (single pass over the non-PAR region of chromosome X).
+
+    For confidence and windows see count_X_genotypes. threads are the decompression threads of the open file
+    (see open_cached).
+    """
+    f = open_cached(input_file, threads)
+    het_events, hom_events = count_X_genotypes(f, confidence, windows)
+    samples: list[str] = list(f.header.samples)
+    return {
+        sample: sex_from_counts(int(het), int(hom), sample) for sample, het, hom in zip(samples, het_events, hom_events)
+    }
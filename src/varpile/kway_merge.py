@@ -0,0 +1,74 @@
+"""
+Streaming merge of parquet files that are sorted by a key (e.g. pos, ref, alt).
+
+Rows with the same key are summed up. Files are read batch by batch and merged with heapq.merge,
+so the memory is bounded by the batch size (times the number of files) and not by the size of the files.
+"""
+
+import heapq
+from pathlib import Path
+from typing import Iterator, Sequence
+
+import pyarrow.parquet as pq
+
+from varpile.utils import OutFile
+
+BATCH_SIZE = 65_536  # rows read at once from each file
+
+
+def iter_rows(path: Path | str, columns: Sequence[str], batch_size: int = BATCH_SIZE) -> Iterator[tuple]:
+    """Iterate over the rows (tuples of the columns) of a parquet file."""
+    parquet_file = pq.ParquetFile(path)
+    if parquet_file.metadata.num_row_groups == 0:
+        return  # empty file (iter_batches fails on it)
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=list(columns)):
+        yield from zip(*(column.to_pylist() for column in batch.columns))
+
+
+def merge_sorted(
+    paths: Sequence[Path | str], out_path: Path, columns: dict, key_size: int = 3, out_columns: dict | None = None
+) -> int:
+    """Merge sorted parquet files into a single sorted file, summing the values of rows with the same key.
+
+    Args:
+        paths: Parquet files sorted by the first key_size columns (every key appears at most once per file).
+        out_path: The resulting parquet file.
+        columns: Columns of the files (name: duckdb SQL type), the first key_size columns are the key,
+            the remaining columns are summed.
+        key_size: Number of key columns.
+        out_columns: Columns of the resulting file (default: columns), in any order, columns that are not
+            in the input files are written as 0.
+
+    Returns:
+        Number of rows written.
+    """
+    streams = [iter_rows(path, columns) for path in paths]
+    n_rows = 0
+
+    out_columns = out_columns or columns
+    # index of every output column in the merged row (None for the columns missing in the input files)
+    indices = [list(columns).index(name) if name in columns else None for name in out_columns]
+    reorder = indices != list(range(len(columns)))
+
+    with OutFile(out_path, out_columns) as out_file:
+
+        def write_row(row: tuple) -> None:
+            out_file.write_row(tuple(0 if i is None else row[i] for i in indices) if reorder else row)
+
+        key, sums = None, None
+        for row in heapq.merge(*streams, key=lambda r: r[:key_size]):
+            row_key = row[:key_size]
+            if row_key == key:
+                sums = [a + b for a, b in zip(sums, row[key_size:])]
+                continue
+
+            if key is not None:
+                write_row((*key, *sums))
+                n_rows += 1
+            key, sums = row_key, row[key_size:]
+
+        if key is not None:
+            write_row((*key, *sums))
+            n_rows += 1
+
+    return n_rows
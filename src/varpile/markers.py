@@ -0,0 +1,43 @@
+"""
+Completion markers of count tasks, used to resume an interrupted `varpile count --resume`.
+
+A task (process_chromosome of a shard, merge_piles of a region) writes a marker file into its output
+directory once its output is complete. The marker contains a digest of everything the output depends
+on (input file, region, sex of the samples, filter values, ...), so a marker left by a run with
+different inputs is stale and the task is redone.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable
+
+MARKER_NAME = ".done"
+
+
+def digest(*values: Any) -> str:
+    """Return a digest of json serializable values (dictionaries are hashed independent of the key order)."""
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def is_done(dir_path: Path, task_digest: str) -> bool:
+    """Return True if the directory has a marker with the given digest."""
+    try:
+        return (dir_path / MARKER_NAME).read_text() == task_digest
+    except FileNotFoundError:
+        return False
+
+
+def mark_done(dir_path: Path, task_digest: str) -> None:
+    """Write the marker atomically (a partially written marker is never seen)."""
+    tmp_path = dir_path / f"{MARKER_NAME}.{os.getpid()}.tmp"
+    tmp_path.write_text(task_digest)
+    os.replace(tmp_path, dir_path / MARKER_NAME)
+
+
+def run_and_mark(dir_path: Path, task_digest: str, fn: Callable, *args, **kwargs) -> Any:
+    """Run fn(*args, **kwargs) and mark dir_path as done once it returns."""
+    result = fn(*args, **kwargs)
+    mark_done(dir_path, task_digest)
+    return result
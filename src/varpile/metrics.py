@@ -0,0 +1,197 @@
+"""
+Metrics of a count run (`varpile count --metrics`).
+
+Every task (sex inference of a file, process_chromosome of a shard, merge_piles of a region) runs in a
+worker through run_measured, which measures the wall and CPU time of the task and the peak RSS of the worker.
+While a task is measured, the instrumented code adds counters (records read, rows and bytes written) and
+timings of its steps with add, counted and timed. These are no-ops when no task is measured, so the
+counting code doesn't pay for the metrics when they are off.
+
+The parent (RunMetrics) collects the metrics of all tasks and writes them to metrics.json, optionally with
+cProfile dumps of the slowest tasks (see RunMetrics.profile_dir).
+"""
+
+import contextlib
+import cProfile
+import json
+import resource
+import time
+from collections import defaultdict
+from concurrent.futures import Executor, Future
+from dataclasses import asdict, dataclass, field, replace
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator
+
+from varpile.markers import run_and_mark
+from varpile.scheduler import Task
+
+METRICS_NAME = "metrics.json"
+PROFILES_DIR = ".profiles"  # hidden, so it is not mistaken for a region directory
+
+COUNTERS = ("records", "samples", "rows", "bytes_written")
+
+
+@dataclass
+class TaskMetrics:
+    name: str  # function of the task
+    labels: dict  # e.g. input file and region
+    wall_s: float = 0
+    cpu_s: float = 0
+    peak_rss_mb: float = 0  # of the worker process (since it started)
+    counters: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    timings: dict[str, float] = field(default_factory=lambda: defaultdict(float))  # seconds per step
+    profile: str | None = None
+
+
+_current: TaskMetrics | None = None  # metrics of the task running in this process
+
+
+def add(counter: str, value: int) -> None:
+    """Add value to a counter of the running task."""
+    if _current is not None:
+        _current.counters[counter] += value
+
+
+def counted(iterable: Iterable, counter: str = "records") -> Iterable:
+    """Return the iterable, counting its items into the counter if a task is measured."""
+    if _current is None:
+        return iterable
+    return _count_items(iterable, _current.counters, counter)
+
+
+def _count_items(iterable: Iterable, counters: dict, counter: str) -> Iterator:
+    for item in iterable:
+        counters[counter] += 1
+        yield item
+
+
+@contextlib.contextmanager
+def timed(step: str):
+    """Add the wall time of the block to the timing of the step."""
+    if _current is None:
+        yield
+        return
+    metrics = _current
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.timings[step] += time.perf_counter() - start
+
+
+def run_measured(name: str, labels: dict, profile_path: Path | None, fn: Callable, *args, **kwargs) -> tuple:
+    """Run fn(*args, **kwargs) in the worker, return its result and TaskMetrics (as dict).
+
+    If profile_path is given the task runs under cProfile and the stats are dumped to profile_path.
+    """
+    global _current
+    _current = metrics = TaskMetrics(name, labels)
+    profiler = cProfile.Profile() if profile_path is not None else None
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        if profiler is not None:
+            result = profiler.runcall(fn, *args, **kwargs)
+        else:
+            result = fn(*args, **kwargs)
+    finally:
+        _current = None
+
+    metrics.wall_s = time.perf_counter() - wall
+    metrics.cpu_s = time.process_time() - cpu
+    metrics.peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if profiler is not None:
+        profile_path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(profile_path)
+        metrics.profile = str(profile_path)
+    return result, asdict(metrics)
+
+
+class RunMetrics:
+    """Collects the metrics of the tasks of a run (in the parent process).
+
+    If profile is > 0, every task is profiled (dumped into profile_dir) and only the dumps of the
+    `profile` slowest tasks are kept when the metrics are written.
+    """
+
+    def __init__(self, enabled: bool, profile_dir: Path | None = None, profile: int = 0) -> None:
+        self.enabled = enabled or profile > 0
+        self.profile_dir = profile_dir if profile > 0 else None
+        self.n_profiles = profile
+        self.tasks: list[dict] = []
+        self.phases: dict[str, float] = {}  # wall time of the phases of the run (in the parent)
+        self._n_tasks = 0
+
+    def _wrap(self, name: str, labels: dict, fn: Callable, args: tuple) -> tuple[Callable, tuple]:
+        profile_path = None
+        if self.profile_dir is not None:
+            profile_path = self.profile_dir / f"{self._n_tasks:05d}_{name}.prof"
+        self._n_tasks += 1
+        return run_measured, (name, labels, profile_path, fn, *args)
+
+    def task(self, task: Task, **labels: Any) -> Task:
+        """Return the task that runs measured (the task itself if metrics are off), see result."""
+        if not self.enabled:
+            return task
+        # tasks of a resumable run are named by the function run_and_mark runs
+        name = task.args[2].__name__ if task.fn is run_and_mark else task.fn.__name__
+        fn, args = self._wrap(name, labels, task.fn, task.args)
+        return replace(task, fn=fn, args=args)
+
+    def submit(self, executor: Executor, fn: Callable, *args, labels: dict | None = None, **kwargs) -> Future:
+        """Submit fn to the executor (measured if metrics are on), see result."""
+        if not self.enabled:
+            return executor.submit(fn, *args, **kwargs)
+        fn, args = self._wrap(fn.__name__, labels or {}, fn, args)
+        return executor.submit(fn, *args, **kwargs)
+
+    def result(self, result: Any) -> Any:
+        """Return the result of a task (created by task or submit) and record its metrics."""
+        if not self.enabled:
+            return result
+        result, task_metrics = result
+        self.tasks.append(task_metrics)
+        return result
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    def summary(self) -> dict:
+        """Totals of the counters and timings per task name."""
+        by_name = {}
+        for task in self.tasks:
+            total = by_name.setdefault(
+                task["name"],
+                {"tasks": 0, "wall_s": 0.0, "cpu_s": 0.0, "max_wall_s": 0.0, "peak_rss_mb": 0.0, "genotypes": 0}
+                | {counter: 0 for counter in COUNTERS}
+                | {"timings": defaultdict(float)},
+            )
+            total["tasks"] += 1
+            total["wall_s"] += task["wall_s"]
+            total["cpu_s"] += task["cpu_s"]
+            total["max_wall_s"] = max(total["max_wall_s"], task["wall_s"])
+            total["peak_rss_mb"] = max(total["peak_rss_mb"], task["peak_rss_mb"])
+            total["genotypes"] += task["counters"].get("records", 0) * task["counters"].get("samples", 0)
+            for counter, value in task["counters"].items():
+                total[counter] = total.get(counter, 0) + value
+            for step, seconds in task["timings"].items():
+                total["timings"][step] += seconds
+        return by_name
+
+    def write(self, out_dir: Path) -> None:
+        """Write metrics.json into out_dir, keep only the profiles of the slowest tasks."""
+        if not self.enabled:
+            return
+
+        tasks = sorted(self.tasks, key=lambda task: task["wall_s"], reverse=True)
+        for task in tasks[self.n_profiles :]:
+            if task["profile"] is not None:
+                Path(task["profile"]).unlink(missing_ok=True)
+                task["profile"] = None
+
+        metrics = {"phases": self.phases, "summary": self.summary(), "tasks": tasks}
+        (out_dir / METRICS_NAME).write_text(json.dumps(metrics, indent=4))
@@ -0,0 +1,187 @@
+"""
+Lookup of variants in a finalized dataset (`varpile query`).
+
+    dataset = varpile.query.open("out_dir")
+    dataset.lookup("chr17", 43044295, "G", "A")  # dict of the result columns or None
+    dataset.region("chr17:43044000-43045000")  # pyarrow Table
+    dataset.lookup_many(read_variants("variants.vcf.gz"))  # the variants with their counts (null if not found)
+
+finalize writes the first and last position of every row group of a result into index.npy next to it (see
+write_index). The index is memory-mapped and a lookup finds the row groups of a position by binary
+search, so it reads only them. The parquet footers are read once per opened dataset.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
+import pyarrow.parquet as pq
+import pysam
+
+from varpile.errors import DatasetError
+from varpile.utils import Region1
+
+VARIANT_COLUMNS = ("chrom", "pos", "ref", "alt")
+VARIANT_SCHEMA = pa.schema([("chrom", pa.string()), ("pos", pa.int32()), ("ref", pa.string()), ("alt", pa.string())])
+VCF_SUFFIXES = (".vcf", ".vcf.gz", ".bcf")
+
+# layout of the result of a region in a finalized dataset
+RESULT_NAME = "result.parquet"
+BINNED_RESULT_NAME = "result"  # directory of the hive partitions (bin=<pos // bin_size>) of a binned result
+
+# index of the row groups of the result of a region, part is the file in result_files
+INDEX_NAME = "index.npy"
+INDEX_DTYPE = np.dtype([("part", "i4"), ("row_group", "i4"), ("min_pos", "i4"), ("max_pos", "i4")])
+
+
+def result_files(region_dir: Path) -> list[Path]:
+    """Return the parquet files of the result of a region (result.parquet or the bins) in position order."""
+    if (region_dir / RESULT_NAME).exists():
+        return [region_dir / RESULT_NAME]
+    paths = (region_dir / BINNED_RESULT_NAME).glob("bin=*/*.parquet")
+    return sorted(paths, key=lambda path: (int(path.parent.name.removeprefix("bin=")), path.name))
+
+
+def write_index(region_dir: Path) -> None:
+    """Write the first and last position of every row group of the result of the region (INDEX_NAME)."""
+    row_groups = []
+    for part, path in enumerate(result_files(region_dir)):
+        metadata = pq.read_metadata(path)
+        pos_column = metadata.schema.names.index("pos")
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            if row_group.num_rows > 0:
+                statistics = row_group.column(pos_column).statistics
+                row_groups.append((part, i, statistics.min, statistics.max))
+    np.save(region_dir / INDEX_NAME, np.array(row_groups, dtype=INDEX_DTYPE))
+
+
+class RegionResult:
+    """Result of a region of a finalized dataset with its row group index."""
+
+    def __init__(self, region: Region1, path: Path) -> None:
+        if not (path / INDEX_NAME).exists():
+            raise DatasetError(f"'{path}' has no {INDEX_NAME} (finalized by an older version), finalize it again")
+        self.region = region
+        self.files = result_files(path)
+        self.index = np.load(path / INDEX_NAME, mmap_mode="r")
+        self._parquet_files: dict[int, pq.ParquetFile] = {}
+
+    def contains(self, chrom: np.ndarray, pos: np.ndarray) -> np.ndarray:
+        """Return the mask of the positions in the region."""
+        begin = self.region.begin or 0
+        end = self.region.end or np.iinfo(np.int32).max
+        return (chrom == self.region.contig) & (begin <= pos) & (pos <= end)
+
+    def row_groups(self, begin: np.ndarray, end: np.ndarray) -> np.ndarray:
+        """Return the (indices into the index of the) row groups with a position in any of the intervals [begin, end]."""
+        # the rows are sorted by position, so are the first and last positions of the row groups
+        first = np.searchsorted(self.index["max_pos"], begin, side="left")
+        last = np.searchsorted(self.index["min_pos"], end, side="right")
+        n = last - first
+        found = [first[n > k] + k for k in range(n.max(initial=0))]
+        return np.unique(np.concatenate(found)) if found else np.array([], dtype=np.intp)
+
+    def read(self, row_groups: np.ndarray) -> pa.Table | None:
+        """Return the rows of the row groups (None if there are none)."""
+        tables = []
+        for part in np.unique(self.index["part"][row_groups]):
+            selected = row_groups[self.index["part"][row_groups] == part]
+            if part not in self._parquet_files:
+                self._parquet_files[part] = pq.ParquetFile(self.files[part])
+            tables.append(self._parquet_files[part].read_row_groups(self.index["row_group"][selected].tolist()))
+        return pa.concat_tables(tables) if tables else None
+
+
+class Dataset:
+    """Finalized dataset (output of varpile finalize)."""
+
+    def __init__(self, path: Path | str) -> None:
+        self.path = Path(path)
+        self.info = json.loads((self.path / "info.json").read_text())
+        directories = sorted(p for p in self.path.iterdir() if p.is_dir() and not p.name.startswith("."))
+        self.regions = [RegionResult(Region1.from_string(d.name), d) for d in directories]
+
+    def _read(self, chrom: np.ndarray, begin: np.ndarray, end: np.ndarray) -> pa.Table | None:
+        """Return the rows (with chrom) of the row groups overlapping the intervals."""
+        tables = []
+        for result in self.regions:
+            in_region = result.contains(chrom, begin)
+            if not in_region.any():
+                continue
+            table = result.read(result.row_groups(begin[in_region], end[in_region]))
+            if table is not None:
+                tables.append(table.add_column(0, "chrom", pa.array([result.region.contig] * len(table), pa.string())))
+        return pa.concat_tables(tables) if tables else None
+
+    def lookup_many(self, variants: pa.Table) -> pa.Table:
+        """Return the variants (chrom, pos, ref, alt) with the columns of the result (null if not found), in order."""
+        variants = variants.select(VARIANT_COLUMNS).cast(VARIANT_SCHEMA)
+        chrom = variants["chrom"].to_numpy(zero_copy_only=False)
+        pos = variants["pos"].to_numpy(zero_copy_only=False)
+        rows = self._read(chrom, pos, pos)
+        if rows is None:
+            rows = self.empty()
+
+        variants = variants.append_column("_row", pa.array(np.arange(len(variants))))
+        joined = variants.join(rows, keys=list(VARIANT_COLUMNS), join_type="left outer")
+        return joined.sort_by("_row").drop_columns("_row").select(rows.column_names)
+
+    def lookup(self, chrom: str, pos: int, ref: str, alt: str) -> dict | None:
+        """Return the result of the variant (as dict of the columns) or None if it isn't in the dataset."""
+        rows = self._read(np.array([chrom]), np.array([pos]), np.array([pos]))
+        if rows is None:
+            return None
+        found = rows.filter((pc.field("pos") == pos) & (pc.field("ref") == ref) & (pc.field("alt") == alt))
+        return found.to_pylist()[0] if len(found) > 0 else None
+
+    def region(self, region: Region1 | str) -> pa.Table:
+        """Return the results of the variants in the region."""
+        if isinstance(region, str):
+            region = Region1.from_string(region)
+        begin = np.array([region.begin or 0])
+        end = np.array([region.end or np.iinfo(np.int32).max])
+        rows = self._read(np.array([region.contig]), begin, end)
+        if rows is None:
+            return self.empty()
+        return rows.filter((pc.field("pos") >= begin[0]) & (pc.field("pos") <= end[0]))
+
+    def empty(self) -> pa.Table:
+        """Return an empty table with the columns of the results."""
+        for result in self.regions:
+            if result.files:
+                schema = pq.read_schema(result.files[0])
+                return pa.schema([("chrom", pa.string())] + list(zip(schema.names, schema.types))).empty_table()
+        raise DatasetError(f"'{self.path}' has no results")
+
+
+def open(path: Path | str) -> Dataset:
+    """Open a finalized dataset."""
+    return Dataset(path)
+
+
+def read_variants(path: Path) -> pa.Table:
+    """Return the variants (chrom, pos, ref, alt) of a VCF/BCF file (a row per alt allele) or of a TSV file.
+
+    The TSV file has no header and the columns chrom, pos, ref, alt.
+    """
+    if path.name.endswith(VCF_SUFFIXES):
+        columns = {name: [] for name in VARIANT_COLUMNS}
+        with pysam.VariantFile(str(path)) as vcf:
+            for record in vcf.fetch():
+                for alt in record.alts or ():
+                    columns["chrom"].append(record.chrom)
+                    columns["pos"].append(record.pos)
+                    columns["ref"].append(record.ref)
+                    columns["alt"].append(alt)
+        return pa.table(columns, schema=VARIANT_SCHEMA)
+
+    return pa.csv.read_csv(
+        path,
+        read_options=pa.csv.ReadOptions(column_names=VARIANT_COLUMNS),
+        parse_options=pa.csv.ParseOptions(delimiter="\t"),
+        convert_options=pa.csv.ConvertOptions(column_types=VARIANT_SCHEMA),
+    )
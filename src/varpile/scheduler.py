@@ -0,0 +1,122 @@
+"""
+Scheduling of tasks on a process pool.
+
+Tasks are submitted largest first (by their estimated cost) and only max_in_flight tasks are
+handed to the executor at a time. This way a follow-up task (e.g. merging the piles of a region)
+can be submitted as soon as all tasks of its group are done, and it runs before the remaining
+(queued) tasks instead of waiting behind them.
+
+With as many tasks in flight as the executor has workers (a process pool of max_in_flight processes), the next
+submitted task runs in the worker that just finished a task, the other workers are busy. A queued task with the same
+affinity (e.g. the input file, which the worker keeps open, see VariantFile.open_cached) is submitted next, unless it
+is much smaller than the largest queued task.
+"""
+
+import heapq
+import itertools
+import math
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Hashable
+
+from tqdm import tqdm
+
+# a task with the affinity of the finished task is preferred if its cost is at least this ratio of the largest one
+LOCALITY_MIN_COST_RATIO = 0.5
+
+
+@dataclass
+class Task:
+    fn: Callable
+    args: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+    cost: float = 0  # estimated amount of work, larger tasks are submitted first
+    group: Hashable = None  # follow-up of the group is submitted when all tasks of the group are done
+    affinity: Hashable = None  # tasks with the same affinity preferably run one after the other in the same worker
+
+
+class Scheduler:
+    """Runs tasks on the executor, largest first, with follow-up tasks per group."""
+
+    def __init__(self, executor: Executor, max_in_flight: int) -> None:
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        self._queue: list[tuple[float, int, Task]] = []  # heap of (-cost, insertion order, task)
+        self._by_affinity: dict[Hashable, list[tuple[float, int, Task]]] = {}  # the same entries per affinity
+        self._submitted: set[int] = set()  # insertion order of submitted tasks (still in the heaps)
+        self._n_queued = 0
+        self._counter = itertools.count()
+        self._pending: dict[Hashable, int] = {}  # group -> number of tasks not done yet
+        self._follow_ups: dict[Hashable, list[Task]] = {}
+
+    def add(self, task: Task) -> None:
+        entry = (-task.cost, next(self._counter), task)
+        heapq.heappush(self._queue, entry)
+        if task.affinity is not None:
+            heapq.heappush(self._by_affinity.setdefault(task.affinity, []), entry)
+        self._n_queued += 1
+        if task.group is not None:
+            self._pending[task.group] = self._pending.get(task.group, 0) + 1
+
+    def add_follow_up(self, group: Hashable, task: Task) -> None:
+        """Submit the task (with the highest priority) once all tasks of the group are done.
+
+        A group can have several follow-ups (e.g. the merges of all regions after the single-pass file tasks).
+        """
+        self._follow_ups.setdefault(group, []).append(task)
+
+    def run(self, desc: str | None = None) -> list[tuple[Task, Any]]:
+        """Run all tasks and follow-ups, return the results in the order of completion."""
+        results = []
+        in_flight: dict[Future, Task] = {}
+        total = self._n_queued + sum(len(follow_ups) for follow_ups in self._follow_ups.values())
+        free_affinities = []  # affinities of the tasks that just finished (their workers are free)
+
+        # follow-ups of groups without tasks can start right away
+        for group in list(self._follow_ups):
+            if self._pending.get(group, 0) == 0:
+                self._push_follow_up(group)
+
+        with tqdm(total=total, desc=desc) as progress:
+            while self._n_queued or in_flight:
+                while self._n_queued and len(in_flight) < self.max_in_flight:
+                    task = self._pop(free_affinities.pop() if free_affinities else None)
+                    in_flight[self.executor.submit(task.fn, *task.args, **task.kwargs)] = task
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = in_flight.pop(future)
+                    results.append((task, future.result()))
+                    progress.update()
+                    free_affinities.append(task.affinity)
+
+                    if task.group is not None and task.group in self._pending:
+                        self._pending[task.group] -= 1
+                        if self._pending[task.group] == 0:
+                            self._push_follow_up(task.group)
+
+        return results
+
+    def _pop(self, affinity: Hashable) -> Task:
+        """Return the largest queued task, or a task with the affinity if it isn't much smaller."""
+        heap = self._queue
+        self._drop_submitted(heap)
+        local = self._by_affinity.get(affinity)
+        if local:
+            self._drop_submitted(local)
+            if local and -local[0][0] >= -heap[0][0] * LOCALITY_MIN_COST_RATIO:
+                heap = local
+        _, order, task = heapq.heappop(heap)
+        self._submitted.add(order)
+        self._n_queued -= 1
+        return task
+
+    def _drop_submitted(self, heap: list) -> None:
+        while heap and heap[0][1] in self._submitted:
+            heapq.heappop(heap)
+
+    def _push_follow_up(self, group: Hashable) -> None:
+        self._pending.pop(group, None)
+        for follow_up in self._follow_ups.pop(group, []):
+            heapq.heappush(self._queue, (-math.inf, next(self._counter), follow_up))
+            self._n_queued += 1
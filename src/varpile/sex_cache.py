@@ -0,0 +1,134 @@
+"""
+Persistent cache of the inferred sex of samples (SamplesSex) of input files.
+
+Sex inference reads chrX of every input file, which is repeated on every `varpile count` run.
+The cache is a json file mapping a key that identifies an input file to its SamplesSex.
+A file is identified either by:
+- "stat": path, size and modification time of the file and its index (cheap, but a copy or touch invalidates it)
+- "content": hash of the header and of the chrX chunks in the index (stable across copies of the file)
+The options of sex inference (confidence, windows) are part of the key.
+
+A precomputed sex map (tsv: sample<TAB>XX|XY) can be supplied instead to skip inference.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Literal, get_args
+
+import pysam
+
+from varpile.index import find_index, read_index
+from varpile.infer_sex import SamplesSex, Sex
+
+logger = logging.getLogger(__name__)
+
+CacheKeyMode = Literal["stat", "content"]
+
+
+def file_key(input_file: Path, mode: CacheKeyMode = "stat", **inference_options) -> str:
+    """Return the key that identifies the input file (and sex inference options) in the cache."""
+    index_path = find_index(input_file)
+
+    if mode == "stat":
+        stat = input_file.stat()
+        index_mtime = index_path.stat().st_mtime_ns if index_path else None
+        identity = [str(input_file.resolve()), stat.st_size, stat.st_mtime_ns, index_mtime]
+    elif mode == "content":
+        with pysam.VariantFile(str(input_file)) as f:
+            header = str(f.header)
+            contig_names = list(f.header.contigs)
+        index = read_index(input_file, contig_names)
+        chrX = index.contigs.get("chrX") if index else None
+        identity = [header, chrX.chunks if chrX else None]
+    else:
+        raise ValueError(f"Unknown cache key mode '{mode}', expected one of {get_args(CacheKeyMode)}")
+
+    identity.append(sorted(inference_options.items()))
+    digest = hashlib.sha256(json.dumps(identity).encode()).hexdigest()
+    return f"{mode}:{digest}"
+
+
+class SexCache:
+    """Json file with SamplesSex of input files, see file_key."""
+
+    def __init__(self, path: Path, mode: CacheKeyMode = "stat", **inference_options) -> None:
+        self.path = path
+        self.mode = mode
+        self.inference_options = inference_options
+        self.entries: dict[str, dict] = self._load()
+        self._new_entries: dict[str, dict] = {}
+        self._keys: dict[Path, str] = {}  # computed once per file ("content" keys read the header and index)
+
+    def _load(self) -> dict[str, dict]:
+        try:
+            return json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning(f"Ignoring corrupted sex cache '{self.path}'")
+            return {}
+
+    def key(self, input_file: Path) -> str:
+        if input_file not in self._keys:
+            self._keys[input_file] = file_key(input_file, self.mode, **self.inference_options)
+        return self._keys[input_file]
+
+    def get(self, input_file: Path) -> SamplesSex | None:
+        entry = self.entries.get(self.key(input_file))
+        return None if entry is None else entry["samples_sex"]
+
+    def is_gvcf(self, input_file: Path) -> bool | None:
+        """Return whether the cached file is a gVCF file (None if unknown, e.g. an entry of an older version)."""
+        entry = self.entries.get(self.key(input_file))
+        return None if entry is None else entry.get("gvcf")
+
+    def set(self, input_file: Path, samples_sex: SamplesSex, gvcf: bool | None = None) -> None:
+        key = self.key(input_file)  # the key computed by get
+        entry = {"path": str(input_file), "samples_sex": samples_sex}
+        if gvcf is not None:
+            entry["gvcf"] = gvcf
+        self.entries[key] = self._new_entries[key] = entry
+
+    def save(self) -> None:
+        """Write the new entries to the cache file.
+
+        The cache can be shared, so we reload it just before writing (to keep entries written by others)
+        and replace it atomically.
+        """
+        if not self._new_entries:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        entries = self._load() | self._new_entries
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(entries, indent=4))
+        os.replace(tmp_path, self.path)
+        self._new_entries = {}
+
+
+def read_sex_map(path: Path) -> dict[str, Sex]:
+    """Read a tsv file with two columns: sample name and sex (XX or XY)."""
+    sex_map = {}
+    for line_number, line in enumerate(path.read_text().splitlines(), start=1):
+        if not line.strip() or line.startswith("#"):
+            continue
+        try:
+            sample, sex = line.rstrip("\n").split("\t")
+        except ValueError:
+            raise ValueError(f"{path}:{line_number}: expected 2 tab separated columns: sample, sex")
+        if sex not in get_args(Sex):
+            raise ValueError(f"{path}:{line_number}: invalid sex '{sex}', expected XX or XY")
+        sex_map[sample] = sex
+    return sex_map
+
+
+def samples_from_map(input_file: Path, sex_map: dict[str, Sex]) -> SamplesSex | None:
+    """Return SamplesSex of the input file if all of its samples are in the sex map (otherwise None)."""
+    with pysam.VariantFile(str(input_file)) as f:
+        samples = list(f.header.samples)
+    if all(sample in sex_map for sample in samples):
+        return {sample: sex_map[sample] for sample in samples}
+    return None
@@ -0,0 +1,84 @@
+"""
+Target intervals of `varpile count --regions-file targets.bed` (e.g. the targets of an exome).
+
+The intervals of a contig are sorted and merged (overlapping and adjacent intervals become one), so a record
+is counted once even if it is in several targets. A contig is counted into a single region (output directory),
+its intervals are split into groups of consecutive intervals with about the same number of bases (one task each).
+"""
+
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import pysam
+
+from varpile.coverage import is_ref_block
+from varpile.errors import RegionError
+
+Intervals = list[tuple[int, int]]  # sorted, non-overlapping (begin, end) intervals, 1-based inclusive as Region1
+
+
+def read_bed(path: Path) -> dict[str, Intervals]:
+    """Return the merged intervals of every contig of the BED file (in the order of the contigs in the file).
+
+    Header lines (#, track, browser) are skipped, columns after chrom, start and end are ignored.
+
+    Raises:
+        RegionError: If a line is not a valid BED interval.
+    """
+    intervals: dict[str, Intervals] = defaultdict(list)
+    with open(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            try:
+                contig, start, end = line.split("\t")[:3]
+                begin, end = int(start) + 1, int(end)  # BED is 0-based half-open
+            except ValueError:
+                raise RegionError(f"Invalid BED line {line_number} of '{path}': {line.strip()!r}")
+            if begin > end:
+                raise RegionError(f"Invalid BED line {line_number} of '{path}', start > end: {line.strip()!r}")
+            intervals[contig].append((begin, end))
+    return {contig: merge_intervals(contig_intervals) for contig, contig_intervals in intervals.items()}
+
+
+def merge_intervals(intervals: Iterable[tuple[int, int]]) -> Intervals:
+    """Sort the intervals and merge the overlapping and adjacent ones."""
+    merged: Intervals = []
+    for begin, end in sorted(intervals):
+        if merged and begin <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((begin, end))
+    return merged
+
+
+def group_intervals(intervals: Intervals, n: int) -> list[Intervals]:
+    """Split the intervals into (at most) n groups of consecutive intervals with about the same number of bases."""
+    total = sum(end - begin + 1 for begin, end in intervals)
+    groups: list[Intervals] = [[]]
+    bases = 0
+    for begin, end in intervals:
+        # start a new group once the current one has its share of the bases
+        if groups[-1] and bases >= total * len(groups) / n:
+            groups.append([])
+        groups[-1].append((begin, end))
+        bases += end - begin + 1
+    return groups
+
+
+def in_intervals(records: Iterable[pysam.VariantRecord], intervals: Intervals) -> Iterator[pysam.VariantRecord]:
+    """Return the records (sorted by position) that start in one of the intervals.
+
+    gVCF reference blocks are returned if they overlap an interval (they tell which samples are covered).
+    """
+    i = 0
+    for record in records:
+        # the first interval that ends at or after the record start (records are sorted, i never decreases)
+        while i < len(intervals) and intervals[i][1] < record.pos:
+            i += 1
+        if i == len(intervals):
+            break
+        last = record.stop if is_ref_block(record) else record.pos
+        if intervals[i][0] <= last:
+            yield record
@@ -1,71 +1,97 @@
-import os
 import sys
 import re
 import shutil
+from array import array
 from dataclasses import dataclass
 from pathlib import Path
-from typing import ClassVar
+from typing import ClassVar, Sequence
 
-import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
 
+from varpile import metrics
 from varpile.errors import RegionError
 
 
+# duckdb SQL type -> (array.array typecode, arrow type), used to buffer the columns of OutFile
+COLUMN_TYPES: dict[str, tuple[str | None, pa.DataType]] = {
+    "TINYINT": ("b", pa.int8()),
+    "UTINYINT": ("B", pa.uint8()),
+    "SMALLINT": ("h", pa.int16()),
+    "USMALLINT": ("H", pa.uint16()),
+    "INT": ("i", pa.int32()),
+    "UINTEGER": ("I", pa.uint32()),
+    "BIGINT": ("q", pa.int64()),
+    "UBIGINT": ("Q", pa.uint64()),
+    "DOUBLE": ("d", pa.float64()),
+    "VARCHAR": (None, pa.string()),  # strings are kept in a list
+}
+
+
 class OutFile:
     """Class that abstracts a parquet file
 
-    Output is the parquet file, but we don't write parquet directly,
-    we first write a temporary tsv file which we then convert to parquet file.
-    This was just easier.
-    We don't have to convert to parquet, but it might help out during the merge step.
+    Rows are appended to typed column buffers, once ROW_GROUP_SIZE rows are buffered
+    they are written out as a parquet row group (memory is bounded by the row group size).
     """
 
+    ROW_GROUP_SIZE: ClassVar[int] = 122_880  # same as the duckdb default
+
     def __init__(self, file_path: Path, columns: dict) -> None:
         """
 
         Args:
             file_path: resulting parquet file
-            columns: dict of the form name: type (type is duckdb SQL type)
+            columns: dict of the form name: type (type is duckdb SQL type, see COLUMN_TYPES)
         """
         self.output_path = file_path  # parquet file
         self.columns = columns
-        self.tmp_path = Path(file_path.parent / "tmp.tsv")  # temporary file that we will later convert
-
-        block_size = os.statvfs(file_path.parent).f_bsize
-        self.file_handle = open(self.tmp_path, "w", buffering=block_size)
+        self.schema = pa.schema([(name, COLUMN_TYPES[sql_type][1]) for name, sql_type in columns.items()])
+        self._typecodes = [COLUMN_TYPES[sql_type][0] for sql_type in columns.values()]
+        self._buffers = self._new_buffers()
+        self._writer = pq.ParquetWriter(self.output_path, self.schema, compression="ZSTD")
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
-            self.file_handle.close()
-            self._convert_to_parquet()
-        except Exception:
-            raise
+            if not exc_type:
+                self._write_row_group()
         finally:
-            if not exc_type:  # Only delete temp file if no exception occurred
-                self.tmp_path.unlink()
+            self._writer.close()
+            if exc_type:  # Don't leave a partially written file behind
+                self.output_path.unlink(missing_ok=True)
+            else:
+                metrics.add("bytes_written", self.output_path.stat().st_size)
 
-    def write_line(self, line) -> None:
-        self.file_handle.write(line)
+    def write_row(self, row: Sequence) -> None:
+        """Append a row, values are in the same order as the columns."""
+        for buffer, value in zip(self._buffers, row):
+            buffer.append(value)
 
-    def _convert_to_parquet(self) -> None:
-        con = duckdb.connect()
-        con.query("set threads=1")  # No need to multithread
+        if len(self._buffers[0]) >= self.ROW_GROUP_SIZE:
+            self._write_row_group()
 
-        rel = con.query(
-            f"""FROM read_csv('{str(self.tmp_path)}', columns={self.columns},
-                               HEADER=FALSE, DELIM='\t', HIVE_PARTITIONING=FALSE, AUTO_DETECT=FALSE );
-            """
-        )
+    def _new_buffers(self) -> list:
+        return [[] if typecode is None else array(typecode) for typecode in self._typecodes]
 
-        # # # TODO: we might need to do some binning (this is how we could do it)
-        # rel = rel.select("*, pos // 100_000_000 as bin")
-        # rel.to_parquet(str(self.output_path), compression="ZSTD", partition_by=["bin"])
-        # flatten_dir(self.output_path)
+    def _write_row_group(self) -> None:
+        if not self._buffers[0]:
+            return
+
+        with metrics.timed("write_row_group"):
+            arrays = []
+            for buffer, field in zip(self._buffers, self.schema):
+                if isinstance(buffer, array):
+                    # zero copy, the array buffer has the same layout as the arrow buffer
+                    arrays.append(pa.Array.from_buffers(field.type, len(buffer), [None, pa.py_buffer(buffer)]))
+                else:
+                    arrays.append(pa.array(buffer, type=field.type))
 
-        rel.to_parquet(str(self.output_path), compression="ZSTD")
+            self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        metrics.add("rows", len(self._buffers[0]))
+        self._buffers = self._new_buffers()
 
 
 def flatten_dir(dir_path: Path) -> None:
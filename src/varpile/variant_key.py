@@ -0,0 +1,105 @@
+"""
+64-bit variant keys.
+
+Piles and count datasets identify a variant (pos, ref, alt) by a single BIGINT key, so grouping, sorting and
+merging work on one integer column instead of an INT and two VARCHARs. The alleles are decoded only when the
+dataset is finalized.
+
+    key = pos << 32 | code
+
+Short alleles (ref and alt of A, C, G, T, each at most 7 bases, together at most 12) are packed into the code:
+
+    bits 0-23   bases of ref + alt, 2 bits per base (A=0, C=1, G=2, T=3), first base in the lowest bits
+    bits 24-26  length of ref
+    bits 27-29  length of alt
+
+Other alleles (long indels, symbolic and * alleles) set bit 31 and the remaining bits are a hash of the alleles.
+Their alleles are written next to the counts (alleles.parquet with key, ref, alt). The hash doesn't depend on
+the input, so keys computed by different centers are the same for the same variant.
+Keys are ordered by position; the order within a position is arbitrary but the same everywhere.
+"""
+
+import hashlib
+from pathlib import Path
+
+import duckdb
+
+from varpile.errors import DatasetError
+
+ALLELES_NAME = "alleles.parquet"
+
+# alleles of the variants with a hashed key (see module docstring)
+ALLELES_COLUMNS = {
+    "key": "BIGINT",
+    "ref": "VARCHAR",
+    "alt": "VARCHAR",
+}
+
+BASES = "ACGT"
+MAX_ALLELE_LENGTH = 7
+MAX_BASES = 12
+LONG_FLAG = 1 << 31
+HASH_MASK = LONG_FLAG - 1
+
+_BASE_DIGITS = str.maketrans(BASES, "0123")
+
+
+def variant_key(pos: int, ref: str, alt: str) -> int:
+    """Return the key of the variant."""
+    bases = ref + alt
+    if len(ref) <= MAX_ALLELE_LENGTH and len(alt) <= MAX_ALLELE_LENGTH and len(bases) <= MAX_BASES:
+        if not bases.strip(BASES):  # only A, C, G, T
+            packed = int(bases.translate(_BASE_DIGITS)[::-1], 4)
+            return pos << 32 | len(alt) << 27 | len(ref) << 24 | packed
+
+    digest = hashlib.blake2b(f"{ref}>{alt}".encode(), digest_size=4).digest()
+    return pos << 32 | LONG_FLAG | int.from_bytes(digest) & HASH_MASK
+
+
+def is_hashed(key: int) -> bool:
+    """Return True if the alleles of the key are hashed (see alleles.parquet)."""
+    return bool(key & LONG_FLAG)
+
+
+def decode(key: int) -> tuple[int, str, str]:
+    """Return (pos, ref, alt) of a key with packed alleles."""
+    if is_hashed(key):
+        raise ValueError(f"Alleles of the key {key} are hashed, see {ALLELES_NAME}")
+    ref_len, alt_len = key >> 24 & 7, key >> 27 & 7
+    bases = "".join(BASES[key >> 2 * i & 3] for i in range(ref_len + alt_len))
+    return key >> 32, bases[:ref_len], bases[ref_len:]
+
+
+def decoded_sql(data: str, alleles: str) -> str:
+    """SQL query of the rows of data (a relation with a key column) with pos, ref, alt instead of the key.
+
+    Args:
+        data: Relation (e.g. read_parquet(...)) with the key column.
+        alleles: Relation with the alleles (key, ref, alt) of the hashed keys of data.
+    """
+    packed_bases = "list_transform(range({begin}, {end}), i -> substr('ACGT', ((key >> (2 * i)) & 3)::int + 1, 1))"
+    ref_len, alt_len = "((key >> 24) & 7)", "((key >> 27) & 7)"
+    packed_ref = f"array_to_string({packed_bases.format(begin=0, end=ref_len)}, '')"
+    packed_alt = f"array_to_string({packed_bases.format(begin=ref_len, end=f'{ref_len} + {alt_len}')}, '')"
+    return f"""
+        select
+        pos: (key >> 32)::int,
+        ref: if((key & {LONG_FLAG}) = 0, {packed_ref}, alleles.ref),
+        alt: if((key & {LONG_FLAG}) = 0, {packed_alt}, alleles.alt),
+        data.* exclude (key),
+        from {data} as data left join (select key, ref, alt from {alleles}) as alleles using (key)
+    """
+
+
+def merge_alleles(con: duckdb.DuckDBPyConnection, alleles_files: list[Path], out_path: Path) -> None:
+    """Write the distinct alleles of the files into out_path (sorted by key).
+
+    Raises:
+        DatasetError: If different alleles have the same key (a collision of the hash).
+    """
+    files = [str(path) for path in alleles_files]
+    rel = con.query(f"select distinct key, ref, alt from read_parquet({files}, union_by_name = true) order by key")
+    collision = rel.aggregate("key, n: count(*)", "key").filter("n > 1").limit(1).fetchall()
+    if collision:
+        raise DatasetError(f"Different alleles have the same variant key {collision[0][0]}")
+    rel.write_parquet(str(out_path), compression="ZSTD")
@@ -0,0 +1,26 @@
+import shutil
+
+import duckdb
+
+from tests.test_main import example_bcf, example_vcf, vcf_directory  # noqa: F401 (fixtures)
+from tests.utils import count_options, sex_map  # noqa: F401 (fixture)
+from varpile.actions import count
+from varpile.actions.count_action import BATCH_PREFIX
+
+
+def test_batches(example_bcf, tmp_path, sex_map):
+    """Small files are counted in batches (of at most 5 files), the counts are the same."""
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    for i in range(10):
+        shutil.copyfile(example_bcf, inputs / f"f{i}.bcf")
+        shutil.copyfile(f"{example_bcf}.csi", inputs / f"f{i}.bcf.csi")
+
+    count(count_options(inputs, tmp_path / "batched", sex_map, paths=[inputs], max_batch_files=5, debug=True))
+    count(count_options(inputs, tmp_path / "files", sex_map, paths=[inputs], max_batch_files=1))
+
+    for region in ["1", "X"]:
+        batches = [path.name for path in (tmp_path / "batched" / region).iterdir() if path.is_dir()]
+        assert 2 <= len(batches) < 10 and all(name.startswith(BATCH_PREFIX) for name in batches)
+        batched = duckdb.read_parquet(str(tmp_path / "batched" / region / "data.parquet")).fetchall()
+        assert batched == duckdb.read_parquet(str(tmp_path / "files" / region / "data.parquet")).fetchall()
@@ -0,0 +1,152 @@
+from pathlib import Path
+
+import duckdb
+import numpy as np
+import pysam
+import pytest
+
+from tests.utils import count_options
+from tests.utils import write_vcf
+from varpile.actions import count, merge
+from varpile.allele_counts import merge_piles, process_chromosome
+from varpile.coverage import _sweep
+from varpile.utils import Region1
+from varpile.variant_key import ALLELES_NAME, decoded_sql
+
+GVCF_HEADER = """\
+    ##fileformat=VCFv4.2
+    ##ALT=<ID=NON_REF,Description="Represents any possible alternative allele at this location">
+    ##contig=<ID=1,length=249250621>
+    ##INFO=<ID=END,Number=1,Type=Integer,Description="Stop position of the interval">
+    ##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+    ##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">
+    ##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">
+    ##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype Quality">
+    ##FORMAT=<ID=MIN_DP,Number=1,Type=Integer,Description="Minimum DP observed within the GVCF block">
+"""
+
+FILTER_VALUES = {"min_DP": 10, "min_GQ": 20, "min_AB": 0.2}
+
+# sample A (XX): its blocks after 1000 fail the GQ filter
+GVCF_A = """\
+    #CHROM  POS   ID  REF  ALT          QUAL  FILTER  INFO      FORMAT           A
+    1       1     .   A    <NON_REF>    .     .       END=99    GT:DP:GQ:MIN_DP  0/0:30:99:25
+    1       100   .   C    G,<NON_REF>  50    .       .         GT:AD:DP:GQ      0/1:10,12,0:22:99
+    1       101   .   T    <NON_REF>    .     .       END=1000  GT:DP:GQ:MIN_DP  0/0:30:99:25
+    1       1001  .   T    <NON_REF>    .     .       END=1209  GT:DP:GQ:MIN_DP  0/0:30:10:25
+    1       1210  .   C    T,<NON_REF>  50    .       .         GT:AD:DP:GQ      0/1:10,12,0:22:99
+    1       1211  .   T    <NON_REF>    .     .       END=2000  GT:DP:GQ:MIN_DP  0/0:30:10:25
+"""
+
+# sample B (XY): has no block at 1200-1249
+GVCF_B = """\
+    #CHROM  POS   ID  REF  ALT          QUAL  FILTER  INFO      FORMAT           B
+    1       1     .   A    <NON_REF>    .     .       END=1199  GT:DP:GQ:MIN_DP  0/0:30:99:25
+    1       1250  .   G    A,<NON_REF>  50    .       .         GT:AD:DP:GQ      1/1:0,30,0:30:99
+    1       1500  .   G    A,<NON_REF>  50    .       .         GT:AD:DP:GQ      1/1:0,30,0:30:99
+    1       1501  .   T    <NON_REF>    .     .       END=3000  GT:DP:GQ:MIN_DP  0/0:30:99:25
+"""
+
+
+def test_sweep():
+    begin, end, weights = np.array([1, 5, 3]), np.array([10, 5, 4]), np.array([1, 10, 100])
+    assert _sweep(np.array([0, 1, 3, 4, 5, 6, 10, 11]), begin, end, weights).tolist() == [0, 1, 101, 101, 11, 1, 1, 0]
+
+
+@pytest.mark.parametrize("engine", ["python", "numpy"])
+def test_gvcf_no_coverage(tmp_path, engine):
+    region_dir = tmp_path / "1"
+    for name, content, sex_info in [("A", GVCF_A, {"A": "XX"}), ("B", GVCF_B, {"B": "XY"})]:
+        vcf_path = tmp_path / f"{name}.vcf"
+        write_vcf(vcf_path, content, header=GVCF_HEADER)
+        # shard boundary inside the blocks, blocks are clipped to the shards
+        for i, shard in enumerate(["1:1-1100", "1:1101"]):
+            shard_dir = region_dir / name / f"shard_{i}"
+            shard_dir.mkdir(parents=True)
+            region = Region1.from_string(shard)
+            process_chromosome(vcf_path, region, sex_info, shard_dir, FILTER_VALUES, engine=engine)
+
+    merge_piles(region_dir, aggregated=engine == "numpy", gvcf_sample_number={"XX": 1, "XY": 1})
+
+    counts = decoded_sql(
+        f"read_parquet('{region_dir / 'data.parquet'}')", f"read_parquet('{region_dir / ALLELES_NAME}')"
+    )
+    rows = duckdb.sql(
+        f"""
+        select pos, alt, XX_n_no_coverage, XY_n_no_coverage
+        from ({counts}) where XX_AC > 0 or XY_AC > 0 order by pos, alt
+        """
+    ).fetchall()
+    assert rows == [
+        (100, "G", 0, 0),  # A has the variant, B a block
+        (1210, "T", 0, 1),  # B has no block
+        (1250, "A", 1, 0),  # A's block fails the GQ filter
+        (1500, "A", 1, 0),
+    ]
+
+
+def test_merge_gvcf_datasets(tmp_path):
+    """Merged datasets count the samples without coverage of a dataset that doesn't have the variant."""
+    sex_map = tmp_path / "sex_map.tsv"
+    sex_map.write_text("A\tXX\nB\tXY\n")
+    paths = []
+    for name, content in [("A", GVCF_A), ("B", GVCF_B)]:
+        write_vcf(tmp_path / f"{name}.vcf", content, header=GVCF_HEADER)
+        paths.append(Path(pysam.tabix_index(str(tmp_path / f"{name}.vcf"), preset="vcf", force=True)))
+        count(count_options(paths[-1], tmp_path / f"counts_{name}", sex_map, regions=[Region1("1", None, None)]))
+    count(count_options(paths[0], tmp_path / "counts", sex_map, paths=paths, regions=[Region1("1", None, None)]))
+    merge([tmp_path / "counts_A", tmp_path / "counts_B"], tmp_path / "merged", threads=1)
+
+    for file in ["data.parquet", "coverage.parquet"]:
+        expected = duckdb.read_parquet(str(tmp_path / "counts" / "1" / file)).fetchall()
+        assert duckdb.read_parquet(str(tmp_path / "merged" / "1" / file)).fetchall() == expected
+    # (begin, end, XX_n, XY_n), A's blocks after 1000 fail the GQ filter, B has no block at 1200-1249
+    assert duckdb.read_parquet(str(tmp_path / "merged" / "1" / "coverage.parquet")).fetchall() == [
+        (1, 1000, 1, 1),
+        (1001, 1199, 0, 1),
+        (1210, 1210, 1, 0),
+        (1250, 1250, 0, 1),
+        (1500, 3000, 0, 1),
+    ]
+
+
+# sample A (XX): a multi-allelic variant split into two records (bcftools norm -m-)
+GVCF_SPLIT = """\
+    #CHROM  POS  ID  REF  ALT          QUAL  FILTER  INFO      FORMAT           A
+    1       1    .   A    <NON_REF>    .     .       END=99    GT:DP:GQ:MIN_DP  0/0:30:99:25
+    1       100  .   C    G,<NON_REF>  50    .       .         GT:AD:DP:GQ      0/1:10,12,0:22:99
+    1       100  .   C    T,<NON_REF>  50    .       .         GT:AD:DP:GQ      0/1:10,12,0:22:99
+    1       101  .   T    <NON_REF>    .     .       END=2000  GT:DP:GQ:MIN_DP  0/0:30:99:25
+"""
+
+# sample C (XX): has no block at 100
+GVCF_C = """\
+    #CHROM  POS  ID  REF  ALT          QUAL  FILTER  INFO      FORMAT           C
+    1       1    .   A    <NON_REF>    .     .       END=99    GT:DP:GQ:MIN_DP  0/0:30:99:25
+    1       101  .   T    <NON_REF>    .     .       END=2000  GT:DP:GQ:MIN_DP  0/0:30:99:25
+"""
+
+
+@pytest.mark.parametrize("engine", ["python", "numpy"])
+def test_split_multiallelic_coverage(tmp_path, engine):
+    """The records of a split multi-allelic site cover the position once for the samples of the file."""
+    sex_map = tmp_path / "sex_map.tsv"
+    sex_map.write_text("A\tXX\nC\tXX\n")
+    regions = [Region1("1", None, None)]
+    for name, content in [("A", GVCF_SPLIT), ("C", GVCF_C)]:
+        write_vcf(tmp_path / f"{name}.vcf", content, header=GVCF_HEADER)
+        path = Path(pysam.tabix_index(str(tmp_path / f"{name}.vcf"), preset="vcf", force=True))
+        count(count_options(path, tmp_path / f"counts_{name}", sex_map, regions=regions, engine=engine))
+    merge([tmp_path / "counts_A", tmp_path / "counts_C"], tmp_path / "merged", threads=1)
+
+    region_dir = tmp_path / "merged" / "1"
+    assert duckdb.read_parquet(str(region_dir / "coverage.parquet")).fetchall() == [
+        (1, 99, 2, 0),
+        (100, 100, 1, 0),
+        (101, 2000, 2, 0),
+    ]
+    counts = decoded_sql(
+        f"read_parquet('{region_dir / 'data.parquet'}')", f"read_parquet('{region_dir / ALLELES_NAME}')"
+    )
+    rows = duckdb.sql(f"select pos, alt, XX_n_no_coverage from ({counts}) order by pos, alt").fetchall()
+    assert rows == [(100, "G", 1), (100, "T", 1)]  # C is not covered
@@ -0,0 +1,93 @@
+import json
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import varpile.query
+from varpile.actions import finalize, finalize_action
+from varpile.allele_counts import COUNT_COLUMNS
+from varpile.query import read_variants
+from varpile.utils import COLUMN_TYPES
+from varpile.variant_key import ALLELES_COLUMNS, ALLELES_NAME, variant_key
+
+
+def schema(columns):
+    return pa.schema([(name, COLUMN_TYPES[sql_type][1]) for name, sql_type in columns.items()])
+
+
+def make_counts(path, regions, positions):
+    """Count dataset with an A>G variant of a single XX sample at the positions in each region."""
+    counts = {name: [0] * len(positions) for name in COUNT_COLUMNS}
+    counts |= {
+        "key": [variant_key(pos, "A", "G") for pos in positions],
+        "XX_AC": [1] * len(positions),
+        "n_samples": [1] * len(positions),
+        "DP_sum": [10] * len(positions),
+        "DP2_sum": [100] * len(positions),
+    }
+    path.mkdir()
+    (path / "info.json").write_text(json.dumps({"sample_number": {"XX": 1, "XY": 0}}))
+    for region in regions:
+        (path / region).mkdir()
+        pq.write_table(pa.table(counts, schema(COUNT_COLUMNS)), path / region / "data.parquet")
+        pq.write_table(schema(ALLELES_COLUMNS).empty_table(), path / region / ALLELES_NAME)
+    return path
+
+
+@pytest.mark.parametrize("engine", ["duckdb", "process"])
+def test_finalize_bins(tmp_path, engine):
+    positions = list(range(1, 1_000_000, 997))
+    counts = make_counts(tmp_path / "counts", ["chr1", "chrX"], positions)
+    finalize(counts, tmp_path / "result", threads=2, engine=engine)
+    finalize(counts, tmp_path / "binned", threads=2, bin_size=100_000, engine=engine)
+    assert not (tmp_path / "binned" / finalize_action.TEMP_DIR).exists()
+
+    for region in ["chr1", "chrX"]:
+        result = duckdb.read_parquet(str(tmp_path / "result" / region / "result.parquet"))
+        assert result.select("pos").fetchall() == [(pos,) for pos in positions]
+
+        # the same rows, the bin is in the path of the files
+        binned = duckdb.sql(
+            f"""
+            select * from read_parquet('{tmp_path}/binned/{region}/result/*/*.parquet', hive_partitioning = true)
+            order by pos
+            """
+        )
+        assert all(bin == pos // 100_000 for pos, bin in binned.select("pos, bin").fetchall())
+        assert binned.select("* exclude (bin)").fetchall() == result.fetchall()
+
+
+@pytest.mark.parametrize("engine", ["duckdb", "process"])
+def test_finalize_empty(tmp_path, engine):
+    """A dataset without regions (e.g. no variants in the targets) is finalized into an empty result."""
+    counts = make_counts(tmp_path / "counts", [], [])
+    finalize(counts, tmp_path / "result", threads=2, engine=engine)
+    assert [path.name for path in (tmp_path / "result").iterdir()] == ["info.json"]
+
+
+@pytest.mark.parametrize("bin_size", [None, 100_000])
+def test_query(tmp_path, monkeypatch, bin_size):
+    monkeypatch.setattr(finalize_action, "RESULT_ROW_GROUP_SIZE", 2048)  # several row groups per file
+    positions = list(range(1, 1_000_000, 97))
+    counts = make_counts(tmp_path / "counts", ["chr1", "chrX:1-500000"], positions)
+    finalize(counts, tmp_path / "result", threads=1, bin_size=bin_size)
+    dataset = varpile.query.open(tmp_path / "result")
+
+    assert dataset.lookup("chr1", 98, "A", "G")["XX_AC"] == 1
+    assert dataset.lookup("chr1", 98, "A", "T") is None
+    assert dataset.lookup("chr1", 99, "A", "G") is None
+    assert dataset.lookup("chrX", 600_000 - 600_000 % 97 + 1, "A", "G") is None  # outside of the region
+    assert dataset.lookup("chr2", 98, "A", "G") is None
+    assert dataset.region("chrX:1000-2000").column("pos").to_pylist() == [p for p in positions if 1000 <= p <= 2000]
+
+    variants = tmp_path / "variants.tsv"
+    variants.write_text("chr1\t999683\tA\tG\nchr2\t1\tA\tG\nchr1\t1\tA\tG\nchr1\t1\tA\tC\n")
+    found = dataset.lookup_many(read_variants(variants))
+    assert found.select(["chrom", "pos", "XX_AC"]).to_pylist() == [
+        {"chrom": "chr1", "pos": 999683, "XX_AC": 1},
+        {"chrom": "chr2", "pos": 1, "XX_AC": None},
+        {"chrom": "chr1", "pos": 1, "XX_AC": 1},
+        {"chrom": "chr1", "pos": 1, "XX_AC": None},
+    ]
@@ -0,0 +1,31 @@
+import numpy as np
+import pysam
+import pytest
+
+from tests.test_main import VCF_HEADER
+from tests.utils import write_vcf
+from varpile.genotypes import MISSING, NO_ALLELE, gt_array
+
+
+@pytest.mark.parametrize(
+    "samples, expected",
+    [
+        ("0/1     1|1     ./.", [(0, 1), (1, 1), (MISSING, MISSING)]),
+        ("1:13    0:12    .:1", [(1, NO_ALLELE), (0, NO_ALLELE), (MISSING, NO_ALLELE)]),
+        ("0/1:13  1:12    .:1", [(0, 1), (1, NO_ALLELE), (MISSING, NO_ALLELE)]),
+        # fallback to pysam (allele index >= 10)
+        ("0/10:13 10/1:12 ./.:1", [(0, 10), (10, 1), (MISSING, MISSING)]),
+    ],
+)
+def test_gt_array(tmp_path, samples, expected):
+    alts = ",".join(["C"] * 10)
+    content = f"""\
+    #CHROM   POS   ID   REF   ALT      QUAL   FILTER   INFO   FORMAT   SAMPLE1   SAMPLE2   SAMPLE3
+    1        1     .    A     {alts}   .      PASS     .      GT:DP    {samples}
+    """
+    write_vcf(tmp_path / "test.vcf", content, header=VCF_HEADER)
+
+    with pysam.VariantFile(str(tmp_path / "test.vcf")) as f:
+        gt = gt_array(next(iter(f)))
+
+    np.testing.assert_array_equal(gt, np.array(expected))
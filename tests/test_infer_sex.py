@@ -0,0 +1,113 @@
+import random
+
+import pysam
+
+from tests.utils import write_vcf
+from varpile.VariantFile import VariantFile
+from varpile.infer_sex import (
+    NON_PAR_REGION_ON_X,
+    count_X_genotypes,
+    infer_samples_sex,
+    infer_sex,
+    sex_from_counts,
+)
+
+CHRX_HEADER = """\
+    ##fileformat=VCFv4.2
+    ##FILTER=<ID=PASS,Description="All filters passed">
+    ##contig=<ID=chrX,length=156040895>
+    ##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+    ##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">
+"""
+
+# probability of a heterozygous genotype of each sample (XY samples are below FRACTION_LIMIT)
+HET_FRACTIONS = [0.0, 0.05, 0.1, 0.35, 0.5, 0.8]
+
+
+def write_chrX_vcf(path, n_records, het_fractions=HET_FRACTIONS, seed=0, span=None):
+    """Indexed vcf.gz with n_records evenly spaced over the non-PAR region of chrX (or the first span bases of it).
+
+    Besides diploid genotypes there are missing (./. and .), phased, multi allelic and haploid (2) genotypes.
+    """
+    rng = random.Random(seed)
+    samples = [f"SAMPLE{i}" for i in range(len(het_fractions))]
+    lines = ["#CHROM POS ID REF ALT QUAL FILTER INFO FORMAT " + " ".join(samples)]
+    step = (span or NON_PAR_REGION_ON_X.end - NON_PAR_REGION_ON_X.begin) // n_records
+    for i in range(n_records):
+        genotypes = []
+        for het_fraction in het_fractions:
+            x = rng.random()
+            if x < 0.05:
+                gt = rng.choice(["./.", "."])
+            elif x < 0.05 + het_fraction:
+                gt = rng.choice(["0/1", "0|1", "1/2", "2"])
+            else:
+                gt = rng.choice(["0/0", "1/1", "2/2"])
+            genotypes.append(f"{gt}:{rng.randint(5, 40)}")
+        lines.append(f"chrX {NON_PAR_REGION_ON_X.begin + i * step} . A C,G . PASS . GT:DP {' '.join(genotypes)}")
+    write_vcf(path, "\n".join(lines), header=CHRX_HEADER)
+    return pysam.tabix_index(str(path), preset="vcf", force=True)
+
+
+def reference_counts(path, sample_rank):
+    """Het and hom genotypes of a sample, counted with pysam (sample by sample)."""
+    het_event = hom_event = 0
+    with pysam.VariantFile(path) as f:
+        for r in f.fetch(*NON_PAR_REGION_ON_X.to_pysam_tuple()):
+            match r.samples[sample_rank]["GT"]:
+                case (None,) | (None, None):
+                    continue
+                case (a, b) if a == b:
+                    hom_event += 1
+                case (a, b):
+                    het_event += 1
+                case (a,) if a > 1:
+                    het_event += 1
+                case wtf:
+                    raise ValueError("Unexpected genotype format:", wtf)
+    return het_event, hom_event
+
+
+def test_infer_samples_sex(tmp_path):
+    """The single pass over all samples gives the same counts and sex as reading the file sample by sample."""
+    path = write_chrX_vcf(tmp_path / "samples.vcf", 300)
+    with VariantFile(path) as f:
+        het_events, hom_events = count_X_genotypes(f)
+        samples = list(f.header.samples)
+
+    expected = {}
+    for rank, sample in enumerate(samples):
+        het_event, hom_event = reference_counts(path, rank)
+        assert (het_events[rank], hom_events[rank]) == (het_event, hom_event)
+        expected[sample] = sex_from_counts(het_event, hom_event, sample)
+
+    assert list(expected.values()) == ["XY", "XY", "XY", "XX", "XX", "XX"]
+    assert infer_samples_sex(path) == expected
+    assert {sample: infer_sex(path, rank) for rank, sample in enumerate(samples)} == expected
+
+
+def samples_sex(path, **options):
+    with VariantFile(path) as f:
+        het_events, hom_events = count_X_genotypes(f, **options)
+        sexes = [sex_from_counts(int(het), int(hom), "") for het, hom in zip(het_events, hom_events)]
+    return sexes, int((het_events + hom_events).sum())
+
+
+def test_early_stop_and_windows(tmp_path):
+    """Early stopping and windowed sampling read fewer genotypes and decide like a full scan."""
+    path = write_chrX_vcf(tmp_path / "samples.vcf", 3000)
+    expected, n_genotypes = samples_sex(path)
+    assert expected == ["XY", "XY", "XY", "XX", "XX", "XX"]
+
+    for options in [{"confidence": 0.999}, {"windows": 20}, {"confidence": 0.999, "windows": 20}]:
+        sexes, n_read = samples_sex(path, **options)
+        assert sexes == expected, options
+        assert n_read < n_genotypes / 2, options
+
+
+def test_sparse_windows(tmp_path):
+    """Without enough genotypes in the windows the whole region is read (samples are not assumed XX)."""
+    path = write_chrX_vcf(tmp_path / "sparse.vcf", 300, span=2_000_000)  # all records before the first window
+    expected, n_genotypes = samples_sex(path)
+    assert expected == ["XY", "XY", "XY", "XX", "XX", "XX"]
+    assert samples_sex(path, windows=20) == (expected, n_genotypes)
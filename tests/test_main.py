@@ -56,8 +56,11 @@ import pysam
 import pysam.bcftools
 import pytest
 
+import varpile.VariantFile as VariantFile_module
 from tests.utils import write_vcf
-from varpile.allele_counts import iter_alleles
+from varpile.VariantFile import VariantFile, open_cached
+from varpile.allele_counts import iter_alleles, merge_piles, process_chromosome
+from varpile.utils import Region1
 
 
 # variants = [
@@ -160,6 +163,52 @@ def test_example_vcf_parsing(example_vcf):
             pass
 
 
+FILTER_VALUES = {"min_DP": 10, "min_GQ": 20, "min_AB": 0.2}
+SEX_INFO = {"SAMPLE1": "XX", "SAMPLE2": "XY"}
+
+
+def count_region(vcf_path, region, out_dir, **kwargs):
+    """Run process_chromosome and merge_piles for a single file and return the merged counts."""
+    region = Region1.from_string(region)
+    pile_dir = out_dir / str(region) / "pile"
+    pile_dir.mkdir(parents=True)
+    process_chromosome(vcf_path, region, SEX_INFO, pile_dir, FILTER_VALUES, **kwargs)
+    aggregated = kwargs.get("aggregate", False) or kwargs.get("engine") == "numpy"
+    merge_piles(out_dir / str(region), aggregated=aggregated)
+    return duckdb.read_parquet(str(out_dir / str(region) / "data.parquet")).fetchall()
+
+
+@pytest.mark.parametrize("region", ["1", "X"])
+def test_pre_aggregated_pile(example_bcf, tmp_path, region):
+    """Piles aggregated inside the worker are merged into the same counts."""
+    expected = count_region(example_bcf, region, tmp_path / "raw")
+    assert count_region(example_bcf, region, tmp_path / "aggregated", aggregate=True) == expected
+
+
+@pytest.mark.parametrize("region", ["1", "X"])
+def test_numpy_engine(example_bcf, tmp_path, region):
+    """The vectorized engine produces the same counts as the per-sample python loop."""
+    expected = count_region(example_bcf, region, tmp_path / "python")
+    assert count_region(example_bcf, region, tmp_path / "numpy", engine="numpy") == expected
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_sharded_region(example_bcf, tmp_path, streaming):
+    """Records overlapping the shard boundaries are counted once (in the shard where they start)."""
+    expected = count_region(example_bcf, "1", tmp_path / "whole")
+
+    region_dir = tmp_path / "sharded" / "1"
+    for i, shard in enumerate(["1:1-1", "1:2-5", "1:6"]):
+        shard_dir = region_dir / "pile" / f"shard_{i}"
+        shard_dir.mkdir(parents=True)
+        process_chromosome(
+            example_bcf, Region1.from_string(shard), SEX_INFO, shard_dir, FILTER_VALUES, aggregate=streaming
+        )
+    merge_piles(region_dir, aggregated=streaming, streaming=streaming, threads=2, temp_directory=tmp_path)
+
+    assert duckdb.read_parquet(str(region_dir / "data.parquet")).fetchall() == expected
+
+
 # def test_allele_count_example(example_vcf):
 #     """Test that the genotype can be parsed."""
 #     values = []
@@ -252,3 +301,30 @@ def test_example_vcf_parsing(example_vcf):
 #     df = duckdb.read_parquet(str(out_file) + "/**/*.parquet").pl()
 #     # parse the
 #     # TODO: how do we assert this?
+
+
+def test_open_cached(example_bcf, example_vcf, monkeypatch):
+    monkeypatch.setattr(VariantFile_module, "MAX_OPEN_FILES", 1)
+    bcf = open_cached(example_bcf)
+    assert open_cached(str(example_bcf)) is bcf
+    assert len(list(bcf.fetch("1"))) == 4
+
+    open_cached(example_vcf)  # the least recently used file is closed
+    assert open_cached(example_bcf) is not bcf
+
+    # opened by the sex inference (no decompression threads), reopened by a count task with decompression threads
+    bcf = open_cached(example_bcf)
+    threaded = open_cached(example_bcf, threads=2)
+    assert threaded is not bcf and threaded.threads == 2
+    assert open_cached(example_bcf, threads=1) is threaded
+    assert open_cached(example_bcf) is threaded
+    assert len(list(threaded.fetch("1"))) == 4
+
+
+def test_fetch_regions(example_bcf, example_vcf):
+    """A single pass returns the records of every region that fetch returns (also of overlapping regions)."""
+    regions = [Region1.from_string(region) for region in ["X:1-150", "1:2-5", "1", "X:200-300", "2"]]
+    with VariantFile(example_vcf) as vcf:  # not indexed
+        found = {region: [r.pos for r in records] for region, records in vcf.fetch_regions(regions)}
+    with VariantFile(example_bcf) as bcf:
+        assert found == {region: [r.pos for r in bcf.fetch(region)] for region in regions}
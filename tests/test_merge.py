@@ -0,0 +1,131 @@
+import json
+import os
+
+import duckdb
+import pytest
+
+from tests.test_main import count_region, example_bcf, example_vcf, vcf_directory  # noqa: F401 (fixtures)
+from tests.utils import count_options, sex_map  # noqa: F401 (fixture)
+from varpile.actions import count, merge, merge_action
+from varpile.errors import DatasetError
+
+AC0_FILTER = {"min_DP": 10, "min_GQ": 20, "min_AB": 0.2}
+
+
+def make_dataset(path, example_bcf, regions, sample_number, AC0_filter=AC0_FILTER):
+    for region in regions:
+        count_region(example_bcf, region, path)
+    info = {
+        "version": "test",
+        "sample_number": sample_number,
+        "AC0_filter": AC0_filter,
+        "datasets": [{"name": path.name, "id": str(path)}],
+    }
+    (path / "info.json").write_text(json.dumps(info))
+    return path
+
+
+def test_merge(example_bcf, tmp_path):
+    a = make_dataset(tmp_path / "a", example_bcf, ["1", "X"], {"XX": 1, "XY": 1})
+    b = make_dataset(tmp_path / "b", example_bcf, ["1"], {"XX": 1, "XY": 1})
+    merge([a, b], tmp_path / "out", threads=1)
+
+    info = json.loads((tmp_path / "out" / "info.json").read_text())
+    assert info["sample_number"] == {"XX": 2, "XY": 2}
+
+    # same as aggregating both datasets at once (and sorted)
+    data = f"read_parquet(['{a}/1/data.parquet', '{b}/1/data.parquet'])"
+    expected = duckdb.sql(
+        f"""
+        select key, sum(columns(* exclude (key)))
+        from {data} group by key order by key
+        """
+    ).fetchall()
+    assert duckdb.read_parquet(str(tmp_path / "out" / "1" / "data.parquet")).fetchall() == expected
+
+    # region present in a single dataset is copied
+    x = duckdb.read_parquet(str(tmp_path / "out" / "X" / "data.parquet")).fetchall()
+    assert x == duckdb.read_parquet(str(a / "X" / "data.parquet")).fetchall()
+
+
+def test_merge_different_filters(example_bcf, tmp_path):
+    a = make_dataset(tmp_path / "a", example_bcf, ["1"], {"XX": 1, "XY": 1})
+    b = make_dataset(tmp_path / "b", example_bcf, ["1"], {"XX": 1, "XY": 1}, AC0_FILTER | {"min_DP": 5})
+    with pytest.raises(DatasetError):
+        merge([a, b], tmp_path / "out", threads=1)
+
+
+def test_merge_into(example_bcf, tmp_path):
+    a = make_dataset(tmp_path / "a", example_bcf, ["1", "X"], {"XX": 1, "XY": 1})
+    b = make_dataset(tmp_path / "b", example_bcf, ["1"], {"XX": 1, "XY": 1})
+    c = make_dataset(tmp_path / "c", example_bcf, ["1"], {"XX": 2, "XY": 0})
+    merge([a, b, c], tmp_path / "all", threads=1)
+
+    # fold c into the merge of a and b (in place)
+    merged = tmp_path / "merged"
+    merge([a, b], merged, threads=1)
+    merge([c], None, threads=1, into=merged)
+
+    for file in ["1/data.parquet", "X/data.parquet"]:
+        expected = duckdb.read_parquet(str(tmp_path / "all" / file)).fetchall()
+        assert duckdb.read_parquet(str(merged / file)).fetchall() == expected
+    info = json.loads((merged / "info.json").read_text())
+    assert info["sample_number"] == {"XX": 4, "XY": 2}
+    assert [dataset["name"] for dataset in info["datasets"]] == ["a", "b", "c"]
+
+    # a dataset can't be included twice
+    with pytest.raises(DatasetError, match="included twice"):
+        merge([b], None, threads=1, into=merged)
+
+
+def test_merge_duplicates(example_bcf, tmp_path, sex_map):
+    """Datasets are identified by their count run and input files, the name is only a label."""
+    a = make_dataset(tmp_path / "center_a" / "counts", example_bcf, ["1"], {"XX": 1, "XY": 1})
+    b = make_dataset(tmp_path / "center_b" / "counts", example_bcf, ["1"], {"XX": 1, "XY": 1})
+    merge([a, b], tmp_path / "out", threads=1)
+    info = json.loads((tmp_path / "out" / "info.json").read_text())
+    assert [dataset["name"] for dataset in info["datasets"]] == ["counts", "counts"]
+
+    # the same input file counted again (into a directory with another name) is a new run of the same data
+    count(count_options(example_bcf, tmp_path / "center", sex_map))
+    count(count_options(example_bcf, tmp_path / "center_recounted", sex_map))
+    datasets = [
+        json.loads((tmp_path / name / "info.json").read_text())["datasets"][0]
+        for name in ["center", "center_recounted"]
+    ]
+    assert datasets[0]["id"] != datasets[1]["id"]
+    assert datasets[0]["version"] == datasets[1]["version"]
+    with pytest.raises(DatasetError, match="included twice, the same input file"):
+        merge([tmp_path / "center", tmp_path / "center_recounted"], tmp_path / "twice", threads=1)
+
+
+def test_merge_into_interrupted(example_bcf, tmp_path, monkeypatch):
+    """A merge into a dataset interrupted while moving the merged files is finished by the next merge."""
+    a = make_dataset(tmp_path / "a", example_bcf, ["1", "X"], {"XX": 1, "XY": 1})
+    c = make_dataset(tmp_path / "c", example_bcf, ["1"], {"XX": 2, "XY": 0})
+    merge([a, c], tmp_path / "all", threads=1)
+    merged = make_dataset(tmp_path / "merged", example_bcf, ["1", "X"], {"XX": 1, "XY": 1})
+
+    # crash after the commit, a file of region 1 is moved but info.json is not
+    replace = os.replace
+    calls = []
+
+    def crash(src, dst):
+        calls.append(dst)
+        if len(calls) == 4:  # info.json into the staging directory, commit, first file
+            raise OSError("crash")
+        replace(src, dst)
+
+    monkeypatch.setattr(merge_action.os, "replace", crash)
+    with pytest.raises(OSError, match="crash"):
+        merge([c], None, threads=1, into=merged)
+    monkeypatch.undo()
+    assert json.loads((merged / "info.json").read_text())["sample_number"] == {"XX": 1, "XY": 1}
+
+    # c is included (the interrupted merge is finished first)
+    with pytest.raises(DatasetError, match="included twice"):
+        merge([c], None, threads=1, into=merged)
+    assert json.loads((merged / "info.json").read_text())["sample_number"] == {"XX": 3, "XY": 1}
+    for file in ["1/data.parquet", "X/data.parquet"]:
+        expected = duckdb.read_parquet(str(tmp_path / "all" / file)).fetchall()
+        assert duckdb.read_parquet(str(merged / file)).fetchall() == expected
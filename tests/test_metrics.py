@@ -0,0 +1,19 @@
+import json
+
+from tests.test_main import example_bcf, example_vcf, vcf_directory  # noqa: F401 (fixtures)
+from tests.utils import count_options, sex_map  # noqa: F401 (fixture)
+from varpile.actions import count
+from varpile.metrics import METRICS_NAME, PROFILES_DIR
+
+
+def test_metrics(example_bcf, tmp_path, sex_map):
+    output = tmp_path / "counts"
+    count(count_options(example_bcf, output, sex_map, metrics=True, profile=1))
+
+    metrics = json.loads((output / METRICS_NAME).read_text())
+    assert metrics["summary"]["process_chromosome"]["tasks"] == 2
+    assert metrics["summary"]["merge_piles"]["tasks"] == 2
+    assert metrics["summary"]["process_chromosome"]["records"] > 0
+    assert metrics["summary"]["file_is_gvcf"]["tasks"] == 1  # the sex is in the sex map, only the header is read
+    assert [task["profile"] is not None for task in metrics["tasks"]] == [True] + [False] * 4  # slowest first
+    assert len(list((output / PROFILES_DIR).iterdir())) == 1
@@ -0,0 +1,27 @@
+import duckdb
+import pytest
+
+from tests.test_main import example_bcf, example_vcf, vcf_directory  # noqa: F401 (fixtures)
+from tests.utils import count_options, sex_map  # noqa: F401 (fixture)
+from varpile.actions import count
+from varpile.errors import DatasetError
+from varpile.markers import MARKER_NAME
+
+
+def test_resume(example_bcf, tmp_path, sex_map):
+    output = tmp_path / "counts"
+    count(count_options(example_bcf, output, sex_map))
+    expected = {region: duckdb.read_parquet(str(output / region / "data.parquet")).fetchall() for region in ["1", "X"]}
+
+    # "crash" before region X was merged, resume it with a different number of shards
+    mtime = (output / "1" / "data.parquet").stat().st_mtime_ns
+    (output / "X" / MARKER_NAME).unlink()
+    (output / "X" / "data.parquet").unlink()
+    count(count_options(example_bcf, output, sex_map, resume=True, shards=2))
+
+    assert (output / "1" / "data.parquet").stat().st_mtime_ns == mtime  # not counted again
+    for region in ["1", "X"]:
+        assert duckdb.read_parquet(str(output / region / "data.parquet")).fetchall() == expected[region]
+
+    with pytest.raises(DatasetError, match="filters changed"):
+        count(count_options(example_bcf, output, sex_map, resume=True, min_DP=5))
@@ -0,0 +1,44 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from varpile.scheduler import Scheduler, Task
+
+
+def test_scheduler_order_and_follow_ups():
+    calls = []
+
+    with ThreadPoolExecutor(1) as executor:
+        scheduler = Scheduler(executor, max_in_flight=1)
+        for name, cost, group in [("a1", 1, "a"), ("b1", 5, "b"), ("a2", 3, "a"), ("b2", 4, "b")]:
+            scheduler.add(Task(calls.append, (name,), cost=cost, group=group))
+        scheduler.add_follow_up("a", Task(calls.append, ("merge a",)))
+        scheduler.add_follow_up("b", Task(calls.append, ("merge b",)))
+        scheduler.add_follow_up("b", Task(calls.append, ("finalize b",)))
+        scheduler.add_follow_up("empty", Task(calls.append, ("merge empty",)))
+        results = scheduler.run()
+
+    # largest first, follow-ups run as soon as their group is done
+    assert calls == ["merge empty", "b1", "b2", "merge b", "finalize b", "a2", "a1", "merge a"]
+    assert len(results) == 8
+
+
+def worker_pid(duration):
+    time.sleep(duration)
+    return os.getpid()
+
+
+def test_scheduler_affinity():
+    """On a pool with a process per task in flight, the tasks of a file run one after the other in the same worker."""
+    with ProcessPoolExecutor(2) as executor:
+        scheduler = Scheduler(executor, max_in_flight=2)
+        # the workers never finish at the same time (a: 0.2s each, b: 0.5s each), b2 is submitted when b1 is done
+        # and the other worker is still running a tasks. Without the affinity, the worker of a1 would run b2 next
+        # (queued before a2)
+        for name in ["a1", "b1", "b2", "a2", "a3", "a4"]:
+            scheduler.add(Task(worker_pid, (0.2 if name[0] == "a" else 0.5,), cost=1, affinity=name[0]))
+        results = scheduler.run()
+
+    pids = {affinity: {pid for task, pid in results if task.affinity == affinity} for affinity in "ab"}
+    assert len(pids["a"]) == 1 and len(pids["b"]) == 1
+    assert pids["a"] != pids["b"]
@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+
+from tests.test_main import example_bcf, example_vcf, vcf_directory  # noqa: F401 (fixtures)
+from tests.utils import count_options
+from varpile.actions import count
+from varpile.cli import make_parser
+from varpile.metrics import METRICS_NAME
+from varpile import sex_cache
+from varpile.sex_cache import SexCache
+
+
+def test_sex_cache_invalidated_on_change(example_bcf, tmp_path):
+    example_bcf = shutil.copy(example_bcf, tmp_path / example_bcf.name)  # the test modifies the file
+    cache_path = tmp_path / "cache.json"
+    samples_sex = {"SAMPLE1": "XX", "SAMPLE2": "XY"}
+
+    cache = SexCache(cache_path)
+    assert cache.get(example_bcf) is None
+    cache.set(example_bcf, samples_sex)
+    cache.save()
+
+    assert SexCache(cache_path).get(example_bcf) == samples_sex
+    # different inference options are different entries
+    assert SexCache(cache_path, windows=10).get(example_bcf) is None
+
+    # modifying the file invalidates the entry
+    stat = example_bcf.stat()
+    os.utime(example_bcf, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert SexCache(cache_path).get(example_bcf) is None
+
+
+def test_sex_cache_opt_in(example_bcf, tmp_path):
+    """The cache is only written with --sex-cache."""
+    args = make_parser().parse_args(["count", str(example_bcf), "-o", str(tmp_path / "counts")])
+    assert args.sex_cache is None
+
+    cache_path = tmp_path / "cache.json"
+    count(count_options(example_bcf, tmp_path / "counts", None, sex_cache=cache_path))
+    assert [entry["path"] for entry in json.loads(cache_path.read_text()).values()] == [str(example_bcf)]
+    assert [entry["gvcf"] for entry in json.loads(cache_path.read_text()).values()] == [False]
+
+    # the sex and whether the file is a gVCF file are cached, no job reads the file
+    count(count_options(example_bcf, tmp_path / "counts", None, sex_cache=cache_path, metrics=True))
+    summary = json.loads((tmp_path / "counts" / METRICS_NAME).read_text())["summary"]
+    assert "infer_file_sex" not in summary and "file_is_gvcf" not in summary
+
+
+def test_sex_cache_key_once(example_bcf, tmp_path, monkeypatch):
+    """A missed file is opened once to compute its key (get then set)."""
+    keys = []
+    monkeypatch.setattr(sex_cache, "file_key", lambda input_file, *args, **kwargs: keys.append(input_file) or "key")
+    cache = SexCache(tmp_path / "cache.json", "content")
+    assert cache.get(example_bcf) is None
+    cache.set(example_bcf, {"SAMPLE1": "XX", "SAMPLE2": "XY"})
+    assert keys == [example_bcf]
@@ -0,0 +1,31 @@
+import subprocess
+import sys
+
+import duckdb
+
+from tests.test_main import example_bcf, example_vcf, vcf_directory  # noqa: F401 (fixtures)
+from tests.utils import count_options, sex_map  # noqa: F401 (fixture)
+from varpile.actions import count
+
+
+def test_single_pass(example_bcf, example_vcf, tmp_path, sex_map):
+    """Unindexed and piped input files are counted in a single pass, the counts are the same."""
+    count(count_options(example_bcf, tmp_path / "indexed", sex_map))
+    count(count_options(example_vcf, tmp_path / "single_pass", sex_map, single_pass=True))
+    with open(example_bcf, "rb") as stdin:
+        command = [
+            "count",
+            "-",
+            "-o",
+            str(tmp_path / "stdin"),
+            "-r",
+            "1,X",
+            "--sex-map",
+            str(sex_map),
+        ]
+        subprocess.run([sys.executable, "-m", "varpile.cli", *command], stdin=stdin, check=True)
+
+    for region in ["1", "X"]:
+        expected = duckdb.read_parquet(str(tmp_path / "indexed" / region / "data.parquet")).fetchall()
+        for output in ["single_pass", "stdin"]:
+            assert duckdb.read_parquet(str(tmp_path / output / region / "data.parquet")).fetchall() == expected
@@ -0,0 +1,57 @@
+import duckdb
+import pytest
+
+import varpile.VariantFile as VariantFile_module
+from tests.test_main import example_bcf, example_vcf, vcf_directory  # noqa: F401 (fixtures)
+from tests.utils import count_options, sex_map  # noqa: F401 (fixture)
+from varpile.VariantFile import VariantFile
+from varpile.actions import count
+from varpile.targets import group_intervals, read_bed
+
+
+def test_read_bed(tmp_path):
+    bed = tmp_path / "targets.bed"
+    bed.write_text(
+        "track name=targets\n#comment\nchr2\t10\t20\tA\nchr1\t5\t10\nchr2\t0\t5\nchr2\t15\t30\nchr2\t30\t31\n"
+    )
+    # 1-based inclusive, overlapping (10-20, 15-30) and adjacent (30-31) intervals are merged
+    assert read_bed(bed) == {"chr2": [(1, 5), (11, 31)], "chr1": [(6, 10)]}
+
+
+def test_group_intervals():
+    intervals = [(1, 100), (201, 300), (401, 450), (501, 550), (601, 700), (801, 1000)]
+    assert group_intervals(intervals, 3) == [
+        [(1, 100), (201, 300)],
+        [(401, 450), (501, 550), (601, 700)],
+        [(801, 1000)],
+    ]
+    assert group_intervals(intervals, 1) == [intervals]
+    assert len(group_intervals(intervals[:2], 5)) == 2
+
+
+@pytest.mark.parametrize("max_skipped_records", [0, 64])
+def test_fetch_intervals(example_bcf, monkeypatch, max_skipped_records):
+    """Records overlapping several intervals (the deletion X:100-299) are returned once."""
+    monkeypatch.setattr(VariantFile_module, "MAX_SKIPPED_RECORDS", max_skipped_records)
+    with VariantFile(example_bcf) as bcf:
+        assert [r.pos for r in bcf.fetch_intervals("1", [(2, 2), (6, 6)])] == [1, 2, 6]
+        assert [r.pos for r in bcf.fetch_intervals("X", [(150, 160), (200, 210), (400, 500)])] == [100]
+        assert list(bcf.fetch_intervals("2", [(1, 100)])) == []
+
+
+@pytest.mark.parametrize("single_pass", [False, True])
+def test_count_regions_file(example_bcf, tmp_path, sex_map, single_pass):
+    """Records that start in a target are counted once, into one region per contig."""
+    bed = tmp_path / "targets.bed"
+    bed.write_text("1\t0\t2\n1\t1\t3\n1\t5\t6\nX\t0\t150\n")  # 1:1-3, 1:6 and X:1-150
+    count(count_options(example_bcf, tmp_path / "all", sex_map))
+    count(count_options(example_bcf, tmp_path / "targets", sex_map, regions_file=bed, single_pass=single_pass))
+
+    assert sorted(path.name for path in (tmp_path / "targets").iterdir() if path.is_dir()) == ["1", "X"]
+    targeted = duckdb.read_parquet(str(tmp_path / "targets" / "1" / "data.parquet")).fetchall()
+    expected = duckdb.sql(
+        f"select * from read_parquet('{tmp_path}/all/1/data.parquet') where (key >> 32) in (1, 2, 6) order by key"
+    )
+    assert targeted == expected.fetchall()
+    # the deletion X:100-299 starts in the target
+    assert len(duckdb.read_parquet(str(tmp_path / "targets" / "X" / "data.parquet")).fetchall()) > 0
@@ -0,0 +1,42 @@
+import pytest
+
+from tests.test_main import example_bcf, example_vcf, vcf_directory  # noqa: F401 (fixtures)
+from tests.utils import count_options, sex_map  # noqa: F401 (fixture)
+from varpile.actions import count, count_action
+from varpile.actions.count_action import MAX_DECOMPRESSION_THREADS, split_threads
+
+
+@pytest.mark.parametrize(
+    "threads, n_tasks, decompression_threads, expected",
+    [
+        (8, 100, None, (8, 0)),  # enough tasks for all threads
+        (8, 3, None, (3, 1)),  # fewer tasks than threads, the idle threads decompress
+        (8, 2, None, (2, 3)),
+        (16, 1, None, (1, MAX_DECOMPRESSION_THREADS)),
+        (8, 0, None, (1, MAX_DECOMPRESSION_THREADS)),  # everything resumed
+        (1, 4, None, (1, 0)),
+        (8, 100, 1, (4, 1)),  # --decompression-threads
+        (8, 100, 0, (8, 0)),
+        (8, 2, 1, (2, 1)),  # no more workers than tasks
+        (2, 100, 3, (1, 3)),
+    ],
+)
+def test_split_threads(threads, n_tasks, decompression_threads, expected):
+    workers, decompression = split_threads(threads, n_tasks, decompression_threads)
+    assert (workers, decompression) == expected
+    if decompression_threads is None and n_tasks > 0:
+        assert workers * (decompression + 1) <= threads
+
+
+def test_pool_size(example_bcf, tmp_path, sex_map, monkeypatch):
+    """The pool has a process per task in flight (no idle processes that would take the tasks of other files)."""
+    pool_sizes = []
+
+    class Pool(count_action.ProcessPoolExecutor):
+        def __init__(self, max_workers):
+            pool_sizes.append(max_workers)
+            super().__init__(max_workers)
+
+    monkeypatch.setattr(count_action, "ProcessPoolExecutor", Pool)
+    count(count_options(example_bcf, tmp_path / "counts", sex_map, threads=4, decompression_threads=3))
+    assert pool_sizes == [1]
@@ -0,0 +1,32 @@
+import duckdb
+import pyarrow as pa
+
+from varpile.variant_key import decode, decoded_sql, is_hashed, variant_key
+
+VARIANTS = [
+    (100, "A", "G"),
+    (100, "ACGTACG", "T"),
+    (100, "A", "ACGTACGT"),  # alt is too long
+    (100, "N", "A"),
+    (101, "T", "*"),
+    (2**31 - 1, "G", "<DEL>"),
+]
+
+
+def test_variant_key():
+    keys = [variant_key(*variant) for variant in VARIANTS]
+    assert [is_hashed(key) for key in keys] == [False, False, True, True, True, True]
+    assert [decode(key) for key in keys[:2]] == VARIANTS[:2]
+    assert keys[3] == variant_key(100, "N", "A")  # hashes don't depend on the process
+    assert all(0 < key < 2**63 for key in keys)
+    assert sorted(keys, key=lambda key: key >> 32) == keys  # ordered by position
+
+
+def test_decoded_sql():
+    keys = [variant_key(*variant) for variant in VARIANTS]
+    data = pa.table({"key": pa.array(keys, pa.int64()), "XX_AC": list(range(len(keys)))})
+    hashed = [(key, ref, alt) for key, (_, ref, alt) in zip(keys, VARIANTS) if is_hashed(key)]
+    alleles = pa.table({name: values for name, values in zip(["key", "ref", "alt"], zip(*hashed))})
+
+    rows = duckdb.sql(decoded_sql("data", "alleles") + " order by XX_AC").fetchall()
+    assert rows == [(*variant, i) for i, variant in enumerate(VARIANTS)]
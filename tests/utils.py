@@ -3,6 +3,9 @@ from pathlib import Path
 from typing import Optional
 
 import pysam
+import pytest
+
+from varpile.utils import Region1
 
 
 # This function is not currently used but is provided for cases
@@ -55,3 +58,28 @@ def write_vcf(path: Path, content: str, header: Optional[str] = None):
                 else:
                     assert len(columns) == expected_number_of_columns, f"Line {i}: {columns}"
                 f.write("\t".join(line.split()) + "\n")
+
+
+@pytest.fixture
+def sex_map(tmp_path):
+    """Sex map of the samples of example_vcf and example_bcf (see tests.test_main)."""
+    path = tmp_path / "sex_map.tsv"
+    path.write_text("SAMPLE1\tXX\nSAMPLE2\tXY\n")
+    return path
+
+
+def count_options(example_bcf, output, sex_map, **kwargs):
+    """Options of `varpile count` of the regions 1 and X of the input file (or of kwargs["paths"])."""
+    opt = dict(
+        paths=[example_bcf],
+        output=output,
+        regions=[Region1.from_string("1"), Region1.from_string("X")],
+        threads=1,
+        debug=False,
+        resume=False,
+        sex_map=sex_map,
+        min_DP=10,
+        min_GQ=20,
+        min_AB=0.2,
+    )
+    return opt | kwargs